@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Time and memory-profile each stage of the merge on synthetic activities.
+
+    python benchmarks/bench_merge.py --output baseline.json
+    python benchmarks/bench_merge.py --compare baseline.json
+
+Two pipelines are measured. ``cli`` starts from stream arrays (as loaded
+from the stream cache) and writes files to disk like strava_merge.py;
+``api`` starts from stravalib-style Stream objects and consumes the encoded
+output as a stream like a merge job's upload.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'api'))
+from todo import formats
+from todo.trackpoints import Trackpoints, merge_tracks, resample_1hz
+from todo.uploads import GzipStream
+
+from synthetic import CHANNEL_SETS, as_strava_streams, synthetic_activities
+
+PIPELINES = ('cli', 'api')
+DURATIONS = (600, 3600, 4 * 3600, 24 * 3600)
+SPORT = 'Ride'
+FILE_CHUNK_BYTES = 64 * 1024
+
+
+def _drain(chunks) -> int:
+    return sum(len(chunk) for chunk in chunks)
+
+
+def _read_chunks(path):
+    with open(path, 'rb') as f:
+        yield from iter(lambda: f.read(FILE_CHUNK_BYTES), b'')
+
+
+def stages(pipeline: str, workdir: str):
+    """(name, callable) pairs run in order; each callable takes and returns the shared state."""
+    def build(state):
+        state['tracks'] = [Trackpoints.from_streams(streams, start) for start, streams in state['inputs']]
+        return state
+
+    def merge(state):
+        state['merged'] = merge_tracks(state['tracks'])
+        return state
+
+    def resample(state):
+        # Timed on its own, but serialization keeps using the merged points
+        resample_1hz(state['merged'])
+        state['points'] = state['merged']
+        return state
+
+    def serialize(output_format):
+        def run(state):
+            points = state['points']
+            if pipeline == 'cli':
+                path = os.path.join(workdir, f'merged.{output_format}')
+                state[f'{output_format}_bytes'] = formats.write_file(path, output_format, points, SPORT,
+                                                                     state['total_time'], state['total_distance'])
+            else:
+                state[f'{output_format}_bytes'] = _drain(formats.encode(output_format, points, SPORT,
+                                                                        state['total_time'], state['total_distance']))
+            return state
+        return run
+
+    def compress(output_format):
+        def run(state):
+            if pipeline == 'cli':
+                chunks = _read_chunks(os.path.join(workdir, f'merged.{output_format}'))
+            else:
+                chunks = formats.encode(output_format, state['points'], SPORT, state['total_time'],
+                                        state['total_distance'])
+            state[f'{output_format}_gz_bytes'] = _drain(GzipStream(chunks, 6))
+            return state
+        return run
+
+    result = [('build', build), ('merge', merge), ('resample', resample)]
+    for output_format in formats.ENCODERS:
+        result.append((f'serialize_{output_format}', serialize(output_format)))
+    for output_format in formats.ENCODERS:
+        result.append((f'compress_{output_format}', compress(output_format)))
+    return result
+
+
+def _initial_state(pipeline: str, activities) -> dict:
+    if pipeline == 'api':
+        inputs = [(start, as_strava_streams(streams)) for start, streams in activities]
+    else:
+        inputs = activities
+    return {
+        'inputs': inputs,
+        'total_time': sum(int(streams['time'][-1]) + 1 for _, streams in activities),
+        'total_distance': sum(float(streams['distance'][-1]) for _, streams in activities),
+    }
+
+
+def run_scenario(pipeline: str, activities, repeat: int) -> dict:
+    """Best-of-``repeat`` seconds per stage, then one traced run for peak memory."""
+    seconds = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        pipeline_stages = stages(pipeline, workdir)
+        for _ in range(repeat):
+            state = _initial_state(pipeline, activities)
+            for name, stage in pipeline_stages:
+                started = time.perf_counter()
+                state = stage(state)
+                elapsed = time.perf_counter() - started
+                seconds[name] = min(seconds.get(name, elapsed), elapsed)
+
+        peaks = {}
+        state = _initial_state(pipeline, activities)
+        tracemalloc.start()
+        try:
+            for name, stage in pipeline_stages:
+                tracemalloc.reset_peak()
+                current = tracemalloc.get_traced_memory()[0]
+                state = stage(state)
+                peaks[name] = tracemalloc.get_traced_memory()[1] - current
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'points': len(state['points']),
+        'output_bytes': {key: value for key, value in state.items() if key.endswith('_bytes')},
+        'stages': {name: {'seconds': seconds[name], 'peak_bytes': peaks[name]} for name, _ in pipeline_stages},
+    }
+
+
+def run(durations, channel_sets, overlaps, pipelines, repeat: int) -> dict:
+    results = []
+    for duration in durations:
+        for channels in channel_sets:
+            for overlap in overlaps:
+                activities = synthetic_activities(duration, 2, channels, min(overlap, duration))
+                scenario = f'{duration}s-{channels}-overlap{overlap}'
+                for pipeline in pipelines:
+                    result = run_scenario(pipeline, activities, repeat)
+                    results.append({'scenario': scenario, 'pipeline': pipeline, **result})
+                    total = sum(stage['seconds'] for stage in result['stages'].values())
+                    print(f"{scenario:<32} {pipeline:<4} {result['points']:>7} points {total:8.3f}s", flush=True)
+    return {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> int:
+    """Print per-stage changes against ``baseline``; returns the number of
+    stages that got slower by more than ``threshold`` (a fraction).
+    """
+    previous = {
+        (r['scenario'], r['pipeline'], name): stage
+        for r in baseline['results'] for name, stage in r['stages'].items()
+    }
+    regressions = 0
+    for r in current['results']:
+        for name, stage in r['stages'].items():
+            before = previous.get((r['scenario'], r['pipeline'], name))
+            if before is None or not before['seconds']:
+                continue
+            change = stage['seconds'] / before['seconds'] - 1
+            memory = stage['peak_bytes'] - before['peak_bytes']
+            flag = ''
+            if change > threshold:
+                regressions += 1
+                flag = '  REGRESSION'
+            print(f"{r['scenario']:<32} {r['pipeline']:<4} {name:<16} {change:+7.1%} time "
+                  f"{memory / 1024:+10.0f} KB peak{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the merge stages on synthetic activities.")
+    parser.add_argument('--durations', type=int, nargs='+', default=list(DURATIONS), metavar='SECONDS',
+                        help="activity durations at 1 Hz (default: 10 min, 1 h, 4 h, 24 h)")
+    parser.add_argument('--channels', nargs='+', choices=sorted(CHANNEL_SETS), default=['full', 'indoor'],
+                        help="stream sets to generate (default: full indoor)")
+    parser.add_argument('--overlap', type=int, nargs='+', default=[0, 300], metavar='SECONDS',
+                        help="seconds the second activity overlaps the first (default: 0 300)")
+    parser.add_argument('--pipeline', nargs='+', choices=PIPELINES, default=list(PIPELINES))
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per scenario, best is kept (default: 3)")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', metavar='BASELINE', help="compare against a JSON file from --output")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="slowdown that counts as a regression with --compare (default: 0.1)")
+    args = parser.parse_args()
+
+    current = run(args.durations, args.channels, args.overlap, args.pipeline, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), current, args.threshold)
+        if regressions:
+            print(f"{regressions} stage(s) slower than the baseline by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""A local fake of the Strava endpoints this project uses, for load tests.
+
+Serves the athlete's activity list, activity details, streams, uploads,
+upload status and the OAuth token exchange with configurable latency,
+``X-RateLimit-*`` headers and injected errors. Point the API or CLI at it
+with ``STRAVA_BASE_URL``:
+
+    python benchmarks/fake_strava.py --port 8001 --latency 0.1
+    STRAVA_BASE_URL=http://127.0.0.1:8001 python strava_merge.py
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from synthetic import CHANNEL_SETS, synthetic_streams
+
+ROUTES = [
+    ('GET', re.compile(r'^/api/v3/athlete/activities$'), 'list_activities'),
+    ('GET', re.compile(r'^/api/v3/activities/(\d+)/streams$'), 'get_streams'),
+    ('GET', re.compile(r'^/api/v3/activities/(\d+)$'), 'get_activity'),
+    ('POST', re.compile(r'^/api/v3/uploads$'), 'create_upload'),
+    ('GET', re.compile(r'^/api/v3/uploads/(\d+)$'), 'get_upload'),
+    ('POST', re.compile(r'^/oauth/token$'), 'token'),
+]
+
+
+class FakeStrava:
+    """Threaded HTTP server holding ``activities`` synthetic activities of
+    ``duration`` seconds each, started one per day up to now.
+
+    Every response waits ``latency`` seconds plus up to ``jitter``, a
+    fraction ``error_rate`` of requests fail with one of ``error_statuses``,
+    and requests beyond ``short_limit``/``long_limit`` get a 429, with usage
+    counted since the server started.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, error_rate: float = 0.0,
+                 error_statuses=(500, 503), short_limit: int = 100000, long_limit: int = 1000000,
+                 activities: int = 20, duration: int = 3600, channels: str = 'full',
+                 upload_processing_seconds: float = 1.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        self.duration = duration
+        self.channels = channels
+        self.upload_processing_seconds = upload_processing_seconds
+        self.usage = 0
+        self.requests = {}
+        self.errors = 0
+        self.throttled = 0
+        self.uploaded_bytes = 0
+        self._uploads = {}
+        self._streams = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self.url = None
+
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        self._activities = [self._activity(i + 1, now - timedelta(days=activities - i)) for i in range(activities)]
+
+    def _activity(self, activity_id: int, start: datetime) -> dict:
+        distance = self.duration * 8.0
+        return {
+            'id': activity_id,
+            'resource_state': 2,
+            'name': f'Synthetic activity {activity_id}',
+            'type': 'Ride',
+            'sport_type': 'Ride',
+            'start_date': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'start_date_local': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'timezone': '(GMT+00:00) Africa/Abidjan',
+            'distance': distance,
+            'moving_time': self.duration,
+            'elapsed_time': self.duration,
+            'total_elevation_gain': 120.0,
+            'workout_type': None,
+            'average_speed': 8.0,
+            'max_speed': 15.0,
+            'has_heartrate': True,
+            'average_heartrate': 140.0,
+            'max_heartrate': 175.0,
+            'heartrate_opt_out': False,
+            'display_hide_heartrate_option': True,
+            'elev_high': 260.0,
+            'elev_low': 180.0,
+            'pr_count': 0,
+            'total_photo_count': 0,
+            'has_kudoed': False,
+            'manual': False,
+            'private': False,
+            'trainer': False,
+            'commute': False,
+        }
+
+    def _streams_json(self, activity_id: int) -> bytes:
+        with self._lock:
+            cached = self._streams.get(activity_id)
+        if cached is None:
+            gps, heartrate, power = CHANNEL_SETS[self.channels]
+            arrays = synthetic_streams(self.duration, activity_id, gps, heartrate, power)
+            cached = json.dumps({
+                key: {'type': key, 'data': value.tolist(), 'series_type': 'time',
+                      'original_size': len(value), 'resolution': 'high'}
+                for key, value in arrays.items()
+            }).encode()
+            with self._lock:
+                self._streams[activity_id] = cached
+        return cached
+
+    # Endpoint handlers return (status, JSON-serializable body or raw bytes)
+
+    def list_activities(self, query, body):
+        after = int(float(query.get('after', ['0'])[0]))
+        page = int(query.get('page', ['1'])[0])
+        per_page = int(query.get('per_page', ['30'])[0])
+        matching = [a for a in self._activities
+                    if datetime.strptime(a['start_date'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+                    .timestamp() > after]
+        return 200, matching[(page - 1) * per_page:page * per_page]
+
+    def get_activity(self, query, body, activity_id):
+        activity_id = int(activity_id)
+        if not 1 <= activity_id <= len(self._activities):
+            return 404, {'message': 'Record Not Found'}
+        return 200, {**self._activities[activity_id - 1], 'resource_state': 3}
+
+    def get_streams(self, query, body, activity_id):
+        activity_id = int(activity_id)
+        if not 1 <= activity_id <= len(self._activities):
+            return 404, {'message': 'Record Not Found'}
+        return 200, self._streams_json(activity_id)
+
+    def create_upload(self, query, body):
+        with self._lock:
+            upload_id = len(self._uploads) + 1
+            self._uploads[upload_id] = time.monotonic()
+            self.uploaded_bytes += len(body)
+        return 201, self._upload_status(upload_id)
+
+    def get_upload(self, query, body, upload_id):
+        if int(upload_id) not in self._uploads:
+            return 404, {'message': 'Record Not Found'}
+        return 200, self._upload_status(int(upload_id))
+
+    def _upload_status(self, upload_id: int) -> dict:
+        ready = time.monotonic() - self._uploads[upload_id] >= self.upload_processing_seconds
+        return {
+            'id': upload_id,
+            'id_str': str(upload_id),
+            'external_id': f'merged-{upload_id}',
+            'error': None,
+            'status': 'Your activity is ready.' if ready else 'Your activity is still being processed.',
+            'activity_id': 1000000 + upload_id if ready else None,
+        }
+
+    def token(self, query, body):
+        return 200, {
+            'token_type': 'Bearer',
+            'access_token': 'fake-access-token',
+            'refresh_token': 'fake-refresh-token',
+            'expires_at': int(time.time()) + 6 * 3600,
+            'expires_in': 6 * 3600,
+        }
+
+    def handle(self, method: str, path: str, query: dict, body: bytes):
+        """Returns (status, headers, body bytes)."""
+        delay = self.latency + self._random.random() * self.jitter
+        if delay > 0:
+            time.sleep(delay)
+        endpoint = method + ' ' + re.sub(r'/\d+', '/{id}', path)
+        with self._lock:
+            self.usage += 1
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            usage = self.usage
+            fail = self._random.random() < self.error_rate
+            error_status = self._random.choice(self.error_statuses) if fail else None
+        headers = {
+            'X-RateLimit-Limit': f'{self.short_limit},{self.long_limit}',
+            'X-RateLimit-Usage': f'{usage},{usage}',
+        }
+        if usage > self.short_limit or usage > self.long_limit:
+            with self._lock:
+                self.throttled += 1
+            return 429, headers, json.dumps({'message': 'Rate Limit Exceeded'}).encode()
+        if fail:
+            with self._lock:
+                self.errors += 1
+            return error_status, headers, json.dumps({'message': 'Injected error'}).encode()
+
+        for route_method, pattern, name in ROUTES:
+            match = pattern.match(path)
+            if route_method == method and match:
+                status, payload = getattr(self, name)(query, body, *match.groups())
+                break
+        else:
+            status, payload = 404, {'message': 'Not Found'}
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode()
+        return status, headers, payload
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Serve in a background thread; returns the base URL."""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _body(self) -> bytes:
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    parts = []
+                    while True:
+                        size = int(self.rfile.readline().split(b';')[0], 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return b''.join(parts)
+                        parts.append(self.rfile.read(size))
+                        self.rfile.readline()
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def _respond(self):
+                url = urlsplit(self.path)
+                status, headers, payload = fake.handle(self.command, url.path, parse_qs(url.query), self._body())
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-strava', daemon=True)
+        self._thread.start()
+        self.url = f'http://{host}:{self._server.server_address[1]}'
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'requests': dict(self.requests),
+                'usage': self.usage,
+                'errors_injected': self.errors,
+                'throttled': self.throttled,
+                'uploads': len(self._uploads),
+                'uploaded_bytes': self.uploaded_bytes,
+            }
+
+    def __enter__(self) -> 'FakeStrava':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Strava API locally.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.02, help="random extra latency, up to this many seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument('--short-limit', type=int, default=100000, help="requests before 429s (15-minute limit)")
+    parser.add_argument('--long-limit', type=int, default=1000000, help="requests before 429s (daily limit)")
+    parser.add_argument('--activities', type=int, default=20)
+    parser.add_argument('--duration', type=int, default=3600, help="seconds per synthetic activity")
+    parser.add_argument('--channels', choices=sorted(CHANNEL_SETS), default='full')
+    args = parser.parse_args()
+
+    fake = FakeStrava(args.latency, args.jitter, args.error_rate, short_limit=args.short_limit,
+                      long_limit=args.long_limit, activities=args.activities, duration=args.duration,
+                      channels=args.channels)
+    print(f"Fake Strava listening on {fake.start(args.host, args.port)}")
+    try:
+        fake._thread.join()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""Load-test the API against a fake Strava and an in-memory Mongo.
+
+    python benchmarks/load_test.py --users 20 --duration 30 --mix activities=4,merge=1
+    python benchmarks/load_test.py --error-rate 0.05 --short-limit 500 --output load.json
+
+The ``todo.app`` ASGI application is driven in-process, on the same event
+loop as its merge workers, so loop blocking caused by request handlers or
+jobs shows up in the report. Strava is a local FakeStrava server reached
+through STRAVA_BASE_URL; Mongo is mongomock-motor unless ``--mongo-url``
+points at a real server.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'api'))
+
+from fake_strava import FakeStrava
+
+OPERATIONS = ('activities', 'refresh', 'merge', 'metrics')
+MERGE_POLL_SECONDS = 0.2
+TIMEOUT_STATUS = 'timeout'
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}, expected one of {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+async def asgi_request(app, method: str, path: str, query: str = '', body: Optional[dict] = None) -> Tuple[int, bytes]:
+    """Call an ASGI app directly with a single HTTP request."""
+    payload = json.dumps(body).encode() if body is not None else b''
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [(b'host', b'loadtest'), (b'content-type', b'application/json'),
+                    (b'content-length', str(len(payload)).encode())],
+        'client': ('127.0.0.1', 0),
+        'server': ('loadtest', 80),
+    }
+    messages = [{'type': 'http.request', 'body': payload, 'more_body': False}]
+    response = {'status': 500, 'body': []}
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            response['body'].append(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return response['status'], b''.join(response['body'])
+
+
+class LoopMonitor:
+    """Measures how late a periodic ``asyncio.sleep`` wakes up, i.e. how long
+    the event loop was blocked by synchronous work.
+    """
+
+    def __init__(self, interval: float = 0.005, threshold: float = 0.01):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags: List[float] = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    def stats(self) -> dict:
+        lags = np.array(self.lags or [0.0])
+        blocked = lags[lags >= self.threshold]
+        return {
+            'blocked_seconds': float(blocked.sum()),
+            'blocked_events': int(len(blocked)),
+            'max_lag_ms': float(lags.max() * 1000),
+            'p99_lag_ms': float(np.percentile(lags, 99) * 1000),
+        }
+
+
+class LoadTest:
+    def __init__(self, app, users: int, mix: Dict[str, float], activity_count: int, seed: int = 0,
+                 request_timeout: float = 30.0, merge_timeout: float = 120.0):
+        self.app = app
+        self.request_timeout = request_timeout
+        self.merge_timeout = merge_timeout
+        self.users = users
+        self.mix = mix
+        self.activity_count = activity_count
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[object, int]] = defaultdict(lambda: defaultdict(int))
+        self.merge_seconds: List[float] = []
+        self.merge_results: Dict[str, int] = defaultdict(int)
+        # Handler exceptions by endpoint and type; the app has already answered them with a 500
+        self.exceptions: Dict[str, int] = defaultdict(int)
+        self._random = random.Random(seed)
+
+    async def _call(self, name: str, method: str, path: str, query: str = '', body: Optional[dict] = None):
+        started = time.perf_counter()
+        try:
+            status, payload = await asyncio.wait_for(asgi_request(self.app, method, path, query, body),
+                                                     self.request_timeout)
+        except asyncio.TimeoutError:
+            # e.g. waiting for the rate-limit window to reset
+            status, payload = TIMEOUT_STATUS, b''
+        except Exception as exc:
+            status, payload = 500, b''
+            self.exceptions[f'{name}: {type(exc).__name__}: {exc}'] += 1
+        self.latencies[name].append(time.perf_counter() - started)
+        self.statuses[name][status] += 1
+        # A real client would wait on the network here; without this, handlers
+        # that never suspend would keep the other users off the loop
+        await asyncio.sleep(0)
+        return status, payload
+
+    async def _merge(self, user_id: str):
+        first = self._random.randint(1, self.activity_count - 1)
+        started = time.perf_counter()
+        status, payload = await self._call('POST /api/merge', 'POST', '/api/merge', f'user_id={user_id}',
+                                           {'activity_ids': [first, first + 1], 'output_format': 'fit'})
+        if status != 202:
+            self.merge_results['rejected'] += 1
+            return
+        job_id = json.loads(payload)['job_id']
+        while time.perf_counter() - started < self.merge_timeout:
+            await asyncio.sleep(MERGE_POLL_SECONDS)
+            status, payload = await self._call('GET /api/merge/{id}', 'GET', f'/api/merge/{job_id}',
+                                               f'user_id={user_id}')
+            job = json.loads(payload) if status == 200 else {}
+            if job.get('status') in ('done', 'failed'):
+                self.merge_results[job['status']] += 1
+                self.merge_seconds.append(time.perf_counter() - started)
+                return
+        self.merge_results[TIMEOUT_STATUS] += 1
+
+    async def _user(self, user_id: str, deadline: float):
+        names, weights = zip(*self.mix.items())
+        while time.perf_counter() < deadline:
+            operation = self._random.choices(names, weights)[0]
+            if operation == 'activities':
+                await self._call('GET /api/activities', 'GET', '/api/activities', f'user_id={user_id}&limit=30')
+            elif operation == 'refresh':
+                await self._call('GET /api/activities?refresh', 'GET', '/api/activities',
+                                 f'user_id={user_id}&limit=30&refresh=true')
+            elif operation == 'metrics':
+                await self._call('GET /api/metrics', 'GET', '/api/metrics')
+            else:
+                await self._merge(user_id)
+
+    async def run(self, duration: float) -> float:
+        deadline = time.perf_counter() + duration
+        started = time.perf_counter()
+        await asyncio.gather(*(self._user(f'load{i}', deadline) for i in range(self.users)))
+        return time.perf_counter() - started
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = {}
+        for name, values in sorted(self.latencies.items()):
+            ms = np.array(values) * 1000
+            endpoints[name] = {
+                'requests': len(values),
+                'rps': len(values) / elapsed,
+                'p50_ms': float(np.percentile(ms, 50)),
+                'p90_ms': float(np.percentile(ms, 90)),
+                'p99_ms': float(np.percentile(ms, 99)),
+                'max_ms': float(ms.max()),
+                'statuses': {str(status): count for status, count in self.statuses[name].items()},
+            }
+        total = sum(len(values) for values in self.latencies.values())
+        merges = np.array(self.merge_seconds or [0.0])
+        return {
+            'elapsed_seconds': elapsed,
+            'requests': total,
+            'rps': total / elapsed,
+            'endpoints': endpoints,
+            'merges': {
+                **self.merge_results,
+                'p50_seconds': float(np.percentile(merges, 50)),
+                'p99_seconds': float(np.percentile(merges, 99)),
+            },
+            'exceptions': dict(self.exceptions),
+        }
+
+
+async def measure_merge_memory(load: LoadTest, user_id: str) -> dict:
+    """Traced peak Python/NumPy allocation of one merge, run on its own."""
+    results = dict(load.merge_results)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        await load._merge(user_id)
+        outcome = next(key for key, count in load.merge_results.items() if count != results.get(key, 0))
+        return {'merge_peak_bytes': tracemalloc.get_traced_memory()[1] - before, 'merge_peak_outcome': outcome}
+    finally:
+        tracemalloc.stop()
+
+
+async def main_async(args) -> dict:
+    fake = FakeStrava(args.latency, args.jitter, args.error_rate, short_limit=args.short_limit,
+                      long_limit=args.long_limit, activities=args.activities, duration=args.activity_duration)
+    base_url = fake.start()
+    # Settings are read when todo.app is imported, so configure it first
+    os.environ.update({
+        'STRAVA_BASE_URL': base_url,
+        'STRAVA_RATE_LIMIT_15MIN': str(args.short_limit),
+        'STRAVA_RATE_LIMIT_DAILY': str(args.long_limit),
+        'STREAM_CACHE_MAX_BYTES': str(args.stream_cache_bytes),
+        'MERGE_WORKERS': str(args.merge_workers),
+    })
+    os.environ.pop('AZURE_KEY_VAULT_ENDPOINT', None)
+    if args.stream_cache_bytes:
+        os.environ.setdefault('STREAM_CACHE_DIR', tempfile.mkdtemp(prefix='loadtest-streams-'))
+
+    from beanie import init_beanie
+    from todo.app import app
+    from todo.models import UserToken, __beanie_models__
+    from todo.routes import merge_workers, strava_pool, tokens, upload_tracker
+
+    if args.mongo_url:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        mongo = AsyncIOMotorClient(args.mongo_url)
+        await mongo.drop_database(args.mongo_database)
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        mongo = AsyncMongoMockClient()
+    # Same initialization as the app's startup event, against the chosen database
+    await init_beanie(database=mongo[args.mongo_database], document_models=__beanie_models__)
+    await tokens.start()
+    await merge_workers.start()
+    await upload_tracker.start()
+    for i in range(args.users):
+        await UserToken(user_id=f'load{i}', access_token=f'token{i}', refresh_token=f'refresh{i}',
+                        expires_at=int(time.time()) + 24 * 3600).insert()
+
+    load = LoadTest(app, args.users, args.mix, args.activities, args.seed, args.request_timeout,
+                    args.merge_timeout)
+    monitor = LoopMonitor()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    monitor.start()
+    try:
+        elapsed = await load.run(args.duration)
+    finally:
+        await monitor.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    merges = sum(load.merge_results.values())
+
+    report = load.report(elapsed)
+    report['event_loop'] = monitor.stats()
+    report['memory'] = {
+        'max_rss_kb': rss_after,
+        'rss_growth_kb': rss_after - rss_before,
+        'rss_growth_per_merge_kb': (rss_after - rss_before) / merges if merges else None,
+        **(await measure_merge_memory(load, 'load0')),
+    }
+    report['fake_strava'] = fake.stats()
+    report['rate_limit'] = strava_pool.scheduler.stats()
+    report['config'] = {key: value for key, value in vars(args).items() if key != 'output'}
+
+    await merge_workers.stop()
+    await upload_tracker.stop()
+    await tokens.stop()
+    strava_pool.shutdown()
+    fake.stop()
+    return report
+
+
+def print_report(report: dict):
+    print(f"{report['requests']} requests in {report['elapsed_seconds']:.1f}s ({report['rps']:.1f} req/s)")
+    for name, endpoint in report['endpoints'].items():
+        statuses = ' '.join(f'{code}x{count}' for code, count in sorted(endpoint['statuses'].items()))
+        print(f"  {name:<28} {endpoint['requests']:>6} {endpoint['rps']:7.1f}/s  p50 {endpoint['p50_ms']:7.1f}ms  "
+              f"p90 {endpoint['p90_ms']:7.1f}ms  p99 {endpoint['p99_ms']:7.1f}ms  [{statuses}]")
+    for error, count in report['exceptions'].items():
+        print(f"  {count}x {error}")
+    merges = report['merges']
+    print(f"merges: {merges.get('done', 0)} done, {merges.get('failed', 0)} failed, "
+          f"{merges.get('rejected', 0)} rejected, {merges.get(TIMEOUT_STATUS, 0)} timed out; p50 {merges['p50_seconds']:.2f}s p99 {merges['p99_seconds']:.2f}s")
+    loop = report['event_loop']
+    print(f"event loop: blocked {loop['blocked_seconds']:.2f}s in {loop['blocked_events']} stalls, "
+          f"max lag {loop['max_lag_ms']:.1f}ms, p99 {loop['p99_lag_ms']:.1f}ms")
+    memory = report['memory']
+    per_merge = memory['rss_growth_per_merge_kb']
+    print(f"memory: max RSS {memory['max_rss_kb'] / 1024:.0f} MB, one merge peaks at "
+          f"{memory['merge_peak_bytes'] / 1024 / 1024:.1f} MB traced ({memory['merge_peak_outcome']})"
+          + (f", RSS growth {per_merge:.0f} KB per merge" if per_merge is not None else ''))
+    fake = report['fake_strava']
+    print(f"fake Strava: {fake['usage']} calls, {fake['errors_injected']} injected errors, "
+          f"{fake['throttled']} throttled, {fake['uploaded_bytes'] / 1024:.0f} KB uploaded")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the API against a fake Strava.")
+    parser.add_argument('--users', type=int, default=10, help="concurrent virtual users (default: 10)")
+    parser.add_argument('--duration', type=float, default=20, help="seconds to generate load (default: 20)")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('activities=6,refresh=1,merge=2,metrics=1'),
+                        help="weighted operations, e.g. activities=6,refresh=1,merge=2,metrics=1")
+    parser.add_argument('--latency', type=float, default=0.05, help="fake Strava latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.02, help="fake Strava random extra latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of fake Strava calls that fail")
+    parser.add_argument('--short-limit', type=int, default=100000, help="fake Strava 15-minute request limit")
+    parser.add_argument('--long-limit', type=int, default=1000000, help="fake Strava daily request limit")
+    parser.add_argument('--activities', type=int, default=20, help="activities per athlete")
+    parser.add_argument('--activity-duration', type=int, default=3600, help="seconds per synthetic activity")
+    parser.add_argument('--request-timeout', type=float, default=30.0, help="seconds before a request counts as timed out")
+    parser.add_argument('--merge-timeout', type=float, default=120.0, help="seconds before a merge counts as timed out")
+    parser.add_argument('--merge-workers', type=int, default=2)
+    parser.add_argument('--stream-cache-bytes', type=int, default=0, help="enable the stream cache (default: off)")
+    parser.add_argument('--mongo-url', help="use this MongoDB instead of mongomock-motor")
+    parser.add_argument('--mongo-database', default='strava_merge_loadtest')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    # Strava threads can still be blocked waiting for a rate-limit window to
+    # reset; don't wait for them at interpreter exit
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Deterministic synthetic Strava streams for benchmarking the merge core."""
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+BASE_START = datetime(2024, 6, 1, 6, 0, tzinfo=timezone.utc)
+
+# Name -> (gps, heartrate, power)
+CHANNEL_SETS = {
+    'full': (True, True, True),
+    'gps_hr': (True, True, False),
+    'gps_only': (True, False, False),
+    'indoor': (False, True, True),
+}
+
+
+def synthetic_streams(duration_seconds: int, seed: int = 0, gps: bool = True, heartrate: bool = True,
+                      power: bool = True) -> Dict[str, np.ndarray]:
+    """1 Hz streams shaped like ``get_activity_streams`` output, as arrays.
+
+    The same arguments always produce the same data. Roughly one sample in
+    500 is dropped to mimic auto-pause gaps, and ``altitude``/``distance``/
+    ``cadence`` are always present.
+    """
+    rng = np.random.default_rng(seed)
+    elapsed = np.arange(duration_seconds, dtype=np.int64)
+    keep = rng.random(duration_seconds) > 0.002
+    keep[0] = True
+    elapsed = elapsed[keep]
+    n = len(elapsed)
+
+    speed = np.clip(8 + np.cumsum(rng.normal(0, 0.05, n)), 2, 15)
+    streams = {
+        'time': elapsed,
+        'distance': np.round(np.cumsum(speed), 1),
+        'altitude': np.round(200 + np.cumsum(rng.normal(0, 0.2, n)), 1),
+        'cadence': np.round(np.clip(85 + rng.normal(0, 5, n), 0, None)),
+    }
+    if gps:
+        heading = np.cumsum(rng.normal(0, 0.02, n))
+        lat = 45.0 + np.cumsum(speed * np.cos(heading)) / 111_320
+        lon = 7.0 + np.cumsum(speed * np.sin(heading)) / (111_320 * np.cos(np.radians(45.0)))
+        streams['latlng'] = np.round(np.column_stack([lat, lon]), 6)
+    if heartrate:
+        streams['heartrate'] = np.round(np.clip(140 + np.cumsum(rng.normal(0, 0.3, n)), 60, 200))
+    if power:
+        streams['watts'] = np.round(np.clip(220 + rng.normal(0, 40, n), 0, None))
+    return streams
+
+
+def as_strava_streams(arrays: Dict[str, np.ndarray]) -> Dict[str, SimpleNamespace]:
+    """Wrap arrays the way stravalib returns them: objects with a list ``data``."""
+    return {key: SimpleNamespace(data=value.tolist()) for key, value in arrays.items()}
+
+
+def synthetic_activities(duration_seconds: int, count: int = 2, channels: str = 'full',
+                         overlap_seconds: int = 0) -> List[Tuple[datetime, Dict[str, np.ndarray]]]:
+    """``count`` consecutive activities of ``duration_seconds`` each.
+
+    Each activity starts ``overlap_seconds`` before the previous one ends, so
+    a positive overlap exercises interleaving in the merge sort.
+    """
+    gps, heartrate, power = CHANNEL_SETS[channels]
+    activities = []
+    start = BASE_START
+    for seed in range(count):
+        activities.append((start, synthetic_streams(duration_seconds, seed, gps, heartrate, power)))
+        start += timedelta(seconds=duration_seconds - overlap_seconds)
+    return activities
@@ -1,11 +1,21 @@
 import asyncio
+import sys
+from pathlib import Path
 
 import motor
 import pytest
+import pytest_asyncio
+from beanie import init_beanie
 from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
 from todo.app import app, settings
+from todo.models import __beanie_models__
+from todo.ratelimit import RateLimitScheduler, StravaSession
+from todo.strava import StravaPool
+from todo.stream_cache import StreamCache
 
 TEST_DB_NAME = "test_db"
+BENCHMARKS_DIR = Path(__file__).resolve().parents[3] / "benchmarks"
 
 
 @pytest.fixture(scope="session")
@@ -22,12 +32,12 @@ def event_loop():
 
 
 @pytest.fixture()
-def app_client():
+def app_client(initialize_database):
     with TestClient(app) as client:
         yield client
 
 
-@pytest.fixture(scope="session", autouse=True)
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
 async def initialize_database():
     settings.AZURE_COSMOS_DATABASE_NAME = TEST_DB_NAME
     mongo_client = motor.motor_asyncio.AsyncIOMotorClient(
@@ -36,3 +46,37 @@ async def initialize_database():
     await mongo_client.drop_database(TEST_DB_NAME)
     yield
     await mongo_client.drop_database(TEST_DB_NAME)
+
+
+@pytest.fixture()
+async def database():
+    """An empty in-memory Mongo for tests that do not need a real server."""
+    database = AsyncMongoMockClient()[TEST_DB_NAME]
+    await init_beanie(database=database, document_models=__beanie_models__)
+    # mongomock drops partialFilterExpression in create_indexes, which beanie uses
+    for model in __beanie_models__:
+        collection = database[model.Settings.name]
+        for index in getattr(model.Settings, "indexes", []):
+            options = dict(index.document)
+            if "partialFilterExpression" in options:
+                await collection.drop_index(options["name"])
+                await collection.create_index(list(options.pop("key").items()), **options)
+
+
+@pytest.fixture()
+def fake_strava():
+    """The local fake Strava server from benchmarks/, serving 30 minute activities."""
+    sys.path.insert(0, str(BENCHMARKS_DIR))
+    from fake_strava import FakeStrava
+
+    server = FakeStrava(latency=0.0, jitter=0.0, duration=1800)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture()
+def strava_pool(fake_strava):
+    pool = StravaPool(4, StreamCache(max_bytes=0), StravaSession(RateLimitScheduler(), base_url=fake_strava.url))
+    yield pool
+    pool.shutdown()
@@ -0,0 +1,81 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from todo.activity_sync import sync_activities
+from todo.models import ActivitySync, StoredActivity
+
+NOW = datetime.now(timezone.utc)
+
+
+class StubClient:
+    """Lists activities by start date, like Strava's ``GET /athlete/activities``."""
+
+    def __init__(self, *activities):
+        self.activities = list(activities)
+        self.calls = 0
+
+    def get_activities(self, after):
+        self.calls += 1
+        return [a for a in self.activities if a.start_date > after]
+
+
+def activity(activity_id: int, days_ago: float):
+    return SimpleNamespace(
+        id=activity_id, name=f"Ride {activity_id}", start_date=NOW - timedelta(days=days_ago), type="Ride",
+        distance=10000.0, moving_time=timedelta(minutes=30), elapsed_time=timedelta(minutes=31),
+        total_elevation_gain=50.0, workout_type=None, average_speed=5.5, max_speed=10.0,
+        has_heartrate=False, average_heartrate=None, max_heartrate=None, elev_high=None, elev_low=None,
+        pr_count=0, total_photo_count=0, has_kudoed=False,
+    )
+
+
+async def sync(client, strava_pool, **options):
+    return await sync_activities("user1", client, strava_pool, min_interval=timedelta(minutes=5),
+                                 initial_window=timedelta(days=30), force=True, **options)
+
+
+async def stored_ids():
+    return sorted(a.activity.id for a in await StoredActivity.find(StoredActivity.user_id == "user1").to_list())
+
+
+async def test_late_upload_of_an_older_activity_is_synced(database, strava_pool):
+    client = StubClient(activity(1, 10), activity(2, 1))
+    await sync(client, strava_pool)
+
+    # Uploaded after the last sync, but started before the newest stored activity
+    client.activities.append(activity(3, 3))
+    assert await sync(client, strava_pool) == 2
+    assert await stored_ids() == [1, 2, 3]
+
+
+async def test_deleted_activities_are_removed(database, strava_pool):
+    client = StubClient(activity(1, 20), activity(2, 3), activity(3, 1))
+    await sync(client, strava_pool)
+
+    client.activities = [activity(3, 1)]
+    await sync(client, strava_pool)
+    # Only the overlap window was re-read
+    assert await stored_ids() == [1, 3]
+
+    await sync(client, strava_pool, reconcile_interval=timedelta(0))
+    assert await stored_ids() == [3]
+    state = await ActivitySync.find_one(ActivitySync.user_id == "user1")
+    assert state.reconciled_at is not None
+
+
+async def test_concurrent_syncs_of_a_user_run_once(database, strava_pool):
+    client = StubClient(activity(1, 10), activity(2, 1))
+    results = await asyncio.gather(*(
+        sync_activities("user1", client, strava_pool, min_interval=timedelta(minutes=5),
+                        initial_window=timedelta(days=30))
+        for _ in range(3)
+    ))
+    assert results == [2, 2, 2]
+    assert client.calls == 1
+    assert await ActivitySync.find(ActivitySync.user_id == "user1").count() == 1
+
+    # Forced refreshes share a sync just the same
+    await asyncio.gather(*(sync(client, strava_pool) for _ in range(3)))
+    assert client.calls == 2
+    assert await stored_ids() == [1, 2]
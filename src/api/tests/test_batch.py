@@ -0,0 +1,62 @@
+import json
+
+import pytest
+from stravalib import Client
+from todo import batch
+from todo.ratelimit import RateLimitScheduler, StravaSession
+
+
+def write_manifest(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_text(content)
+    return str(path)
+
+
+def test_manifest_groups_are_keyed_by_their_activity_ids(tmp_path):
+    path = write_manifest(tmp_path, "groups.json", json.dumps({"groups": [
+        {"activity_ids": [2, 1], "name": "Ride"},
+        {"id": "named", "activity_ids": "3, 4", "prefer": {"heartrate": [4]}},
+    ]}))
+    first, second = batch.load_manifest(path)
+    assert (first.key, first.activity_ids, first.name) == ("1-2", [2, 1], "Ride")
+    assert (second.key, second.activity_ids, second.prefer) == ("named", [3, 4], {"heartrate": [4]})
+
+
+def test_csv_manifest_ids_are_separated_by_spaces_or_semicolons(tmp_path):
+    path = write_manifest(tmp_path, "groups.csv", "id,activity_ids,name\na,1 2,First\nb,3;4;5,\n")
+    groups = batch.load_manifest(path)
+    assert [(g.key, g.activity_ids, g.name) for g in groups] == [
+        ("a", [1, 2], "First"), ("b", [3, 4, 5], "Merged Activity")]
+
+
+@pytest.mark.parametrize("entries, message", [
+    ([{"activity_ids": [1]}], "group 1 needs at least 2 activity ids"),
+    ([{"activity_ids": [1, 2]}, {"activity_ids": [2, 1]}], "Duplicate manifest groups: 1-2"),
+    ([{"activity_ids": [1, 2], "prefer": {"heartrate": [3]}}], "group 1: "),
+])
+def test_invalid_manifests_are_rejected(tmp_path, entries, message):
+    path = write_manifest(tmp_path, "groups.json", json.dumps(entries))
+    with pytest.raises(ValueError, match=message):
+        batch.load_manifest(path)
+
+
+def test_rerun_skips_groups_that_are_already_done(fake_strava, tmp_path):
+    output_dir = tmp_path / "merged"
+    output_dir.mkdir()
+    with open(output_dir / batch.STATE_FILE, "w") as f:
+        f.write(json.dumps({"key": "a", "status": "done", "output": "a.tcx"}) + "\n")
+        f.write(json.dumps({"key": "b", "status": "failed", "error": "Upload failed"}) + "\n")
+        f.write('{"key": "c", "sta')  # cut short by an interrupted run
+    groups = [batch.Group(key, ids, "Merged", "") for key, ids in (("a", [1, 2]), ("b", [3, 4]), ("c", [5, 6]))]
+
+    session = StravaSession(RateLimitScheduler(), fake_strava.url)
+    client = Client(access_token="token", requests_session=session, rate_limit_requests=False)
+    reported = []
+    report = batch.BatchMerge(client, session, "token", str(output_dir), processes=1,
+                              on_result=reported.append).run(groups)
+
+    assert sorted(result["key"] for result in reported) == ["b", "c"]
+    assert (report["done"], report["failed"], report["skipped"]) == (2, 0, 1)
+    assert [result["status"] for result in report["results"]] == ["skipped", "done", "done"]
+    assert fake_strava.stats()["uploads"] == 2
+    assert sorted(batch.load_state(str(output_dir))) == ["a", "b", "c"]
@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+CLI = Path(__file__).resolve().parents[3] / "strava_merge.py"
+
+
+def run_cli(fake_strava, tmp_path, *args):
+    env = {**os.environ, "STRAVA_ACCESS_TOKEN": "token", "STRAVA_BASE_URL": fake_strava.url,
+           "STREAM_CACHE_DIR": str(tmp_path / "streams")}
+    return subprocess.run([sys.executable, str(CLI), *args], cwd=tmp_path, env=env,
+                          capture_output=True, text=True, timeout=60)
+
+
+def test_merge_and_upload(fake_strava, tmp_path):
+    result = run_cli(fake_strava, tmp_path, "merge", "1", "2", "--format", "fit", "--upload")
+    assert result.returncode == 0, result.stderr
+    assert (tmp_path / "merged.fit").stat().st_size > 0
+    assert "Activity uploaded successfully" in result.stdout
+    assert fake_strava.stats()["uploads"] == 1
+
+
+def test_batch_without_upload(fake_strava, tmp_path):
+    (tmp_path / "groups.json").write_text('[{"id": "a", "activity_ids": [1, 2]}, {"id": "b", "activity_ids": [3, 4]}]')
+    result = run_cli(fake_strava, tmp_path, "--manifest", "groups.json", "--no-upload", "--format", "tcx")
+    assert result.returncode == 0, result.stderr
+    assert sorted(path.name for path in (tmp_path / "merged").glob("*.tcx")) == ["a.tcx", "b.tcx"]
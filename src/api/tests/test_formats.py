@@ -0,0 +1,73 @@
+import struct
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import numpy as np
+from todo.fit import HEADER_SIZE, crc16, iter_fit
+from todo.tcx import TCX_NAMESPACE, iter_tcx, merged_sport
+from todo.trackpoints import CHANNELS, Trackpoints
+
+START = 1_700_000_000
+NS = {'tcx': TCX_NAMESPACE}
+
+
+def points(seconds: int = 25) -> Trackpoints:
+    """A track with every channel, and GPS and heart rate dropouts."""
+    time = np.arange(START, START + seconds)
+    columns = {name: np.linspace(1.0, 100.0, seconds) for name in CHANNELS}
+    columns['lat'] = np.linspace(47.0, 47.01, seconds)
+    columns['lon'] = np.linspace(8.0, 8.01, seconds)
+    columns['lat'][3] = columns['lon'][3] = np.nan
+    columns['heartrate'][5:8] = np.nan
+    return Trackpoints(time, **columns)
+
+
+def test_tcx_is_well_formed_across_chunks():
+    track = points()
+    data = b''.join(iter_tcx(track, 'Ride', 24, 100.0, chunk_points=7))
+    root = ET.fromstring(data)
+    lap = root.find('tcx:Activities/tcx:Activity/tcx:Lap', NS)
+    assert root.find('tcx:Activities/tcx:Activity', NS).get('Sport') == 'Ride'
+    assert lap.find('tcx:TotalTimeSeconds', NS).text == '24.0'
+    assert lap.find('tcx:DistanceMeters', NS).text == '100.0'
+    trackpoints = lap.findall('tcx:Track/tcx:Trackpoint', NS)
+    assert len(trackpoints) == len(track)
+    assert trackpoints[0].find('tcx:Time', NS).text == '2023-11-14T22:13:20Z'
+    assert trackpoints[3].find('tcx:Position', NS) is None
+    assert trackpoints[5].find('tcx:HeartRateBpm', NS) is None
+    assert data == b''.join(iter_tcx(track, 'Ride', 24, 100.0))
+
+
+def test_tcx_of_no_points():
+    root = ET.fromstring(b''.join(iter_tcx(Trackpoints.empty(), 'Run', 0, 0)))
+    assert root.findall('.//tcx:Trackpoint', NS) == []
+
+
+def test_fit_header_size_and_crcs():
+    data = b''.join(iter_fit(points(), 'Ride', 24, 100.0, chunk_points=7))
+    header_size, _, _, data_size, signature, header_crc = struct.unpack('<BBHI4sH', data[:HEADER_SIZE])
+    assert header_size == HEADER_SIZE
+    assert signature == b'.FIT'
+    assert header_crc == crc16(data[:HEADER_SIZE - 2])
+    assert data_size == len(data) - HEADER_SIZE - 2
+    # The file CRC covers everything before it, so the whole file checks to zero
+    assert struct.unpack('<H', data[-2:])[0] == crc16(data[:-2])
+    assert crc16(data) == 0
+    assert data == b''.join(iter_fit(points(), 'Ride', 24, 100.0))
+
+
+def test_fit_of_no_points():
+    data = b''.join(iter_fit(Trackpoints.empty(), 'Run', 0, 0))
+    data_size = struct.unpack('<I', data[4:8])[0]
+    assert data_size == len(data) - HEADER_SIZE - 2
+    assert crc16(data) == 0
+
+
+def test_merged_sport_does_not_depend_on_the_id_order():
+    # Repeats with the ids in another order share a fingerprint and so the job
+    run = (datetime(2024, 5, 1, 7), SimpleNamespace(root='Run'))
+    ride = (datetime(2024, 5, 1, 7) + timedelta(hours=1), 'Ride')
+    assert merged_sport([run, ride]) == merged_sport([ride, run]) == 'Run'
+    # Simultaneous starts are broken by name
+    assert merged_sport([(run[0], 'Walk'), (run[0], 'Hike')]) == 'Hike'
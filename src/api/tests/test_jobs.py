@@ -0,0 +1,71 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from todo.jobs import MergeWorkerPool
+from todo.models import MergeJob, MergeStatus
+
+
+async def test_merge_job_runs_end_to_end(database, strava_pool, fake_strava):
+    await strava_pool.tokens.save("user1", "token", "refresh", int(time.time()) + 3600)
+    workers = MergeWorkerPool(1, strava_pool)
+    await workers.start()
+    try:
+        job = await workers.submit(MergeJob(user_id="user1", activity_ids=[1, 2], name="Merged",
+                                            description="", output_format="fit"))
+        await asyncio.wait_for(workers._queue.join(), 30)
+    finally:
+        await workers.stop()
+
+    job = await MergeJob.get(job.id)
+    assert job.status == MergeStatus.DONE, job.error
+    assert job.upload_id is not None
+    assert job.output_bytes > 0
+    assert fake_strava.stats()["uploads"] == 1
+
+
+def _job(**fields) -> MergeJob:
+    return MergeJob(user_id="user1", activity_ids=[1, 2], name="Merged", description="", **fields)
+
+
+async def test_only_one_pool_claims_a_job(database, strava_pool):
+    job = _job()
+    await job.insert()
+    pools = [MergeWorkerPool(1, strava_pool) for _ in range(3)]
+    claims = await asyncio.gather(*(pool._claim(job.id) for pool in pools))
+    assert sum(claim is not None for claim in claims) == 1
+
+
+async def test_resume_skips_jobs_leased_by_live_pools(database, strava_pool):
+    now = datetime.utcnow()
+    live = _job(owner="other", lease_expires_at=now + timedelta(minutes=1))
+    live_upload = _job(owner="other", lease_expires_at=now + timedelta(minutes=1), status=MergeStatus.UPLOADING)
+    dead = _job(owner="gone", lease_expires_at=now - timedelta(seconds=1))
+    dead_upload = _job(owner="gone", lease_expires_at=now - timedelta(seconds=1), status=MergeStatus.UPLOADING)
+    for job in (live, live_upload, dead, dead_upload):
+        await job.insert()
+
+    pool = MergeWorkerPool(1, strava_pool)
+    await pool._resume()
+
+    assert pool._held == {dead.id}
+    assert (await MergeJob.get(live_upload.id)).status == MergeStatus.UPLOADING
+    failed = await MergeJob.get(dead_upload.id)
+    assert failed.status == MergeStatus.FAILED
+    assert failed.error == "Interrupted during upload"
+    # Another pool cannot take the live one from its owner
+    assert await pool._claim(live.id) is None
+    assert (await pool._claim(dead.id)).owner == pool.owner
+
+
+async def test_running_jobs_keep_their_lease(database, strava_pool):
+    pool = MergeWorkerPool(1, strava_pool, lease_seconds=60)
+    job = _job(owner=pool.owner, lease_expires_at=datetime.utcnow() + timedelta(seconds=1))
+    await job.insert()
+    pool._held.add(job.id)
+    await job.set_status(MergeStatus.FETCHING)
+    await pool._renew()
+    await job.set_status(MergeStatus.MERGING)
+
+    renewed = await MergeJob.get(job.id)
+    assert renewed.lease_expires_at > datetime.utcnow() + timedelta(seconds=30)
@@ -0,0 +1,39 @@
+import asyncio
+
+from todo.jobs import MergeWorkerPool
+from todo.merge_cache import MergeResultCache, fingerprint
+from todo.models import MergeJob, MergeStatus
+
+
+def test_fingerprint_ignores_activity_order():
+    assert fingerprint("user1", [2, 1], "tcx") == fingerprint("user1", [1, 2], "tcx")
+    assert fingerprint("user1", [1, 2], "tcx") != fingerprint("user1", [1, 2], "fit")
+
+
+def _submit(pool: MergeWorkerPool, key: str):
+    return lambda: pool.submit(MergeJob(user_id="user1", activity_ids=[1, 2], name="Merged", description="",
+                                        fingerprint=key))
+
+
+async def test_replicas_submit_a_request_once(database, strava_pool):
+    key = fingerprint("user1", [1, 2], "tcx")
+    # Replicas share the database but nothing in memory
+    replicas = [(MergeResultCache(60, 0), MergeWorkerPool(1, strava_pool)) for _ in range(3)]
+    results = await asyncio.gather(*(cache.submit(key, _submit(pool, key)) for cache, pool in replicas))
+
+    assert len({job.id for job, _ in results}) == 1
+    assert sorted(reused for _, reused in results) == [False, True, True]
+    assert await MergeJob.find(MergeJob.fingerprint == key).count() == 1
+
+
+async def test_force_joins_a_running_merge_but_not_a_finished_one(database, strava_pool):
+    key = fingerprint("user1", [1, 2], "tcx")
+    cache, pool = MergeResultCache(60, 0), MergeWorkerPool(1, strava_pool)
+    first, _ = await cache.submit(key, _submit(pool, key))
+
+    job, reused = await cache.submit(key, _submit(pool, key), force=True)
+    assert (job.id, reused) == (first.id, True)
+
+    await first.set_status(MergeStatus.DONE)
+    job, reused = await cache.submit(key, _submit(pool, key), force=True)
+    assert job.id != first.id and not reused
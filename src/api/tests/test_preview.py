@@ -0,0 +1,87 @@
+import time
+
+import httpx
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from todo import routes
+from todo.preview import PreviewCache, build_preview, encode_polyline, preview_etag
+from todo.trackpoints import Trackpoints
+
+START = 1_700_000_000
+NAN = np.nan
+
+
+@pytest.mark.parametrize("coordinates, encoded", [
+    # The example from Google's polyline algorithm documentation
+    ([(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)], "_p~iF~ps|U_ulLnnqC_mqNvxq`@"),
+    ([(0.0, 0.0), (0.00001, -0.00001)], "??A@"),
+    ([], ""),
+])
+def test_encode_polyline(coordinates, encoded):
+    lat, lon = np.array(coordinates, dtype=np.float64).reshape(-1, 2).T
+    assert encode_polyline(lat, lon) == encoded
+
+
+def ten_points(**channels) -> Trackpoints:
+    columns = {"lat": np.linspace(47.0, 47.9, 10), "lon": np.linspace(8.0, 8.9, 10),
+               "distance": np.arange(10) * 10.0, "altitude": np.arange(10.0),
+               "heartrate": np.full(10, NAN), "cadence": np.full(10, NAN), "watts": np.full(10, NAN)}
+    columns.update(channels)
+    return Trackpoints(START + np.arange(10), **columns)
+
+
+def test_preview_samples_the_route_and_averages_buckets():
+    points = ten_points(heartrate=[100, 110, NAN, NAN, NAN, 120, 130, 140, NAN, 160])
+    preview = build_preview(points, 4)
+
+    route = [0, 3, 6, 9]
+    assert preview["polyline"] == encode_polyline(points.lat[route], points.lon[route])
+    assert preview["bounds"] == [47.0, 8.0, 47.9, 8.9]
+    assert (preview["points"], preview["start_time"], preview["duration"], preview["distance"]) == (
+        10, START, 9, 90.0)
+    # Buckets of samples 0-1, 2-4, 5-6 and 7-9
+    assert preview["elevation"] == [0.5, 3.0, 5.5, 8.0]
+    assert preview["heartrate"] == [105, None, 125, 150]
+
+
+def test_preview_of_a_track_without_positions_or_elevation():
+    preview = build_preview(ten_points(lat=np.full(10, NAN), lon=np.full(10, NAN), altitude=np.full(10, NAN)), 4)
+    assert (preview["polyline"], preview["bounds"], preview["elevation"]) == ("", None, None)
+
+
+def test_preview_etag_depends_on_the_request_only():
+    etag = preview_etag("user1", [2, 1], 200)
+    assert etag.startswith('"') and etag.endswith('"')
+    assert preview_etag("user1", [1, 2], 200) == etag
+    assert preview_etag("user1", [1, 2], 100) != etag
+    assert preview_etag("user2", [1, 2], 200) != etag
+
+
+async def test_revalidated_preview_is_not_modified(database, strava_pool, fake_strava, monkeypatch):
+    monkeypatch.setattr(routes, "strava_pool", strava_pool)
+    monkeypatch.setattr(routes, "stream_cache", strava_pool.stream_cache)
+    monkeypatch.setattr(routes, "preview_cache", PreviewCache(0))
+    await strava_pool.tokens.save("user1", "token", "refresh", int(time.time()) + 3600)
+    app = FastAPI()
+    app.include_router(routes.router)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/api/merge/preview", params={"activity_ids": [2, 1], "points": 50})
+        assert response.status_code == 200
+        assert len(response.json()["activities"]) == 2
+        requests = fake_strava.stats()["requests"]
+
+        etag = response.headers["ETag"]
+        revalidated = await client.get("/api/merge/preview", params={"activity_ids": [1, 2], "points": 50},
+                                       headers={"If-None-Match": etag})
+        assert revalidated.status_code == 304
+        assert revalidated.headers["ETag"] == etag
+        assert revalidated.content == b""
+        # Answered without fetching anything from Strava
+        assert fake_strava.stats()["requests"] == requests
+
+        changed = await client.get("/api/merge/preview", params={"activity_ids": [1, 2], "points": 60},
+                                   headers={"If-None-Match": etag})
+        assert changed.status_code == 200
@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+from todo.jobs import MergeWorkerPool
+from todo.models import MergeJob, MergeStatus
+from todo.ratelimit import BACKGROUND, INTERACTIVE, RateLimitScheduler
+
+ACTIVITIES_URL = "https://www.strava.com/api/v3/athlete/activities"
+
+
+def test_usage_and_limits_follow_strava_headers(strava_pool, fake_strava):
+    fake_strava.short_limit = 50
+    for _ in range(3):
+        strava_pool.session.get(ACTIVITIES_URL)
+    scheduler = strava_pool.scheduler
+    assert (scheduler.short_limit, scheduler.short_usage, scheduler.long_usage) == (50, 3, 3)
+    assert scheduler.stats()["available"] == 47
+
+
+def test_rate_limited_response_exhausts_the_window(strava_pool, fake_strava):
+    # Usage from other processes that this one has not seen yet
+    fake_strava.usage = fake_strava.short_limit = 100
+    assert strava_pool.session.get(ACTIVITIES_URL).status_code == 429
+    assert strava_pool.scheduler.admit(1, INTERACTIVE) is None
+    assert strava_pool.scheduler.stats()["throttled"] == 0
+
+
+def test_background_work_leaves_a_reserve():
+    scheduler = RateLimitScheduler(short_limit=10, background_reserve=0.2)
+    assert scheduler.capacity(BACKGROUND) == 8
+    assert scheduler.admit(9, BACKGROUND) is None
+    assert scheduler.admit(10, INTERACTIVE) is not None
+
+
+def test_unused_reservations_are_released():
+    scheduler = RateLimitScheduler(short_limit=10, background_reserve=0.0)
+    with scheduler.admit(6) as reservation:
+        scheduler.acquire(reservation=reservation)
+        assert scheduler.admit(5) is None
+    assert scheduler.reserved == 0
+    assert scheduler.admit(9) is not None
+
+
+async def test_merges_larger_than_a_window_fail(database, strava_pool):
+    await strava_pool.tokens.save("user1", "token", "refresh", int(time.time()) + 3600)
+    strava_pool.scheduler.short_limit = 20
+    workers = MergeWorkerPool(1, strava_pool)
+    await workers.start()
+    try:
+        # Two calls per uncached activity plus the upload
+        job = await workers.submit(MergeJob(user_id="user1", activity_ids=list(range(1, 11)), name="Merged",
+                                            description=""))
+        await asyncio.wait_for(workers._queue.join(), 10)
+    finally:
+        await workers.stop()
+
+    job = await MergeJob.get(job.id)
+    assert job.status == MergeStatus.FAILED
+    assert job.error == "Merging 10 activities needs 21 Strava calls, more than the 16 a rate-limit window allows"
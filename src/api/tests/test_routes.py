@@ -0,0 +1,42 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from todo import routes
+from todo.activity_sync import sync_activities
+from todo.models import MergeJob
+
+
+@pytest.fixture()
+def local_timezone():
+    """Run in a non-UTC local time zone, where naive datetimes are misread."""
+    previous = os.environ.get("TZ")
+    os.environ["TZ"] = "America/New_York"
+    time.tzset()
+    yield
+    if previous is None:
+        del os.environ["TZ"]
+    else:
+        os.environ["TZ"] = previous
+    time.tzset()
+
+
+async def test_load_tracks_reads_stored_start_dates_as_utc(database, strava_pool, fake_strava,
+                                                          local_timezone, monkeypatch):
+    monkeypatch.setattr(routes, "strava_pool", strava_pool)
+    monkeypatch.setattr(routes, "stream_cache", strava_pool.stream_cache)
+    await strava_pool.tokens.save("user1", "token", "refresh", int(time.time()) + 3600)
+    client = await strava_pool.clients.get("user1")
+    await sync_activities("user1", client, strava_pool, min_interval=timedelta(0), initial_window=timedelta(days=30))
+
+    [track] = await routes.load_tracks("user1", client, [1])
+    start = datetime.strptime(fake_strava._activities[0]["start_date"], "%Y-%m-%dT%H:%M:%SZ")
+    assert track.time[0] == int(start.replace(tzinfo=timezone.utc).timestamp())
+
+
+def test_simplify_savings_are_estimated_from_serialization_time():
+    job = MergeJob(user_id="user1", activity_ids=[1, 2], name="Merged", description="", points_in=3000,
+                   points_out=1000, simplify_seconds=0.1, serialize_seconds=0.5, upload_seconds=20.0)
+    # Writing the 2000 dropped points would have taken twice the 0.5s of the 1000 kept
+    assert routes.merge_job_status(job)["simplify"]["estimated_seconds_saved"] == pytest.approx(0.9)
@@ -0,0 +1,52 @@
+import threading
+from types import SimpleNamespace
+
+from todo import app, routes
+from todo.models import Settings, get_settings
+
+
+class StubSecretClient:
+    """Serves secrets from a dict, like azure.keyvault.secrets.SecretClient."""
+
+    def __init__(self, secrets: dict, concurrent: int = 1):
+        self.secrets = secrets
+        self.fetched = []
+        # Every get_secret waits until ``concurrent`` of them are in flight
+        self._barrier = threading.Barrier(concurrent, timeout=5)
+
+    def list_properties_of_secrets(self):
+        return [SimpleNamespace(name=name) for name in self.secrets]
+
+    def get_secret(self, name):
+        self._barrier.wait()
+        self.fetched.append(name)
+        return SimpleNamespace(name=name, value=self.secrets[name])
+
+
+def test_loads_only_declared_secrets_concurrently():
+    client = StubSecretClient({"strava-client-id": "123", "strava-client-secret": "s3cret", "unrelated": "x"},
+                              concurrent=2)
+    settings = Settings()
+    settings.load_secrets(client)
+    assert (settings.STRAVA_CLIENT_ID, settings.STRAVA_CLIENT_SECRET) == ("123", "s3cret")
+    assert sorted(client.fetched) == ["strava-client-id", "strava-client-secret"]
+
+
+def test_load_all_secrets():
+    settings = Settings(AZURE_KEY_VAULT_LOAD_ALL=True)
+    client = StubSecretClient({"strava-client-id": "123", "unrelated": "x"})
+    settings.load_secrets(client)
+    assert sorted(client.fetched) == ["strava-client-id", "unrelated"]
+
+
+def test_refresh_reuses_the_client():
+    client = StubSecretClient({"strava-client-secret": "old"})
+    settings = Settings()
+    settings.load_secrets(client)
+    client.secrets["strava-client-secret"] = "new"
+    settings.load_secrets()
+    assert settings.STRAVA_CLIENT_SECRET == "new"
+
+
+def test_settings_are_shared():
+    assert get_settings() is app.settings is routes.settings
@@ -0,0 +1,69 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+from todo.stream_cache import StreamCache
+
+
+class StubClient:
+    """Serves the same streams for every activity, like stravalib's ``get_activity_streams``."""
+
+    def __init__(self, points: int = 100):
+        rng = np.random.default_rng(0)
+        self.streams = {
+            "time": SimpleNamespace(data=list(range(points))),
+            "latlng": SimpleNamespace(data=(rng.random((points, 2)) + [52.0, 4.0]).tolist()),
+            "heartrate": SimpleNamespace(data=rng.integers(90, 180, points).tolist()),
+            "cadence": SimpleNamespace(data=None),
+        }
+        self.calls = 0
+
+    def get_activity_streams(self, activity_id, types):
+        self.calls += 1
+        return self.streams
+
+
+def test_streams_are_downloaded_once(tmp_path):
+    cache = StreamCache(str(tmp_path), max_bytes=10 * 1024 * 1024)
+    client = StubClient()
+
+    first = cache.fetch(client, 1)
+    second = cache.fetch(client, 1)
+
+    assert client.calls == 1
+    assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "hit_rate": 0.5}
+    assert set(second) == {"time", "latlng", "heartrate"}
+    for key in first:
+        np.testing.assert_array_equal(second[key], first[key])
+    assert second["time"].dtype == np.int64
+    assert second["latlng"].shape == (100, 2)
+    np.testing.assert_array_equal(second["latlng"], client.streams["latlng"].data)
+
+
+def test_disabled_cache_writes_nothing(tmp_path):
+    cache = StreamCache(str(tmp_path / "streams"), max_bytes=0)
+    client = StubClient()
+    cache.fetch(client, 1)
+    cache.fetch(client, 1)
+    assert client.calls == 2
+    assert not (tmp_path / "streams").exists()
+
+
+def test_least_recently_used_streams_are_evicted(tmp_path):
+    client = StubClient(1000)
+    cache = StreamCache(str(tmp_path), max_bytes=10 * 1024 * 1024)
+    cache.fetch(client, 1)
+    size = os.path.getsize(tmp_path / "1.npz")
+    # Room for two entries
+    cache.max_bytes = int(size * 2.5)
+    cache.fetch(client, 2)
+    os.utime(tmp_path / "1.npz", (1000, 1000))
+    os.utime(tmp_path / "2.npz", (2000, 2000))
+
+    # Reading activity 1 makes it the most recently used, so 2 goes
+    cache.fetch(client, 1)
+    cache.fetch(client, 3)
+
+    assert sorted(os.listdir(tmp_path)) == ["1.npz", "3.npz"]
+    assert cache.evictions == 1
+    assert not cache.contains(2)
@@ -0,0 +1,19 @@
+import time
+
+from todo.models import Settings
+from todo.tokens import TokenStore
+
+
+async def test_refresh_uses_credentials_loaded_after_startup(database, strava_pool, fake_strava):
+    settings = Settings()
+    tokens = TokenStore(strava_pool.session, settings)
+    await tokens.save("user1", "expired", "refresh", int(time.time()) - 60)
+
+    assert (await tokens.get("user1")).access_token == "expired"
+
+    # e.g. reloaded from Key Vault
+    settings.STRAVA_CLIENT_ID, settings.STRAVA_CLIENT_SECRET = "123", "s3cret"
+    token = await tokens.get("user1")
+    assert token.access_token == "fake-access-token"
+    assert token.expires_at > time.time()
+    assert tokens.stats()["refreshes"] == 1
@@ -0,0 +1,144 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from todo.trackpoints import (CHANNELS, EARTH_RADIUS_M, Trackpoints, decimate, merge_tracks, reduce_points,
+                              resample_1hz, simplify, source_priority)
+
+START = 1_700_000_000
+
+
+def track(start: int, seconds: int, step: int = 1, **channels) -> Trackpoints:
+    """A 1 km/100 s track sampled every ``step`` seconds; unspecified channels are missing."""
+    time = np.arange(start, start + seconds, step)
+    columns = {name: np.full(len(time), np.nan) for name in CHANNELS}
+    columns['distance'] = (time - start) * 10.0
+    for name, value in channels.items():
+        columns[name] = np.broadcast_to(np.asarray(value, dtype=np.float64), len(time)).copy()
+    return Trackpoints(time, **columns)
+
+
+def test_totals_of_overlapping_tracks():
+    # A watch and a bike computer recording the same hour
+    merged = merge_tracks([track(START, 3600), track(START + 60, 3540)])
+    assert merged.duration() == 3599
+    assert merged.total_distance() == 35990.0
+
+
+def test_from_streams_fills_missing_samples_with_nan():
+    start = datetime.fromtimestamp(START, timezone.utc)
+    streams = {
+        # stravalib Stream objects and cached arrays both work
+        'time': SimpleNamespace(data=[0, 1, 2, 3]),
+        'latlng': [[47.0, 8.0], [47.1, 8.1]],
+        'heartrate': SimpleNamespace(data=[120, None, 125]),
+        'watts': None,
+    }
+    points = Trackpoints.from_streams(streams, start)
+    assert points.time.tolist() == [START, START + 1, START + 2, START + 3]
+    assert points.lat[:2].tolist() == [47.0, 47.1]
+    assert points.mask('position').tolist() == [True, True, False, False]
+    assert points.mask('heartrate').tolist() == [True, False, True, False]
+    assert not points.mask('distance').any()
+    assert not points.mask('watts').any()
+
+    assert len(Trackpoints.from_streams({'time': []}, start)) == 0
+    assert len(Trackpoints.from_streams({}, start)) == 0
+
+
+def test_merge_sequential_tracks():
+    merged = merge_tracks([track(START + 200, 100), track(START, 100)])
+    assert len(merged) == 200
+    assert (np.diff(merged.time) > 0).all()
+    # The break between the activities adds no distance
+    assert merged.distance[99] == merged.distance[100] == 990.0
+    assert merged.total_distance() == 1980.0
+
+
+def test_merge_overlapping_tracks_prefers_the_earliest_start():
+    merged = merge_tracks([track(START + 50, 100, heartrate=150), track(START, 100, heartrate=100)])
+    assert merged.time.tolist() == list(range(START, START + 150))
+    assert (merged.heartrate[:100] == 100).all()
+    assert (merged.heartrate[100:] == 150).all()
+    assert (np.diff(merged.distance) >= 0).all()
+    assert merged.total_distance() == 1490.0
+
+
+def test_merge_overlapping_tracks_by_priority():
+    watch = track(START, 100, lat=47.0, lon=8.0, heartrate=100)
+    bike = track(START + 50, 100, lat=46.0, lon=7.0, heartrate=150, watts=200)
+    merged = merge_tracks([watch, bike], priority={'heartrate': [1]})
+    overlap = slice(50, 100)
+    assert (merged.heartrate[overlap] == 150).all()
+    assert (merged.heartrate[:50] == 100).all()
+    assert (merged.lat[overlap] == 47.0).all()
+    # Channels only one track has are filled from it
+    assert (merged.watts[50:] == 200).all() and not merged.mask('watts')[:50].any()
+
+
+def test_source_priority_rejects_unknown_channels_and_activities():
+    assert source_priority([11, 22], {'heartrate': [22]}) == {'heartrate': [1]}
+    with pytest.raises(ValueError):
+        source_priority([11, 22], {'speed': [22]})
+    with pytest.raises(ValueError):
+        source_priority([11, 22], {'heartrate': [33]})
+
+
+def test_resample_fills_short_gaps():
+    points = resample_1hz(track(START, 20, step=5, heartrate=[100, 110, 120, 130]))
+    assert points.time.tolist() == list(range(START, START + 16))
+    assert points.distance.tolist() == [10.0 * i for i in range(16)]
+    assert points.heartrate[:6].tolist() == [100, 102, 104, 106, 108, 110]
+
+
+def test_resample_keeps_long_gaps():
+    points = merge_tracks([track(START, 3), track(START + 100, 2)], resample=True)
+    assert points.time.tolist() == [START, START + 1, START + 2, START + 100, START + 101]
+
+    # A channel's own long gap stays missing even when the timeline has no gap
+    heartrate = np.full(41, np.nan)
+    heartrate[[0, 40]] = 100.0
+    points = resample_1hz(track(START, 41, heartrate=heartrate).take(slice(None, None, 10)))
+    assert len(points) == 41
+    assert points.mask('heartrate').tolist() == [True] + [False] * 39 + [True]
+
+
+def test_decimate_keeps_the_first_point_of_each_interval_and_the_last():
+    assert decimate(track(START, 11), 5).time.tolist() == [START, START + 5, START + 10]
+    assert decimate(track(START, 12), 5).time.tolist() == [START, START + 5, START + 10, START + 11]
+    irregular = track(START, 15).take(np.array([0, 4, 5, 9, 10, 14]))
+    assert decimate(irregular, 5).time.tolist() == [START, START + 5, START + 10, START + 14]
+    assert len(decimate(track(START, 11), 1)) == 11
+
+
+def line_with_detour(detour_m: float) -> Trackpoints:
+    """21 points due north at constant altitude; the middle one is ``detour_m`` east."""
+    lat = np.linspace(47.0, 47.01, 21)
+    lon = np.full(21, 8.0)
+    lon[10] += np.degrees(detour_m / (EARTH_RADIUS_M * np.cos(np.radians(lat.mean()))))
+    return track(START, 21, lat=lat, lon=lon, altitude=500.0)
+
+
+def test_simplify_drops_points_within_tolerance():
+    assert simplify(line_with_detour(10.0), 10.1).time.tolist() == [START, START + 20]
+    assert simplify(line_with_detour(10.0), 9.9).time.tolist() == [START, START + 10, START + 20]
+
+
+def test_simplify_keeps_endpoints_and_points_without_position():
+    points = line_with_detour(0.0)
+    for name in ('lat', 'lon'):
+        getattr(points, name)[[0, 5, 20]] = np.nan
+    assert simplify(points, 1.0).time.tolist() == [START, START + 1, START + 5, START + 19, START + 20]
+
+
+def test_reduce_points_decimates_then_simplifies():
+    points = line_with_detour(10.0)
+    reduced, reduction = reduce_points(points, interval_seconds=5)
+    assert reduced.time.tolist() == [START, START + 5, START + 10, START + 15, START + 20]
+    reduced, reduction = reduce_points(points, interval_seconds=5, tolerance_m=5.0)
+    assert reduced.time.tolist() == [START, START + 10, START + 20]
+    assert (reduction.points_in, reduction.points_out) == (21, 3)
+    assert reduction.ratio == 3 / 21
+    reduced, reduction = reduce_points(points)
+    assert reduced is points and reduction.ratio == 1.0
@@ -0,0 +1,117 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from todo import uploads
+from todo.models import MergeJob, MergeResult, MergeStatus, UploadState
+from todo.upload_tracker import UploadTracker, _Pending
+
+
+@pytest.fixture()
+async def tracker(database, strava_pool):
+    tracker = UploadTracker(strava_pool, initial_delay=0.01, max_delay=0.04, timeout=10.0)
+    yield tracker
+    await tracker.stop()
+
+
+async def uploaded_job(**fields) -> MergeJob:
+    job = MergeJob(user_id="user1", activity_ids=[1, 2], name="Merged", description="", status=MergeStatus.DONE,
+                   upload_id=10, upload_state=UploadState.PROCESSING, **fields)
+    await job.insert()
+    return job
+
+
+def script_checks(tracker, outcomes):
+    """Answer polls from ``outcomes``, recording the job and time of each."""
+    polls = []
+
+    async def check(job):
+        polls.append((job.id, asyncio.get_running_loop().time()))
+        return outcomes.pop(0) if isinstance(outcomes, list) else outcomes
+
+    tracker._check = check
+    return polls
+
+
+async def test_polls_back_off_until_the_upload_is_ready(tracker):
+    job = await uploaded_job(owner="pool")
+    await tracker.track(job)
+    polls = script_checks(tracker, [uploads.UploadOutcome(uploads.PROCESSING)] * 4
+                          + [uploads.UploadOutcome(uploads.READY, activity_id=99)])
+    await tracker.start()
+    await tracker.wait(job.id, 5)
+
+    gaps = [b - a for (_, a), (_, b) in zip(polls, polls[1:])]
+    # Doubling from 0.01s, capped at 0.04s
+    assert gaps == pytest.approx([0.02, 0.04, 0.04, 0.04], abs=0.015)
+    job = await MergeJob.get(job.id)
+    assert (job.upload_state, job.activity_id, job.owner) == (UploadState.READY, 99, tracker.owner)
+    assert tracker.stats()["outcomes"]["ready"] == 1
+    assert tracker.stats()["pending"] == 0
+
+
+async def test_rejected_upload_drops_the_reusable_result(tracker):
+    job = await uploaded_job(owner="pool")
+    await MergeResult(fingerprint="abc", user_id="user1", job_id=job.id, output_format="fit",
+                      expires_at=datetime.utcnow() + timedelta(hours=1)).insert()
+    await tracker.track(job)
+    script_checks(tracker, uploads.UploadOutcome(uploads.ERROR, error="duplicate of activity 5"))
+    await tracker.start()
+    await tracker.wait(job.id, 5)
+
+    job = await MergeJob.get(job.id)
+    assert (job.upload_state, job.upload_error) == (UploadState.ERROR, "duplicate of activity 5")
+    assert await MergeResult.find(MergeResult.job_id == job.id).count() == 0
+
+
+async def test_upload_still_processing_at_the_deadline_times_out(tracker):
+    tracker.timeout = 0.05
+    job = await uploaded_job(owner="pool")
+    await tracker.track(job)
+    script_checks(tracker, uploads.UploadOutcome(uploads.PROCESSING))
+    await tracker.start()
+    await tracker.wait(job.id, 5)
+
+    job = await MergeJob.get(job.id)
+    assert job.upload_state == UploadState.TIMEOUT
+
+
+async def test_uploads_are_polled_in_order_of_when_they_are_due(tracker):
+    jobs = [await uploaded_job(owner=tracker.owner) for _ in range(3)]
+    now = asyncio.get_running_loop().time()
+    for job, due in zip(jobs, (0.03, 0.01, 0.02)):
+        tracker._held.add(job.id)
+        tracker._pending.append(_Pending(now + due, job.id, 0.01, now + 10))
+    tracker._pending.sort()
+    polls = script_checks(tracker, uploads.UploadOutcome(uploads.READY, activity_id=1))
+    await tracker.start()
+    await asyncio.gather(*(tracker.wait(job.id, 5) for job in jobs))
+
+    assert [job_id for job_id, _ in polls] == [jobs[1].id, jobs[2].id, jobs[0].id]
+
+
+async def test_each_upload_is_followed_by_one_live_tracker(database, strava_pool):
+    now = datetime.utcnow()
+    live = await uploaded_job(owner="other", lease_expires_at=now + timedelta(minutes=1))
+    dead = await uploaded_job(owner="gone", lease_expires_at=now - timedelta(seconds=1))
+    unleased = await uploaded_job()
+
+    trackers = [UploadTracker(strava_pool) for _ in range(3)]
+    await asyncio.gather(*(tracker._resume() for tracker in trackers))
+
+    held = [job_id for tracker in trackers for job_id in tracker._held]
+    assert sorted(held) == sorted([dead.id, unleased.id])
+    assert (await MergeJob.get(live.id)).owner == "other"
+
+
+async def test_tracker_stops_polling_an_upload_taken_over_elsewhere(tracker):
+    job = await uploaded_job(owner="pool")
+    await tracker.track(job)
+    await MergeJob.get_motor_collection().update_one({"_id": job.id}, {"$set": {"owner": "other"}})
+    polls = script_checks(tracker, uploads.UploadOutcome(uploads.READY))
+    await tracker.start()
+    await asyncio.sleep(0.05)
+
+    assert polls == []
+    assert tracker.stats()["pending"] == 0
+    assert job.id not in tracker._held
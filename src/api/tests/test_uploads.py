@@ -0,0 +1,50 @@
+import gzip
+import os
+import zlib
+
+from todo import uploads
+from todo.uploads import GzipStream, RetainedCopy
+
+
+def test_gzip_stream_round_trip():
+    chunks = [b'<Trackpoint>' * 1000, b'', os.urandom(5000), b'</Track>']
+    stream = GzipStream(iter(chunks))
+    compressed = b''.join(stream)
+    assert gzip.decompress(compressed) == b''.join(chunks)
+    assert stream.raw_bytes == sum(map(len, chunks))
+    assert stream.compressed_bytes == len(compressed)
+
+
+def test_gzip_stream_of_nothing():
+    assert gzip.decompress(b''.join(GzipStream(iter([])))) == b''
+
+
+def test_retained_copy_is_gzipped():
+    chunks = [b'<Trackpoint>' * 1000, b'</Track>']
+    retained = RetainedCopy(iter(chunks), max_bytes=10000, level=6)
+    assert list(retained) == chunks
+    assert gzip.decompress(retained.data) == b''.join(chunks)
+
+
+def test_retained_copy_stops_compressing_past_max_bytes(monkeypatch):
+    compressed = []
+    compressobj = zlib.compressobj
+
+    class Compressor:
+        def __init__(self, *args):
+            self._compressor = compressobj(*args)
+
+        def compress(self, data):
+            compressed.append(data)
+            return self._compressor.compress(data)
+
+        def flush(self):
+            compressed.append(b'')
+            return self._compressor.flush()
+
+    monkeypatch.setattr(uploads.zlib, 'compressobj', Compressor)
+    chunks = [os.urandom(64 * 1024) for _ in range(10)]
+    retained = RetainedCopy(iter(chunks), max_bytes=100 * 1024, level=6)
+    assert list(retained) == chunks
+    assert retained.data is None
+    assert len(compressed) < 5
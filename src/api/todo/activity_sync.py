@@ -0,0 +1,135 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Sequence
+
+from pymongo import DESCENDING, UpdateOne
+from stravalib import Client
+
+from .models import Activity, ActivitySync, StoredActivity
+from .strava import StravaPool
+from .tcx import elapsed_seconds, sport_name
+
+# Always projected so that clients can page with ``before=<last start_date>``
+CURSOR_FIELDS = ("id", "start_date")
+
+# Syncs in progress in this process, by user
+_in_flight: Dict[str, "asyncio.Future[int]"] = {}
+
+
+def activity_from_strava(a) -> Activity:
+    return Activity(
+        id=a.id,
+        name=a.name,
+        start_date=a.start_date.isoformat(),
+        type=sport_name(a.type),
+        distance=float(a.distance),
+        moving_time=elapsed_seconds(a.moving_time),
+        elapsed_time=elapsed_seconds(a.elapsed_time),
+        total_elevation_gain=float(a.total_elevation_gain),
+        workout_type=a.workout_type,
+        average_speed=float(a.average_speed),
+        max_speed=float(a.max_speed),
+        has_heartrate=a.has_heartrate,
+        average_heartrate=a.average_heartrate,
+        max_heartrate=a.max_heartrate,
+        # Not in stravalib 1.x models
+        heartrate_opt_out=getattr(a, 'heartrate_opt_out', None) or False,
+        display_hide_heartrate_option=getattr(a, 'display_hide_heartrate_option', None) or False,
+        elev_high=a.elev_high,
+        elev_low=a.elev_low,
+        pr_count=a.pr_count,
+        total_photo_count=a.total_photo_count,
+        has_kudoed=a.has_kudoed
+    )
+
+
+async def sync_activities(user_id: str, client: Client, strava_pool: StravaPool,
+                          min_interval: timedelta, initial_window: timedelta,
+                          overlap: timedelta = timedelta(days=7),
+                          reconcile_interval: timedelta = timedelta(days=1), force: bool = False) -> int:
+    """Pull recent activities from Strava into Mongo.
+
+    Strava lists activities by start date only, so each sync re-reads
+    ``overlap`` before the newest stored activity to catch late uploads of
+    older recordings (including merges this app uploaded). Every
+    ``reconcile_interval`` the whole stored range is re-read instead. Stored
+    activities in the re-read range that Strava no longer lists were deleted
+    there and are removed.
+
+    Skipped when the user was synced less than ``min_interval`` ago unless
+    ``force`` is set. Callers that arrive while the user is being synced
+    share that sync. Returns the number of activities fetched from Strava.
+    """
+    running = _in_flight.get(user_id)
+    if running is None:
+        running = _in_flight[user_id] = asyncio.ensure_future(
+            _sync(user_id, client, strava_pool, min_interval, initial_window, overlap, reconcile_interval, force))
+        running.add_done_callback(lambda _: _in_flight.pop(user_id, None))
+    # A caller that goes away does not cancel the sync for the others
+    return await asyncio.shield(running)
+
+
+async def _sync(user_id: str, client: Client, strava_pool: StravaPool, min_interval: timedelta,
+                initial_window: timedelta, overlap: timedelta, reconcile_interval: timedelta, force: bool) -> int:
+    now = datetime.now(timezone.utc)
+    state = await ActivitySync.find_one(ActivitySync.user_id == user_id)
+    if state and not force and now - state.synced_at.replace(tzinfo=timezone.utc) < min_interval:
+        return 0
+
+    reconcile = (state is None or state.reconciled_at is None
+                 or now - state.reconciled_at.replace(tzinfo=timezone.utc) >= reconcile_interval)
+    stored = StoredActivity.find(StoredActivity.user_id == user_id)
+    if reconcile:
+        oldest = await stored.sort(+StoredActivity.start_date).first_or_none()
+        after = now - initial_window
+        if oldest:
+            # ``after`` is exclusive
+            after = min(after, oldest.start_date.replace(tzinfo=timezone.utc) - timedelta(seconds=1))
+    else:
+        newest = await stored.sort(-StoredActivity.start_date).first_or_none()
+        after = newest.start_date.replace(tzinfo=timezone.utc) - overlap if newest else now - initial_window
+    activities = await strava_pool.run(lambda: list(client.get_activities(after=after)))
+
+    collection = StoredActivity.get_motor_collection()
+    if activities:
+        await collection.bulk_write([
+            UpdateOne(
+                {"user_id": user_id, "activity.id": a.id},
+                {"$set": {"start_date": a.start_date, "activity": activity_from_strava(a).dict()}},
+                upsert=True,
+            )
+            for a in activities
+        ], ordered=False)
+    await collection.delete_many({
+        "user_id": user_id,
+        "start_date": {"$gt": after},
+        "activity.id": {"$nin": [a.id for a in activities]},
+    })
+
+    # Upserted atomically, as another replica may be syncing the same user
+    synced = {"synced_at": now, "reconciled_at": now} if reconcile else {"synced_at": now}
+    await ActivitySync.get_motor_collection().update_one({"user_id": user_id}, {"$set": synced}, upsert=True)
+    return len(activities)
+
+
+async def list_activities(user_id: str, limit: int, before: Optional[datetime] = None,
+                          fields: Optional[Sequence[str]] = None) -> List[dict]:
+    """Newest-first page of stored activities from a single indexed query.
+
+    Pass the last item's ``start_date`` as ``before`` to get the next page.
+    ``fields`` restricts each item to those Activity fields.
+    """
+    query = {"user_id": user_id}
+    if before:
+        query["start_date"] = {"$lt": before}
+    if fields:
+        projection = {f"activity.{name}": 1 for name in set(fields) | set(CURSOR_FIELDS)}
+    else:
+        projection = {"activity": 1}
+    projection["_id"] = 0
+
+    cursor = (StoredActivity.get_motor_collection()
+              .find(query, projection)
+              .sort("start_date", DESCENDING)
+              .limit(limit))
+    return [doc["activity"] async for doc in cursor]
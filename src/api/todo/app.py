@@ -1,15 +1,26 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
 import motor
-from azure.monitor.opentelemetry.exporter import AzureMonitorTraceExporter
+from azure.monitor.opentelemetry.exporter import AzureMonitorMetricExporter, AzureMonitorTraceExporter
 from beanie import init_beanie
 from fastapi import FastAPI
+from opentelemetry import metrics, trace
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
 
-from .models import Settings, __beanie_models__
+from .models import __beanie_models__, get_settings
+
+logger = logging.getLogger(__name__)
 
-settings = Settings()
+import_started = time.perf_counter()
+settings = get_settings()
 app = FastAPI(
     description="Strava Activity Merger API",
     version="2.0.0",
@@ -25,15 +36,26 @@ if settings.APPLICATIONINSIGHTS_CONNECTION_STRING:
         resource=Resource({SERVICE_NAME: settings.APPLICATIONINSIGHTS_ROLENAME})
     )
     tracerProvider.add_span_processor(BatchSpanProcessor(exporter))
+    # Global, so the merge stage and Strava HTTP spans are exported too
+    trace.set_tracer_provider(tracerProvider)
+    metrics.set_meter_provider(MeterProvider(
+        resource=Resource({SERVICE_NAME: settings.APPLICATIONINSIGHTS_ROLENAME}),
+        metric_readers=[PeriodicExportingMetricReader(AzureMonitorMetricExporter.from_connection_string(
+            settings.APPLICATIONINSIGHTS_CONNECTION_STRING
+        ))],
+    ))
 
     FastAPIInstrumentor.instrument_app(app, tracer_provider=tracerProvider)
 
 
-from .routes import router
+from .routes import merge_workers, router, strava_pool, tokens, upload_tracker
 app.include_router(router)
 
+secret_refresh: Optional[asyncio.Task] = None
+
 @app.on_event("startup")
 async def startup_event():
+    global secret_refresh
     client = motor.motor_asyncio.AsyncIOMotorClient(
         settings.AZURE_COSMOS_CONNECTION_STRING
     )
@@ -41,3 +63,36 @@ async def startup_event():
         database=client[settings.AZURE_COSMOS_DATABASE_NAME],
         document_models=__beanie_models__,
     )
+    await tokens.start()
+    await merge_workers.start()
+    await upload_tracker.start()
+    if settings.AZURE_KEY_VAULT_ENDPOINT and settings.AZURE_KEY_VAULT_REFRESH_SECONDS > 0:
+        secret_refresh = asyncio.create_task(refresh_secrets())
+        secret_refresh.add_done_callback(log_stopped_refresh)
+    logger.info("Startup completed in %.2fs", time.perf_counter() - import_started)
+
+async def refresh_secrets():
+    # Secrets are cached on the settings instance and refreshed in the background
+    while True:
+        await asyncio.sleep(settings.AZURE_KEY_VAULT_REFRESH_SECONDS)
+        try:
+            await asyncio.to_thread(settings.load_secrets)
+        except Exception:
+            logger.exception("Key Vault secret refresh failed")
+
+def log_stopped_refresh(task: asyncio.Task):
+    # Failures of a single refresh are logged in the loop; this catches the loop itself dying
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Key Vault secret refresh stopped", exc_info=task.exception())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await merge_workers.stop()
+    await upload_tracker.stop()
+    await tokens.stop()
+    global secret_refresh
+    if secret_refresh is not None:
+        secret_refresh.cancel()
+        await asyncio.gather(secret_refresh, return_exceptions=True)
+        secret_refresh = None
+    strava_pool.shutdown()
@@ -0,0 +1,272 @@
+import asyncio
+import csv
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence
+
+from . import formats, uploads
+from .stream_cache import StreamCache, streams_to_arrays
+from .tcx import merged_sport, sport_name
+from .trackpoints import Trackpoints, merge_tracks, reduce_points, source_priority
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = 'batch_state.jsonl'
+REPORT_FILE = 'batch_report.json'
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+
+class Group(NamedTuple):
+    """One merged activity to produce from ``activity_ids``."""
+    key: str
+    activity_ids: List[int]
+    name: str
+    description: str
+    # Preferred activity ids per channel, see trackpoints.merge_tracks
+    prefer: Optional[Dict[str, List[int]]] = None
+
+
+class ActivityData(NamedTuple):
+    """The parts of an activity a merge needs, in picklable form."""
+    start_date: datetime
+    sport: str
+    streams: Dict
+
+
+def _parse_ids(value) -> List[int]:
+    if isinstance(value, str):
+        value = [part for part in re.split(r'[\s;,]+', value) if part]
+    return [int(activity_id) for activity_id in value]
+
+
+def _group(entry: dict, index: int) -> Group:
+    activity_ids = _parse_ids(entry.get('activity_ids') or [])
+    if len(activity_ids) < 2:
+        raise ValueError(f"Manifest group {index + 1} needs at least 2 activity ids")
+    # Keyed by the activity ids unless named, so reordering the manifest keeps resume state valid
+    key = str(entry.get('id') or '-'.join(str(i) for i in sorted(activity_ids)))
+    prefer = {channel: _parse_ids(ids) for channel, ids in (entry.get('prefer') or {}).items()}
+    try:
+        source_priority(activity_ids, prefer)
+    except ValueError as e:
+        raise ValueError(f"Manifest group {index + 1}: {e}")
+    return Group(key, activity_ids, entry.get('name') or 'Merged Activity',
+                 entry.get('description') or 'Merged from multiple activities', prefer)
+
+
+def load_manifest(path: str) -> List[Group]:
+    """Read merge groups from a JSON or CSV manifest.
+
+    JSON is a list of objects (or ``{"groups": [...]}``) with
+    ``activity_ids`` and optional ``id``, ``name``, ``description`` and
+    ``prefer`` (activity ids per channel). CSV has the same columns except
+    ``prefer``, with ids separated by spaces or semicolons.
+    """
+    with open(path, newline='') as f:
+        if path.lower().endswith('.csv'):
+            entries = list(csv.DictReader(f))
+        else:
+            entries = json.load(f)
+            if isinstance(entries, dict):
+                entries = entries['groups']
+    groups = [_group(entry, index) for index, entry in enumerate(entries)]
+    keys = [group.key for group in groups]
+    duplicates = sorted({key for key in keys if keys.count(key) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate manifest groups: {', '.join(duplicates)}")
+    return groups
+
+
+def load_state(output_dir: str) -> Dict[str, dict]:
+    """Results of groups completed by earlier runs, keyed by group."""
+    done = {}
+    path = os.path.join(output_dir, STATE_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by an interrupted run
+                if result.get('status') == 'done':
+                    done[result['key']] = result
+    return done
+
+
+def _safe_filename(key: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', key)
+
+
+def fetch_activity(client, stream_cache: StreamCache, activity_id: int) -> ActivityData:
+    activity = client.get_activity(activity_id)
+    return ActivityData(activity.start_date, sport_name(activity.type),
+                        streams_to_arrays(stream_cache.fetch(client, activity_id)))
+
+
+def merge_group(activities: Sequence[ActivityData], output_file: str, output_format: str,
+                simplify_interval: Optional[int] = None, simplify_tolerance: Optional[float] = None,
+                priority: Optional[Dict[str, List[int]]] = None, resample: bool = False) -> dict:
+    """Merge and write one group. Runs in a worker process."""
+    started = time.perf_counter()
+    points = merge_tracks((Trackpoints.from_streams(a.streams, a.start_date) for a in activities), priority,
+                          resample)
+    if simplify_interval or simplify_tolerance:
+        points, _ = reduce_points(points, simplify_interval, simplify_tolerance)
+    sport = merged_sport((a.start_date, a.sport) for a in activities)
+    size = formats.write_file(output_file, output_format, points, sport, points.duration(), points.total_distance())
+    return {'points': len(points), 'output_bytes': size, 'merge_seconds': time.perf_counter() - started}
+
+
+def upload_file(session, access_token: str, path: str, name: str, description: str, data_type: str,
+                compression_level: int = 0):
+    filename = os.path.basename(path)
+    with open(path, 'rb') as f:
+        chunks = iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b'')
+        if compression_level:
+            chunks = uploads.GzipStream(chunks, compression_level)
+            data_type += '.gz'
+            filename += '.gz'
+        return uploads.upload_activity(session, access_token, chunks, name, description, data_type, filename)
+
+
+def describe(result: dict) -> str:
+    parts = [f"{result['key']}: {result['status']}"]
+    if 'points' in result:
+        parts.append(f"{result['points']} points, {result['output_bytes'] / 1024:.0f} KB")
+    if result.get('upload_id'):
+        parts.append(f"upload {result['upload_id']}")
+    if result.get('activity_id'):
+        parts.append(f"activity {result['activity_id']}")
+    if result.get('upload_error'):
+        parts.append(result['upload_error'])
+    if result.get('error'):
+        parts.append(result['error'])
+    return ', '.join(parts) + f" in {result.get('seconds', 0):.1f}s"
+
+
+class BatchMerge:
+    """Merge every manifest group and upload the results.
+
+    Groups run concurrently: downloads and uploads share ``concurrency``
+    threads while merging and serialization run in ``processes`` worker
+    processes, so one group's upload overlaps the next group's download.
+    Each finished group is appended to ``batch_state.jsonl`` in
+    ``output_dir``, passed to ``on_result`` and skipped when the batch is run
+    again.
+    """
+
+    def __init__(self, client, session, access_token: str, output_dir: str, output_format: str = 'tcx',
+                 processes: Optional[int] = None, concurrency: int = 4, upload: bool = True,
+                 compression_level: int = 0, stream_cache: Optional[StreamCache] = None,
+                 simplify_interval: Optional[int] = None, simplify_tolerance: Optional[float] = None,
+                 resample: bool = False, wait: Optional[float] = None,
+                 on_result: Optional[Callable[[dict], None]] = None):
+        self.client = client
+        self.session = session
+        self.access_token = access_token
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.processes = processes
+        self.concurrency = concurrency
+        self.upload = upload
+        self.compression_level = compression_level
+        self.stream_cache = stream_cache or StreamCache(max_bytes=0)
+        self.simplify_interval = simplify_interval
+        self.simplify_tolerance = simplify_tolerance
+        self.resample = resample
+        self.wait = wait
+        self.on_result = on_result
+
+    def _record(self, result: dict):
+        line = (json.dumps(result) + '\n').encode()
+        with open(os.path.join(self.output_dir, STATE_FILE), 'ab+') as f:
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # Leave a line cut short by an interrupted run on its own
+                    line = b'\n' + line
+            f.write(line)
+
+    async def _run_group(self, group: Group, threads: ThreadPoolExecutor, processes: ProcessPoolExecutor,
+                         groups_slot: asyncio.Semaphore) -> dict:
+        loop = asyncio.get_running_loop()
+        result = {'key': group.key, 'activity_ids': group.activity_ids, 'name': group.name}
+        started = time.perf_counter()
+        # Bounds how many groups hold downloaded streams in memory at once
+        async with groups_slot:
+            try:
+                activities = await asyncio.gather(*(
+                    loop.run_in_executor(threads, fetch_activity, self.client, self.stream_cache, activity_id)
+                    for activity_id in group.activity_ids
+                ))
+                output_file = os.path.join(self.output_dir, f'{_safe_filename(group.key)}.{self.output_format}')
+                result['output'] = output_file
+                result.update(await loop.run_in_executor(
+                    processes, merge_group, activities, output_file, self.output_format,
+                    self.simplify_interval, self.simplify_tolerance,
+                    source_priority(group.activity_ids, group.prefer or {}), self.resample))
+                del activities
+                if self.upload:
+                    response = await loop.run_in_executor(
+                        threads, upload_file, self.session, self.access_token, output_file, group.name,
+                        group.description, self.output_format, self.compression_level)
+                    if response.status_code != 201:
+                        raise RuntimeError(f"Upload failed: {response.status_code} {response.text}")
+                    result['upload_id'] = response.json().get('id')
+                result['status'] = 'done'
+            except Exception as e:
+                logger.debug("Group %s failed", group.key, exc_info=True)
+                result.update(status='failed', error=str(e))
+        if self.wait and result.get('upload_id'):
+            # Outside the group slot: waiting on Strava holds no streams in memory
+            try:
+                # Not on ``threads``: a group waiting on Strava would hold up other groups' transfers
+                outcome = await loop.run_in_executor(None, uploads.wait_for_upload, self.session,
+                                                     self.access_token, result['upload_id'], self.wait)
+                result.update(upload_state=outcome.state, activity_id=outcome.activity_id,
+                              upload_error=outcome.error)
+            except Exception as e:
+                result.update(upload_state=uploads.PROCESSING, upload_error=str(e))
+        result['seconds'] = time.perf_counter() - started
+        self._record(result)
+        if self.on_result:
+            self.on_result(result)
+        return result
+
+    async def _run(self, groups: List[Group]) -> List[dict]:
+        # Enough groups in flight to keep both the network threads and the processes busy
+        workers = max(self.concurrency, self.processes or os.cpu_count() or 1)
+        groups_slot = asyncio.Semaphore(2 * workers)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='batch') as threads, \
+                ProcessPoolExecutor(max_workers=self.processes) as processes:
+            return await asyncio.gather(*(
+                self._run_group(group, threads, processes, groups_slot) for group in groups
+            ))
+
+    def run(self, groups: List[Group]) -> dict:
+        os.makedirs(self.output_dir, exist_ok=True)
+        done = load_state(self.output_dir)
+        pending = [group for group in groups if group.key not in done]
+        if done:
+            logger.info("Resuming: %d of %d groups already done", len(groups) - len(pending), len(groups))
+        started = time.perf_counter()
+        results = asyncio.run(self._run(pending)) if pending else []
+
+        by_key = {result['key']: result for result in results}
+        report = {
+            'groups': len(groups),
+            'done': sum(result['status'] == 'done' for result in results),
+            'failed': sum(result['status'] == 'failed' for result in results),
+            'skipped': len(groups) - len(pending),
+            'seconds': time.perf_counter() - started,
+            'results': [by_key.get(group.key) or {**done[group.key], 'status': 'skipped'} for group in groups],
+        }
+        with open(os.path.join(self.output_dir, REPORT_FILE), 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+            f.write('\n')
+        return report
@@ -0,0 +1,168 @@
+import struct
+from typing import Iterator
+
+import numpy as np
+
+from .tcx import CHUNK_POINTS, sport_name
+from .trackpoints import Trackpoints
+
+# Seconds between the Unix epoch and the FIT epoch (1989-12-31T00:00:00Z)
+FIT_EPOCH_OFFSET = 631065600
+SEMICIRCLES_PER_DEGREE = 2 ** 31 / 180
+
+PROTOCOL_VERSION = 0x20
+PROFILE_VERSION = 2132
+HEADER_SIZE = 14
+
+# FIT base types
+ENUM, UINT8, UINT16, SINT32, UINT32, UINT32Z = 0x00, 0x02, 0x84, 0x85, 0x86, 0x8C
+
+# Global message numbers
+FILE_ID, SESSION, LAP, RECORD, ACTIVITY = 0, 18, 19, 20, 34
+
+# FIT sport enum for Strava activity types; anything else is "generic"
+SPORTS = {
+    'Run': 1, 'TrailRun': 1, 'VirtualRun': 1,
+    'Ride': 2, 'VirtualRide': 2, 'EBikeRide': 2, 'MountainBikeRide': 2, 'GravelRide': 2,
+    'EMountainBikeRide': 2, 'Handcycle': 2, 'Velomobile': 2,
+    'Swim': 5,
+    'Walk': 11,
+    'NordicSki': 12, 'BackcountrySki': 12,
+    'AlpineSki': 13,
+    'Snowboard': 14,
+    'Rowing': 15, 'VirtualRow': 15,
+    'Hike': 17,
+    'Canoeing': 19, 'Kayaking': 19,
+}
+
+# Record message: (field number, base type, numpy dtype)
+RECORD_FIELDS = [
+    (253, UINT32, '<u4'),  # timestamp
+    (0, SINT32, '<i4'),    # position_lat, semicircles
+    (1, SINT32, '<i4'),    # position_long, semicircles
+    (2, UINT16, '<u2'),    # altitude, (m + 500) * 5
+    (5, UINT32, '<u4'),    # distance, cm
+    (3, UINT8, 'u1'),      # heart_rate, bpm
+    (4, UINT8, 'u1'),      # cadence, rpm
+    (7, UINT16, '<u2'),    # power, watts
+]
+RECORD_DTYPE = np.dtype([('header', 'u1')] + [(f'f{num}', dtype) for num, _, dtype in RECORD_FIELDS])
+INVALID = {UINT8: 0xFF, UINT16: 0xFFFF, SINT32: 0x7FFFFFFF, UINT32: 0xFFFFFFFF, UINT32Z: 0}
+SIZES = {ENUM: 1, UINT8: 1, UINT16: 2, SINT32: 4, UINT32: 4, UINT32Z: 4}
+FORMATS = {ENUM: 'B', UINT8: 'B', UINT16: 'H', SINT32: 'i', UINT32: 'I', UINT32Z: 'I'}
+
+
+def _crc_tables():
+    """CRC-16/ARC as used by FIT, with a second table that consumes two
+    bytes per step so the checksum loop runs half as many iterations.
+    """
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    table16 = []
+    for value in range(1 << 16):
+        crc = (value >> 8) ^ table[value & 0xFF]
+        table16.append((crc >> 8) ^ table[crc & 0xFF])
+    return table, table16
+
+
+_CRC_TABLE, _CRC_TABLE16 = _crc_tables()
+
+
+def crc16(data: bytes, crc: int = 0) -> int:
+    table16 = _CRC_TABLE16
+    even = len(data) & ~1
+    for word in np.frombuffer(data, dtype='<u2', count=even // 2).tolist():
+        crc = table16[crc ^ word]
+    if even != len(data):
+        crc = (crc >> 8) ^ _CRC_TABLE[(crc ^ data[-1]) & 0xFF]
+    return crc
+
+
+def _definition(local_type: int, global_num: int, fields) -> bytes:
+    header = struct.pack('<BBBHB', 0x40 | local_type, 0, 0, global_num, len(fields))
+    return header + b''.join(struct.pack('BBB', num, SIZES[base], base) for num, base, _ in fields)
+
+
+def _message(local_type: int, fields) -> bytes:
+    fmt = '<B' + ''.join(FORMATS[base] for _, base, _ in fields)
+    return struct.pack(fmt, local_type, *(value for _, _, value in fields))
+
+
+def _fit_time(epoch_seconds: int) -> int:
+    return int(epoch_seconds) - FIT_EPOCH_OFFSET
+
+
+def _scaled(values: np.ndarray, scale: float, offset: float, dtype: str, base: int) -> np.ndarray:
+    valid = ~np.isnan(values)
+    info = np.iinfo(dtype)
+    # The top of each unsigned range is FIT's "invalid" marker
+    high = info.max - 1 if info.kind == 'u' else info.max
+    encoded = np.clip(np.round((np.where(valid, values, 0) + offset) * scale), info.min, high)
+    return np.where(valid, encoded, INVALID[base]).astype(dtype)
+
+
+def _records(points: Trackpoints) -> bytes:
+    records = np.zeros(len(points), dtype=RECORD_DTYPE)
+    records['header'] = 1  # local message type of the record definition
+    records['f253'] = points.time - FIT_EPOCH_OFFSET
+    records['f0'] = _scaled(points.lat, SEMICIRCLES_PER_DEGREE, 0, '<i4', SINT32)
+    records['f1'] = _scaled(points.lon, SEMICIRCLES_PER_DEGREE, 0, '<i4', SINT32)
+    records['f2'] = _scaled(points.altitude, 5, 500, '<u2', UINT16)
+    records['f5'] = _scaled(points.distance, 100, 0, '<u4', UINT32)
+    records['f3'] = _scaled(points.heartrate, 1, 0, 'u1', UINT8)
+    records['f4'] = _scaled(points.cadence, 1, 0, 'u1', UINT8)
+    records['f7'] = _scaled(points.watts, 1, 0, '<u2', UINT16)
+    return records.tobytes()
+
+
+def _summary(points: Trackpoints, sport, total_time_seconds, distance_meters) -> bytes:
+    start = _fit_time(points.time[0]) if len(points) else 0
+    end = _fit_time(points.time[-1]) if len(points) else 0
+    sport_num = SPORTS.get(sport_name(sport), 0)
+    elapsed_ms = int(round(float(total_time_seconds) * 1000))
+    distance_cm = int(round(float(distance_meters) * 100))
+
+    # Events: 9 = lap, 8 = session, 26 = activity; event_type 1 = stop
+    lap = [(253, UINT32, end), (2, UINT32, start), (7, UINT32, elapsed_ms), (8, UINT32, elapsed_ms),
+           (9, UINT32, distance_cm), (25, ENUM, sport_num), (0, ENUM, 9), (1, ENUM, 1)]
+    session = [(253, UINT32, end), (2, UINT32, start), (7, UINT32, elapsed_ms), (8, UINT32, elapsed_ms),
+               (9, UINT32, distance_cm), (5, ENUM, sport_num), (6, ENUM, 0), (25, UINT16, 0),
+               (26, UINT16, 1), (0, ENUM, 8), (1, ENUM, 1)]
+    activity = [(253, UINT32, end), (0, UINT32, elapsed_ms), (1, UINT16, 1), (2, ENUM, 0),
+                (3, ENUM, 26), (4, ENUM, 1)]
+    return b''.join(
+        _definition(2, global_num, fields) + _message(2, fields)
+        for global_num, fields in ((LAP, lap), (SESSION, session), (ACTIVITY, activity))
+    )
+
+
+def iter_fit(points: Trackpoints, sport, total_time_seconds, distance_meters,
+             chunk_points: int = CHUNK_POINTS) -> Iterator[bytes]:
+    """Yield a FIT activity file (file_id, records, lap, session, activity)
+    in chunks of at most ``chunk_points`` records, like ``iter_tcx``.
+    """
+    start = _fit_time(points.time[0]) if len(points) else 0
+    file_id = [(0, ENUM, 4), (1, UINT16, 255), (2, UINT16, 0), (3, UINT32Z, 1), (4, UINT32, start)]
+    record_fields = [(num, base, None) for num, base, _ in RECORD_FIELDS]
+    preamble = _definition(0, FILE_ID, file_id) + _message(0, file_id) + _definition(1, RECORD, record_fields)
+    summary = _summary(points, sport, total_time_seconds, distance_meters)
+
+    # The header needs the data size up front; records have a fixed size
+    data_size = len(preamble) + len(points) * RECORD_DTYPE.itemsize + len(summary)
+    header = struct.pack('<BBHI4s', HEADER_SIZE, PROTOCOL_VERSION, PROFILE_VERSION, data_size, b'.FIT')
+    header += struct.pack('<H', crc16(header))
+    yield header
+
+    # The trailing file CRC covers the header as well as the data
+    crc = crc16(preamble, crc16(header))
+    yield preamble
+    for offset in range(0, len(points), chunk_points):
+        chunk = _records(points.take(slice(offset, offset + chunk_points)))
+        crc = crc16(chunk, crc)
+        yield chunk
+    crc = crc16(summary, crc)
+    yield summary + struct.pack('<H', crc)
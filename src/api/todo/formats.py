@@ -0,0 +1,41 @@
+import time
+from typing import BinaryIO, Iterator, Union
+
+from .fit import iter_fit
+from .tcx import iter_tcx
+from .trackpoints import Trackpoints
+
+ENCODERS = {
+    'tcx': iter_tcx,
+    'fit': iter_fit,
+}
+
+
+def encode(output_format: str, points: Trackpoints, sport, total_time_seconds, distance_meters) -> Iterator[bytes]:
+    """Stream the merged activity in ``output_format`` ('tcx' or 'fit')."""
+    return ENCODERS[output_format](points, sport, total_time_seconds, distance_meters)
+
+
+def write_file(target: Union[str, BinaryIO], output_format: str, points: Trackpoints, sport,
+               total_time_seconds, distance_meters) -> int:
+    """Stream the merged activity to a path or binary file object; returns bytes written."""
+    if isinstance(target, str):
+        with open(target, 'wb') as f:
+            return write_file(f, output_format, points, sport, total_time_seconds, distance_meters)
+    written = 0
+    for chunk in encode(output_format, points, sport, total_time_seconds, distance_meters):
+        target.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def compare(points: Trackpoints, sport, total_time_seconds, distance_meters) -> dict:
+    """Encode in every format without keeping the output; returns
+    ``{format: (bytes, seconds)}`` for size/time comparisons.
+    """
+    results = {}
+    for output_format in ENCODERS:
+        started = time.perf_counter()
+        size = sum(len(chunk) for chunk in encode(output_format, points, sport, total_time_seconds, distance_meters))
+        results[output_format] = (size, time.perf_counter() - started)
+    return results
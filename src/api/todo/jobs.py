@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional, Set
+
+from beanie import PydanticObjectId
+from opentelemetry import propagate
+from pymongo import ASCENDING, ReturnDocument
+
+from . import uploads
+from .merge_cache import MergeResultCache
+from .models import MergeJob, MergeStatus, UploadState
+from .ratelimit import BACKGROUND, request_priority
+from .strava import StravaPool
+from .formats import encode
+from .tcx import merged_sport
+from .telemetry import MeteredChunks, payload_size, stage, stage_duration, tracer
+from .trackpoints import Trackpoints, merge_tracks, reduce_points, source_priority
+from .upload_tracker import UploadTracker
+
+logger = logging.getLogger(__name__)
+
+# Stages that can safely be rerun from scratch by another worker pool
+RESUMABLE = [MergeStatus.QUEUED, MergeStatus.FETCHING, MergeStatus.MERGING, MergeStatus.SIMPLIFYING,
+             MergeStatus.SERIALIZING]
+
+
+class MergeError(Exception):
+    pass
+
+
+def merge_budget_error(strava_pool: StravaPool, activity_ids: List[int]) -> Optional[str]:
+    """Why a merge of ``activity_ids`` can never be admitted, or None if it can."""
+    calls = strava_pool.calls_for_merge(activity_ids)
+    capacity = strava_pool.scheduler.capacity(BACKGROUND)
+    if calls <= capacity:
+        return None
+    return (f"Merging {len(activity_ids)} activities needs {calls} Strava calls, "
+            f"more than the {capacity} a rate-limit window allows")
+
+
+def build_track(activities, all_streams, priority=None, resample: bool = False) -> Trackpoints:
+    with stage("build_points") as span:
+        tracks = [
+            Trackpoints.from_streams(streams, act.start_date)
+            for act, streams in zip(activities, all_streams)
+        ]
+        span.set_attribute("merge.points_per_activity", [len(track) for track in tracks])
+    with stage("merge", {"merge.points_in": sum(map(len, tracks)), "merge.resample": resample}) as span:
+        merged = merge_tracks(tracks, priority, resample)
+        span.set_attribute("merge.points", len(merged))
+        return merged
+
+
+async def run_merge(job: MergeJob, strava_pool: StravaPool, compression_level: int = 0,
+                    result_cache: Optional[MergeResultCache] = None):
+    # Continue the trace of the request that submitted the job
+    with tracer.start_as_current_span("merge.job", context=propagate.extract(job.trace_context), attributes={
+        "merge.job_id": str(job.id),
+        "merge.activities": len(job.activity_ids),
+        "merge.output_format": job.output_format,
+    }):
+        await _run_stages(job, strava_pool, compression_level, result_cache)
+
+
+async def _run_stages(job: MergeJob, strava_pool: StravaPool, compression_level: int,
+                      result_cache: Optional[MergeResultCache]):
+    client = await strava_pool.clients.get(job.user_id)
+    if client is None:
+        raise MergeError("Not authenticated")
+
+    await job.set_status(MergeStatus.FETCHING)
+    with stage("fetch", {"merge.activities": len(job.activity_ids)}):
+        activities, all_streams = await strava_pool.fetch_activities(client, job.activity_ids)
+
+    await job.set_status(MergeStatus.MERGING)
+    sport = merged_sport((activity.start_date, activity.type) for activity in activities)
+    all_points = await asyncio.to_thread(build_track, activities, all_streams,
+                                         source_priority(job.activity_ids, job.prefer), job.resample)
+
+    stats = {}
+    if job.simplify_interval or job.simplify_tolerance:
+        await job.set_status(MergeStatus.SIMPLIFYING)
+        with stage("simplify") as span:
+            all_points, reduction = await asyncio.to_thread(reduce_points, all_points, job.simplify_interval,
+                                                            job.simplify_tolerance)
+            span.set_attributes({"merge.points_in": reduction.points_in, "merge.points_out": reduction.points_out})
+        logger.info("Merge job %s simplified %s", job.id, reduction.summary())
+        stats.update(points_in=reduction.points_in, points_out=reduction.points_out,
+                     simplify_seconds=reduction.seconds)
+
+    await job.set_status(MergeStatus.SERIALIZING)
+    # Overlapping recordings would be counted twice by summing the activities
+    encoded = MeteredChunks(encode(job.output_format, all_points, sport, all_points.duration(),
+                                   all_points.total_distance()))
+    chunks = encoded
+    data_type = job.output_format
+    if compression_level:
+        chunks = uploads.GzipStream(encoded, compression_level)
+        data_type += '.gz'
+    retained = None
+    if result_cache is not None and result_cache.max_file_bytes > 0:
+        # Keep a gzipped copy of the output for repeats of this request, up to the size that can be stored
+        retained = uploads.RetainedCopy(chunks, result_cache.max_file_bytes, 0 if compression_level else 6)
+
+    # The file is generated (and compressed) lazily while the upload streams it to Strava
+    await job.set_status(MergeStatus.UPLOADING)
+    started = time.perf_counter()
+    with stage("upload", {"merge.data_type": data_type, "merge.points": len(all_points)}) as span:
+        response = await strava_pool.run(uploads.upload_activity, strava_pool.session, client.access_token,
+                                         retained or chunks, job.name, job.description, data_type=data_type,
+                                         filename=f'merged.{data_type}')
+        upload_bytes = chunks.compressed_bytes if isinstance(chunks, uploads.GzipStream) else encoded.bytes
+        span.set_attributes({
+            "merge.bytes_serialized": encoded.bytes,
+            "merge.bytes_uploaded": upload_bytes,
+            "merge.upload_status": response.status_code,
+        })
+    stats['upload_seconds'] = time.perf_counter() - started
+    stage_duration.record(encoded.seconds, {"stage": "serialize"})
+    payload_size.record(encoded.bytes, {"payload": "serialized", "format": job.output_format})
+    payload_size.record(upload_bytes, {"payload": "upload", "format": data_type})
+    if response.status_code != 201:
+        raise MergeError(f"Upload failed: {response.text}")
+    stats.update(output_bytes=encoded.bytes, upload_bytes=upload_bytes, serialize_seconds=encoded.seconds)
+    if isinstance(chunks, uploads.GzipStream):
+        logger.info("Merge job %s upload compressed %s", job.id, chunks.summary())
+        stats['compression_seconds'] = chunks.seconds
+    # Strava processes the file after accepting it; the upload tracker follows it from here
+    body = response.json()
+    outcome = uploads.upload_outcome(body)
+    await job.set_status(MergeStatus.DONE, upload_id=body.get('id'), upload_state=UploadState(outcome.state),
+                         activity_id=outcome.activity_id, upload_error=outcome.error, **stats)
+    if result_cache is not None and outcome.state != uploads.ERROR:
+        await result_cache.store(job, retained.data if retained else None)
+
+
+class MergeWorkerPool:
+    """A fixed number of in-process workers draining a queue of merge jobs.
+
+    Several replicas may share the jobs collection. A pool claims a job
+    atomically before running it, and holds a lease on it that it renews
+    every ``lease_seconds / 3`` while the job is queued or running here.
+    Only jobs whose lease has expired, because the pool that claimed them
+    has died, are resumed by another pool.
+    """
+
+    def __init__(self, workers: int, strava_pool: StravaPool, compression_level: int = 0,
+                 result_cache: Optional[MergeResultCache] = None, upload_tracker: Optional[UploadTracker] = None,
+                 lease_seconds: float = 120.0):
+        self._workers = workers
+        self._strava_pool = strava_pool
+        self._compression_level = compression_level
+        self._result_cache = result_cache
+        self._upload_tracker = upload_tracker
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # Jobs queued, deferred or running here, whose leases this pool renews
+        self._held: Set[PydanticObjectId] = set()
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        await self._resume()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self._workers)]
+        self._tasks.append(asyncio.create_task(self._maintain()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _lease(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    def _enqueue(self, job_id: PydanticObjectId):
+        self._held.add(job_id)
+        self._queue.put_nowait(job_id)
+
+    async def submit(self, job: MergeJob) -> MergeJob:
+        job.owner = self.owner
+        job.lease_expires_at = self._lease()
+        await job.insert()
+        self._enqueue(job.id)
+        return job
+
+    async def _claim(self, job_id: PydanticObjectId) -> Optional[MergeJob]:
+        """Atomically take the job if it still needs running and no other live pool holds it."""
+        now = datetime.utcnow()
+        document = await MergeJob.get_motor_collection().find_one_and_update(
+            {
+                "_id": job_id,
+                "status": {"$in": [status.value for status in RESUMABLE]},
+                "$or": [{"owner": self.owner}, {"owner": None}, {"lease_expires_at": {"$lt": now}}],
+            },
+            {"$set": {"owner": self.owner, "lease_expires_at": self._lease()}},
+            return_document=ReturnDocument.AFTER,
+        )
+        return MergeJob.parse_obj(document) if document else None
+
+    async def _renew(self):
+        if self._held:
+            await MergeJob.get_motor_collection().update_many(
+                {"_id": {"$in": list(self._held)}, "owner": self.owner},
+                {"$set": {"lease_expires_at": self._lease()}},
+            )
+
+    async def _resume(self):
+        """Take over the jobs of pools that stopped renewing their leases."""
+        expired = {"$or": [{"lease_expires_at": None}, {"lease_expires_at": {"$lt": datetime.utcnow()}}]}
+        collection = MergeJob.get_motor_collection()
+        # A job that died while uploading may already exist on Strava, so it is failed instead
+        async for document in collection.find({"status": MergeStatus.UPLOADING.value, **expired}):
+            failed = await collection.update_one(
+                {"_id": document["_id"], "status": MergeStatus.UPLOADING.value, **expired},
+                {"$set": {"status": MergeStatus.FAILED.value, "error": "Interrupted during upload",
+                          "updated_at": datetime.utcnow()}},
+            )
+            if failed.modified_count:
+                logger.warning("Merge job %s was interrupted during upload", document["_id"])
+        cursor = collection.find({"status": {"$in": [status.value for status in RESUMABLE]}, **expired},
+                                 sort=[("created_at", ASCENDING)])
+        async for document in cursor:
+            if document["_id"] not in self._held:
+                logger.info("Resuming merge job %s", document["_id"])
+                self._enqueue(document["_id"])
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self._renew()
+                await self._resume()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Renewing merge job leases failed")
+
+    async def _work(self):
+        # Interactive requests take precedence over merge jobs for rate-limit budget
+        request_priority.set(BACKGROUND)
+        while True:
+            job_id = await self._queue.get()
+            deferred = False
+            try:
+                deferred = await self._run(job_id)
+            finally:
+                if not deferred:
+                    self._held.discard(job_id)
+                self._queue.task_done()
+
+    async def _run(self, job_id: PydanticObjectId) -> bool:
+        """Run the job unless another pool has it; returns whether it was deferred."""
+        job = await self._claim(job_id)
+        if job is None:
+            return False
+        error = merge_budget_error(self._strava_pool, job.activity_ids)
+        if error:
+            await job.set_status(MergeStatus.FAILED, error=error)
+            return False
+        # Admit the merge only if the whole thing fits in the remaining budget,
+        # otherwise try again once the rate-limit window resets
+        reservation = self._strava_pool.scheduler.admit(self._strava_pool.calls_for_merge(job.activity_ids))
+        if reservation is None:
+            delay = self._strava_pool.scheduler.seconds_until_reset()
+            logger.info("Deferring merge job %s for %.0fs: Strava rate limit budget exhausted", job_id, delay)
+            asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, job_id)
+            return True
+        try:
+            with reservation:
+                await run_merge(job, self._strava_pool, self._compression_level, self._result_cache)
+            if self._upload_tracker is not None and job.upload_state == UploadState.PROCESSING:
+                await self._upload_tracker.track(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Merge job %s failed", job_id)
+            await job.set_status(MergeStatus.FAILED, error=str(e))
+        return False
@@ -0,0 +1,114 @@
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Mapping, Optional, Sequence, Tuple
+
+from beanie.operators import NotIn
+from pymongo.errors import DuplicateKeyError
+
+from .models import MergeJob, MergeResult, MergeStatus
+
+FINISHED = [MergeStatus.DONE, MergeStatus.FAILED]
+SUBMIT_ATTEMPTS = 3
+
+
+def fingerprint(user_id: str, activity_ids: Sequence[int], output_format: str,
+                simplify_interval: Optional[int] = None, simplify_tolerance: Optional[float] = None,
+                prefer: Optional[Mapping[str, Sequence[int]]] = None, resample: bool = False) -> str:
+    """Stable key for a merge request: the same user, set of activities and
+    output options always produce the same fingerprint, whatever the order
+    of the ids.
+    """
+    key = json.dumps([user_id, sorted(activity_ids), output_format, simplify_interval, simplify_tolerance,
+                      prefer or {}, resample], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class MergeResultCache:
+    """Deduplicates merge requests by fingerprint.
+
+    A repeat of a request returns the job still working on it, or the
+    completed job recorded in ``merge_results`` until its TTL expires.
+    Failed jobs are not reused, so retrying after a failure merges again.
+    """
+
+    def __init__(self, ttl_seconds: int, max_file_bytes: int):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.max_file_bytes = max_file_bytes
+        self.in_flight_hits = 0
+        self.stored_hits = 0
+        self.misses = 0
+        self.forced = 0
+
+    async def submit(self, key: str, submit: Callable[[], Awaitable[MergeJob]],
+                     force: bool = False) -> Tuple[MergeJob, bool]:
+        """Return ``(job, reused)``: the job for a repeat of request ``key``,
+        or the one ``submit()`` inserts for it.
+
+        MergeJob's unique index on the fingerprints of unfinished jobs makes
+        this safe across replicas: of concurrent submissions, the losers get
+        a DuplicateKeyError and reuse the winner's job. ``force`` skips
+        completed results, but still joins a merge that is running.
+        """
+        if force:
+            self.forced += 1
+        for attempt in range(SUBMIT_ATTEMPTS):
+            if not force:
+                existing = await self.lookup(key)
+                if existing is not None:
+                    return existing, True
+            try:
+                return await submit(), False
+            except DuplicateKeyError:
+                # The same request was submitted meanwhile, possibly by another
+                # replica; it can also have finished again before the lookup
+                if attempt == SUBMIT_ATTEMPTS - 1:
+                    raise
+                force = False
+
+    async def lookup(self, key: str) -> Optional[MergeJob]:
+        job = await MergeJob.find_one(MergeJob.fingerprint == key, NotIn(MergeJob.status, FINISHED))
+        if job is not None:
+            self.in_flight_hits += 1
+            return job
+        result = await MergeResult.find_one(MergeResult.fingerprint == key)
+        # The TTL monitor only runs about once a minute, so check expiry here too
+        if result is not None and result.expires_at > datetime.utcnow():
+            job = await MergeJob.get(result.job_id)
+            if job is not None:
+                self.stored_hits += 1
+                return job
+        self.misses += 1
+        return None
+
+    async def store(self, job: MergeJob, file: Optional[bytes]):
+        """Record a completed job, replacing any earlier result for its fingerprint."""
+        if not job.fingerprint:
+            return
+        now = datetime.utcnow()
+        result = MergeResult(
+            fingerprint=job.fingerprint,
+            user_id=job.user_id,
+            job_id=job.id,
+            upload_id=job.upload_id,
+            output_format=job.output_format,
+            file=file if file is not None and len(file) <= self.max_file_bytes else None,
+            created_at=now,
+            expires_at=now + self.ttl,
+        )
+        await MergeResult.find_one(MergeResult.fingerprint == job.fingerprint).delete()
+        try:
+            await result.insert()
+        except DuplicateKeyError:
+            pass  # a concurrent forced merge of the same request stored its result first
+
+    def stats(self) -> dict:
+        hits = self.in_flight_hits + self.stored_hits
+        lookups = hits + self.misses
+        return {
+            "in_flight_hits": self.in_flight_hits,
+            "stored_hits": self.stored_hits,
+            "misses": self.misses,
+            "forced": self.forced,
+            "hit_rate": hits / lookups if lookups else None,
+        }
@@ -1,41 +1,107 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import Enum
-from typing import Optional
+from functools import lru_cache
+from typing import Any, Dict, Literal, Optional
 
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 from beanie import Document, PydanticObjectId
-from pydantic import BaseModel, BaseSettings
+from pydantic import BaseModel, BaseSettings, Field, PrivateAttr
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+logger = logging.getLogger(__name__)
 
 def keyvault_name_as_attr(name: str) -> str:
     return name.replace("-", "_").upper()
 
 
 class Settings(BaseSettings):
+    _secret_client: Any = PrivateAttr(default=None)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         # Load secrets from keyvault
         if self.AZURE_KEY_VAULT_ENDPOINT:
-            credential = DefaultAzureCredential()
-            keyvault_client = SecretClient(self.AZURE_KEY_VAULT_ENDPOINT, credential)
-            for secret in keyvault_client.list_properties_of_secrets():
-                setattr(
-                    self,
-                    keyvault_name_as_attr(secret.name),
-                    keyvault_client.get_secret(secret.name).value,
-                )
+            self.load_secrets()
+
+    def load_secrets(self, client: Optional[SecretClient] = None):
+        """Fetch Key Vault secrets concurrently and set them as attributes.
+
+        Only secrets that map to a declared setting are fetched unless
+        AZURE_KEY_VAULT_LOAD_ALL is set. ``client`` defaults to a SecretClient
+        for AZURE_KEY_VAULT_ENDPOINT and is kept for later refreshes.
+        """
+        if client is not None:
+            self._secret_client = client
+        elif self._secret_client is None:
+            self._secret_client = SecretClient(self.AZURE_KEY_VAULT_ENDPOINT, DefaultAzureCredential())
+
+        started = time.perf_counter()
+        names = [
+            secret.name for secret in self._secret_client.list_properties_of_secrets()
+            if self.AZURE_KEY_VAULT_LOAD_ALL or keyvault_name_as_attr(secret.name) in self.__fields__
+        ]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.AZURE_KEY_VAULT_MAX_WORKERS, len(names)))) as executor:
+            values = list(executor.map(lambda name: self._secret_client.get_secret(name).value, names))
+        for name, value in zip(names, values):
+            setattr(self, keyvault_name_as_attr(name), value)
+        logger.info("Loaded %d Key Vault secrets in %.2fs", len(names), time.perf_counter() - started)
 
     AZURE_COSMOS_CONNECTION_STRING: str = ""
     AZURE_COSMOS_DATABASE_NAME: str = "strava_merge"
     AZURE_KEY_VAULT_ENDPOINT: Optional[str] = None
+    AZURE_KEY_VAULT_LOAD_ALL: bool = False
+    AZURE_KEY_VAULT_MAX_WORKERS: int = 8
+    AZURE_KEY_VAULT_REFRESH_SECONDS: int = 3600
     APPLICATIONINSIGHTS_CONNECTION_STRING: Optional[str] = None
     APPLICATIONINSIGHTS_ROLENAME: Optional[str] = "API"
+    STRAVA_CLIENT_ID: Optional[str] = None
+    STRAVA_CLIENT_SECRET: Optional[str] = None
     STRAVA_REDIRECT_URI: Optional[str] = None
+    STRAVA_MAX_CONCURRENCY: int = 8
+    STRAVA_BASE_URL: str = "https://www.strava.com"
+    STRAVA_POOL_SIZE: int = 20
+    STRAVA_TIMEOUT_SECONDS: float = 30.0
+    STRAVA_RETRIES: int = 3
+    STRAVA_RATE_LIMIT_15MIN: int = 200
+    STRAVA_RATE_LIMIT_DAILY: int = 2000
+    STRAVA_BACKGROUND_RESERVE: float = 0.2
+    MERGE_WORKERS: int = 2
+    # A replica that stops renewing its jobs' leases for this long is presumed dead
+    MERGE_JOB_LEASE_SECONDS: int = 120
+    UPLOAD_COMPRESSION_LEVEL: int = 6
+    STREAM_CACHE_DIR: Optional[str] = None
+    STREAM_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    ACTIVITY_SYNC_INTERVAL_SECONDS: int = 300
+    ACTIVITY_SYNC_INITIAL_DAYS: int = 30
+    # Strava lists by start date, so late uploads of older activities need a look back
+    ACTIVITY_SYNC_OVERLAP_DAYS: int = 7
+    ACTIVITY_SYNC_RECONCILE_SECONDS: int = 24 * 3600
+    MERGE_RESULT_TTL_SECONDS: int = 7 * 24 * 3600
+    # Cosmos DB caps documents at 2 MB; larger outputs keep only the upload outcome
+    MERGE_RESULT_MAX_FILE_BYTES: int = 1536 * 1024
+    UPLOAD_POLL_INITIAL_SECONDS: float = 2.0
+    UPLOAD_POLL_MAX_SECONDS: float = 60.0
+    UPLOAD_POLL_TIMEOUT_SECONDS: float = 1800.0
+    PREVIEW_CACHE_MAX_ENTRIES: int = 1024
+    TOKEN_CACHE_TTL_SECONDS: float = 300.0
+    TOKEN_REFRESH_MARGIN_SECONDS: float = 600.0
+    TOKEN_REFRESH_CHECK_SECONDS: float = 60.0
 
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
+        # Lets AZURE_KEY_VAULT_LOAD_ALL set secrets that are not declared above
+        extra = "allow"
+
+
+@lru_cache()
+def get_settings() -> Settings:
+    return Settings()
 
 
 class UserToken(Document):
@@ -47,6 +113,10 @@ class UserToken(Document):
 
     class Settings:
         name = "user_tokens"
+        indexes = [
+            IndexModel([("user_id", ASCENDING)], unique=True),
+            IndexModel([("expires_at", ASCENDING)]),
+        ]
 
 
 class Activity(BaseModel):
@@ -73,10 +143,146 @@ class Activity(BaseModel):
     has_kudoed: bool
 
 
+class StoredActivity(Document):
+    user_id: str
+    start_date: datetime
+    activity: Activity
+
+    class Settings:
+        name = "activities"
+        indexes = [
+            IndexModel([("user_id", ASCENDING), ("start_date", DESCENDING)]),
+            IndexModel([("user_id", ASCENDING), ("activity.id", ASCENDING)], unique=True),
+        ]
+
+
+class ActivitySync(Document):
+    user_id: str
+    synced_at: datetime
+    reconciled_at: Optional[datetime] = None
+
+    class Settings:
+        name = "activity_sync"
+        indexes = [IndexModel([("user_id", ASCENDING)], unique=True)]
+
+
+OutputFormat = Literal["tcx", "fit"]
+# See trackpoints.PRIORITY_CHANNELS
+PriorityChannel = Literal["position", "distance", "altitude", "heartrate", "cadence", "watts"]
+
+
 class MergeRequest(BaseModel):
     activity_ids: list[int]
     name: str = "Merged Activity"
     description: str = "Merged from multiple activities"
+    output_format: OutputFormat = "tcx"
+    # Optional point reduction before serialization; both may be combined
+    simplify_interval: Optional[int] = Field(None, ge=1, description="Keep one point per this many seconds")
+    simplify_tolerance: Optional[float] = Field(None, gt=0, description="Douglas-Peucker tolerance in meters")
+    # Where activities overlap, which ones to take each channel from, most preferred first
+    prefer: Dict[PriorityChannel, list[int]] = Field(default_factory=dict)
+    resample: bool = Field(False, description="Interpolate the merged track onto one point per second")
+
+
+class MergeStatus(str, Enum):
+    QUEUED = "queued"
+    FETCHING = "fetching"
+    MERGING = "merging"
+    SIMPLIFYING = "simplifying"
+    SERIALIZING = "serializing"
+    UPLOADING = "uploading"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class UploadState(str, Enum):
+    """Strava's processing of a completed merge's upload."""
+    PROCESSING = "processing"
+    READY = "ready"
+    ERROR = "error"
+    TIMEOUT = "timeout"
+
+
+class MergeJob(Document):
+    user_id: str
+    activity_ids: list[int]
+    name: str
+    description: str
+    output_format: OutputFormat = "tcx"
+    simplify_interval: Optional[int] = None
+    simplify_tolerance: Optional[float] = None
+    prefer: Dict[str, list[int]] = Field(default_factory=dict)
+    resample: bool = False
+    status: MergeStatus = MergeStatus.QUEUED
+    upload_id: Optional[int] = None
+    upload_state: Optional[UploadState] = None
+    activity_id: Optional[int] = None
+    upload_error: Optional[str] = None
+    error: Optional[str] = None
+    output_bytes: Optional[int] = None
+    upload_bytes: Optional[int] = None
+    compression_seconds: Optional[float] = None
+    points_in: Optional[int] = None
+    points_out: Optional[int] = None
+    simplify_seconds: Optional[float] = None
+    serialize_seconds: Optional[float] = None
+    upload_seconds: Optional[float] = None
+    # W3C trace context of the submitting request, so job spans join its trace
+    trace_context: Dict[str, str] = Field(default_factory=dict)
+    # Identifies repeats of the same request, see merge_cache.fingerprint
+    fingerprint: Optional[str] = None
+    # The worker pool that has claimed the job, until its lease expires
+    owner: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+    class Settings:
+        name = "merge_jobs"
+        indexes = [
+            IndexModel([("fingerprint", ASCENDING), ("status", ASCENDING)]),
+            # At most one unfinished job per request, across replicas (needs MongoDB 6.0+ for $in)
+            IndexModel([("fingerprint", ASCENDING)], name="fingerprint_unfinished", unique=True,
+                       partialFilterExpression={
+                           "fingerprint": {"$type": "string"},
+                           "status": {"$in": [s.value for s in MergeStatus
+                                              if s not in (MergeStatus.DONE, MergeStatus.FAILED)]},
+                       }),
+            IndexModel([("upload_state", ASCENDING)]),
+            IndexModel([("status", ASCENDING), ("lease_expires_at", ASCENDING)]),
+        ]
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (MergeStatus.DONE, MergeStatus.FAILED)
+
+    async def set_status(self, status: MergeStatus, **fields):
+        # Only the given fields are written, so the lease renewed meanwhile
+        # by the worker pool is not overwritten
+        await self.set({"status": status, **fields, "updated_at": datetime.utcnow()})
+
+
+class MergeResult(Document):
+    """Outcome of a completed merge, kept until ``expires_at`` so that
+    repeated requests reuse it. ``file`` is the gzipped output when it fit
+    within MERGE_RESULT_MAX_FILE_BYTES.
+    """
+    fingerprint: str
+    user_id: str
+    job_id: PydanticObjectId
+    upload_id: Optional[int] = None
+    output_format: OutputFormat
+    file: Optional[bytes] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime
+
+    class Settings:
+        name = "merge_results"
+        indexes = [
+            IndexModel([("fingerprint", ASCENDING)], unique=True),
+            IndexModel([("job_id", ASCENDING)]),
+            IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+        ]
 
 
-__beanie_models__ = [UserToken]
+__beanie_models__ = [UserToken, MergeJob, StoredActivity, ActivitySync, MergeResult]
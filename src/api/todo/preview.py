@@ -0,0 +1,116 @@
+import hashlib
+import json
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from .trackpoints import Trackpoints
+
+# Part of every ETag, so bump it when the preview payload changes
+PREVIEW_VERSION = 2
+
+
+def encode_polyline(lat: np.ndarray, lon: np.ndarray, precision: int = 5) -> str:
+    """Google encoded polyline of the given coordinates."""
+    scaled = np.round(np.column_stack([lat, lon]) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    # Zigzag: shift left one bit, inverting negative values
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    out = []
+    for value in values.tolist():
+        while value >= 0x20:
+            out.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        out.append(chr(value + 63))
+    return ''.join(out)
+
+
+def _spaced(count: int, size: int) -> np.ndarray:
+    """Up to ``size`` evenly spaced indices into ``count`` items, including both ends."""
+    if count <= size:
+        return np.arange(count)
+    return np.unique(np.linspace(0, count - 1, size).round().astype(np.int64))
+
+
+def _bucket_means(values: np.ndarray, size: int, decimals: int) -> Optional[List[Optional[float]]]:
+    """Mean of each of ``size`` equal runs of samples; None where a run has no samples."""
+    valid = ~np.isnan(values)
+    if not valid.any():
+        return None
+    starts = np.unique(np.linspace(0, len(values), min(size, len(values)) + 1).astype(np.int64)[:-1])
+    sums = np.add.reduceat(np.where(valid, values, 0.0), starts)
+    counts = np.add.reduceat(valid.astype(np.int64), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.round(sums / counts, decimals)
+    return [None if count == 0 else (float(mean) if decimals else int(mean))
+            for mean, count in zip(means.tolist(), counts.tolist())]
+
+
+def build_preview(points: Trackpoints, size: int) -> dict:
+    """Compact summary of a track for drawing: at most ``size`` positions as
+    an encoded polyline, and elevation and heart rate averaged into ``size``
+    buckets (null when the track has none).
+    """
+    positioned = np.flatnonzero(points.mask('position'))
+    route = positioned[_spaced(len(positioned), size)]
+    preview = {
+        "points": len(points),
+        "start_time": points.start_time(),
+        "duration": points.duration(),
+        "distance": round(points.max_distance(), 1),
+        "polyline": encode_polyline(points.lat[route], points.lon[route]),
+        "bounds": None,
+        "elevation": _bucket_means(points.altitude, size, 1),
+        "heartrate": _bucket_means(points.heartrate, size, 0),
+    }
+    if len(positioned):
+        lat, lon = points.lat[positioned], points.lon[positioned]
+        preview["bounds"] = [round(float(lat.min()), 5), round(float(lon.min()), 5),
+                             round(float(lat.max()), 5), round(float(lon.max()), 5)]
+    return preview
+
+
+def preview_etag(user_id: str, activity_ids: Sequence[int], size: int) -> str:
+    """Recorded streams never change, so the ETag follows from the request alone
+    and a revalidation can be answered without fetching anything.
+    """
+    key = json.dumps([PREVIEW_VERSION, user_id, sorted(activity_ids), size])
+    return '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+
+
+class PreviewCache:
+    """In-memory LRU of encoded preview bodies, keyed by ETag."""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[str, bytes]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, etag: str) -> Optional[bytes]:
+        body = self._entries.get(etag)
+        if body is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(etag)
+        self.hits += 1
+        return body
+
+    def put(self, etag: str, body: bytes):
+        if self.max_entries <= 0:
+            return
+        self._entries[etag] = body
+        self._entries.move_to_end(etag)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": sum(len(body) for body in self._entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
@@ -0,0 +1,240 @@
+import threading
+import time
+from contextvars import ContextVar
+from typing import Mapping, Optional
+
+import requests
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .telemetry import strava_calls, strava_errors, tracer
+
+STRAVA_BASE_URL = "https://www.strava.com"
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+SHORT_WINDOW_SECONDS = 15 * 60
+LONG_WINDOW_SECONDS = 24 * 60 * 60
+
+# Priority and reservation of the Strava calls made in the current context.
+# StravaPool copies the context into its worker threads.
+request_priority: ContextVar[int] = ContextVar("strava_request_priority", default=INTERACTIVE)
+current_reservation: ContextVar[Optional["Reservation"]] = ContextVar("strava_reservation", default=None)
+
+
+def _parse_pair(value: Optional[str]):
+    try:
+        short, long = (int(v) for v in value.split(","))
+    except (AttributeError, ValueError):
+        return None
+    return short, long
+
+
+class RateLimitScheduler:
+    """Process-wide view of Strava's 15-minute and daily request quotas.
+
+    Usage is counted locally as calls are made and corrected from the
+    ``X-RateLimit-Usage``/``X-RateLimit-Limit`` headers of every response.
+    Background calls leave ``background_reserve`` of the 15-minute budget
+    untouched so interactive requests keep working, and multi-call work such
+    as a merge can ``admit`` its whole call count up front instead of
+    failing halfway with a 429.
+    """
+
+    def __init__(self, short_limit: int = 200, long_limit: int = 2000, background_reserve: float = 0.2):
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        self.background_reserve = background_reserve
+        self.short_usage = 0
+        self.long_usage = 0
+        self.reserved = 0
+        self.throttled = 0
+        self._windows = self._current_windows(time.time())
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _current_windows(now: float):
+        # Strava resets at natural quarter hours and at midnight UTC
+        return int(now // SHORT_WINDOW_SECONDS), int(now // LONG_WINDOW_SECONDS)
+
+    def _roll(self):
+        short_window, long_window = self._current_windows(time.time())
+        if short_window != self._windows[0]:
+            self.short_usage = 0
+        if long_window != self._windows[1]:
+            self.long_usage = 0
+        self._windows = (short_window, long_window)
+
+    def _floor(self, priority: int) -> int:
+        return int(self.short_limit * self.background_reserve) if priority == BACKGROUND else 0
+
+    def _available(self) -> int:
+        self._roll()
+        return min(self.short_limit - self.short_usage, self.long_limit - self.long_usage) - self.reserved
+
+    def seconds_until_reset(self) -> float:
+        now = time.time()
+        if self.long_limit - self.long_usage <= 0:
+            return LONG_WINDOW_SECONDS - now % LONG_WINDOW_SECONDS
+        return SHORT_WINDOW_SECONDS - now % SHORT_WINDOW_SECONDS
+
+    def acquire(self, priority: int = INTERACTIVE, reservation: Optional["Reservation"] = None):
+        """Block until one call may be made, then count it."""
+        with self._cond:
+            if reservation is not None and reservation.remaining > 0:
+                reservation.remaining -= 1
+                self.reserved -= 1
+            else:
+                while self._available() <= self._floor(priority):
+                    self.throttled += 1
+                    self._cond.wait(timeout=self.seconds_until_reset())
+            self.short_usage += 1
+            self.long_usage += 1
+
+    def update(self, headers: Mapping[str, str], status_code: int = 200):
+        limits = _parse_pair(headers.get("X-RateLimit-Limit"))
+        usage = _parse_pair(headers.get("X-RateLimit-Usage"))
+        with self._cond:
+            self._roll()
+            if limits:
+                self.short_limit, self.long_limit = limits
+            if usage:
+                self.short_usage, self.long_usage = usage
+            if status_code == 429:
+                self.short_usage = max(self.short_usage, self.short_limit)
+            self._cond.notify_all()
+
+    def capacity(self, priority: int = BACKGROUND) -> int:
+        """The most calls ``admit`` can grant at ``priority``, i.e. in a fresh window."""
+        with self._cond:
+            return min(self.short_limit, self.long_limit) - self._floor(priority)
+
+    def admit(self, calls: int, priority: int = BACKGROUND) -> Optional["Reservation"]:
+        """Reserve budget for ``calls`` requests, or return None if it is not
+        available in the current window. More than ``capacity`` calls are
+        never admitted.
+        """
+        with self._cond:
+            if self._available() - self._floor(priority) < calls:
+                return None
+            self.reserved += calls
+            return Reservation(self, calls)
+
+    def release(self, calls: int):
+        with self._cond:
+            self.reserved -= calls
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            available = self._available()
+            return {
+                "short_limit": self.short_limit,
+                "short_usage": self.short_usage,
+                "long_limit": self.long_limit,
+                "long_usage": self.long_usage,
+                "reserved": self.reserved,
+                "available": available,
+                "throttled": self.throttled,
+                "seconds_until_reset": round(self.seconds_until_reset()),
+            }
+
+
+class Reservation:
+    """Budget admitted for a unit of work; unused calls are released on exit."""
+
+    def __init__(self, scheduler: RateLimitScheduler, calls: int):
+        self.scheduler = scheduler
+        self.remaining = calls
+        self._token = None
+
+    def __enter__(self) -> "Reservation":
+        self._token = current_reservation.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        current_reservation.reset(self._token)
+        with self.scheduler._cond:
+            unused, self.remaining = self.remaining, 0
+        self.scheduler.release(unused)
+
+
+class StravaSession(requests.Session):
+    """Process-wide keep-alive ``requests.Session`` for Strava.
+
+    Every call goes through a RateLimitScheduler. Connections are pooled per
+    host (``pool_size`` each), idempotent requests are retried with backoff
+    on connection errors and 502/503/504, and ``timeout`` applies unless a
+    call sets its own. ``base_url`` replaces https://www.strava.com, e.g. to
+    point at a local fake Strava server.
+    """
+
+    def __init__(self, scheduler: RateLimitScheduler, base_url: str = STRAVA_BASE_URL,
+                 pool_size: int = 20, timeout: float = 30.0, retries: int = 3):
+        super().__init__()
+        self.scheduler = scheduler
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waited = 0
+        self._stats_lock = threading.Lock()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                      allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry,
+                              pool_block=True)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        if self.base_url != STRAVA_BASE_URL and url.startswith(STRAVA_BASE_URL):
+            url = self.base_url + url[len(STRAVA_BASE_URL):]
+        kwargs.setdefault("timeout", self.timeout)
+        with tracer.start_as_current_span(f"HTTP {method.upper()}", kind=SpanKind.CLIENT,
+                                          attributes={"http.method": method.upper(), "http.url": url}) as span:
+            self.scheduler.acquire(request_priority.get(), current_reservation.get())
+            with self._stats_lock:
+                # pool_block makes requests beyond pool_size wait for a free connection
+                if self.in_flight >= self.pool_size:
+                    self.waited += 1
+                self.in_flight += 1
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.RequestException as e:
+                strava_calls.add(1, {"http.method": method.upper()})
+                strava_errors.add(1, {"http.method": method.upper(), "error.type": type(e).__name__})
+                raise
+            finally:
+                with self._stats_lock:
+                    self.in_flight -= 1
+            labels = {"http.method": method.upper(), "http.status_code": response.status_code}
+            span.set_attribute("http.status_code", response.status_code)
+            strava_calls.add(1, labels)
+            if response.status_code >= 400:
+                span.set_status(Status(StatusCode.ERROR))
+                strava_errors.add(1, labels)
+        self.scheduler.update(response.headers, response.status_code)
+        return response
+
+    def pool_stats(self) -> dict:
+        opened = requests_made = idle = 0
+        for adapter in {id(a): a for a in self.adapters.values()}.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                opened += pool.num_connections
+                requests_made += pool.num_requests
+                idle += sum(conn is not None for conn in list(pool.pool.queue))
+        return {
+            "pool_size": self.pool_size,
+            "connections_opened": opened,
+            "connections_idle": idle,
+            "requests": requests_made,
+            "reused": requests_made - opened,
+            "in_flight": self.in_flight,
+            "waited": self.waited,
+        }
@@ -1,23 +1,53 @@
-from datetime import datetime, timedelta
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
 from typing import List, Optional
 
-from fastapi import APIRouter, HTTPException, Depends
+from beanie import PydanticObjectId
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Response
+from opentelemetry import propagate
 from starlette.requests import Request
-import requests
 from stravalib import Client
-import xml.etree.ElementTree as ET
 
-from .models import Activity, MergeRequest, UserToken, Settings
+from .activity_sync import list_activities, sync_activities
+from .jobs import MergeWorkerPool, merge_budget_error
+from .merge_cache import MergeResultCache, fingerprint
+from .models import (Activity, MergeJob, MergeRequest, MergeResult, MergeStatus, StoredActivity, UploadState,
+                     get_settings)
+from .preview import PreviewCache, build_preview, preview_etag
+from .ratelimit import RateLimitScheduler, StravaSession
+from .strava import StravaPool
+from .stream_cache import StreamCache
+from .tokens import TOKEN_URL, TokenStore
+from .trackpoints import Reduction, Trackpoints, merge_tracks, source_priority
+from .upload_tracker import UploadTracker
 
-settings = Settings()
+settings = get_settings()
+stream_cache = StreamCache(settings.STREAM_CACHE_DIR, settings.STREAM_CACHE_MAX_BYTES)
+strava_session = StravaSession(
+    RateLimitScheduler(settings.STRAVA_RATE_LIMIT_15MIN, settings.STRAVA_RATE_LIMIT_DAILY,
+                       settings.STRAVA_BACKGROUND_RESERVE),
+    settings.STRAVA_BASE_URL,
+    pool_size=settings.STRAVA_POOL_SIZE,
+    timeout=settings.STRAVA_TIMEOUT_SECONDS,
+    retries=settings.STRAVA_RETRIES,
+)
+tokens = TokenStore(strava_session, settings, settings.TOKEN_CACHE_TTL_SECONDS,
+                    settings.TOKEN_REFRESH_MARGIN_SECONDS, settings.TOKEN_REFRESH_CHECK_SECONDS)
+strava_pool = StravaPool(settings.STRAVA_MAX_CONCURRENCY, stream_cache, strava_session, tokens)
+preview_cache = PreviewCache(settings.PREVIEW_CACHE_MAX_ENTRIES)
+merge_results = MergeResultCache(settings.MERGE_RESULT_TTL_SECONDS, settings.MERGE_RESULT_MAX_FILE_BYTES)
+upload_tracker = UploadTracker(strava_pool, settings.UPLOAD_POLL_INITIAL_SECONDS, settings.UPLOAD_POLL_MAX_SECONDS,
+                               settings.UPLOAD_POLL_TIMEOUT_SECONDS, settings.MERGE_JOB_LEASE_SECONDS)
+merge_workers = MergeWorkerPool(settings.MERGE_WORKERS, strava_pool, settings.UPLOAD_COMPRESSION_LEVEL,
+                                merge_results, upload_tracker, settings.MERGE_JOB_LEASE_SECONDS)
 
 router = APIRouter(prefix="/api")
 
 async def get_strava_client(user_id: str = "user1"):  # For simplicity, fixed user
-    token = await UserToken.find_one(UserToken.user_id == user_id)
-    if not token:
+    client = await strava_pool.clients.get(user_id)
+    if not client:
         raise HTTPException(status_code=401, detail="Not authenticated")
-    client = Client(access_token=token.access_token, refresh_token=token.refresh_token, token_expires=token.expires_at)
     return client
 
 @router.get("/auth/url")
@@ -32,173 +62,216 @@ async def get_auth_url():
 async def auth_callback_get(code: str):
     client_id = settings.STRAVA_CLIENT_ID
     client_secret = settings.STRAVA_CLIENT_SECRET
-    token_response = requests.post("https://www.strava.com/oauth/token", data={
+    response = await strava_pool.run(strava_session.post, TOKEN_URL, data={
         'client_id': client_id,
         'client_secret': client_secret,
         'code': code,
         'grant_type': 'authorization_code'
-    }).json()
+    })
+    token_response = response.json()
     access_token = token_response['access_token']
     refresh_token = token_response['refresh_token']
     expires_at = token_response['expires_at']
     user_id = "user1"
-    existing = await UserToken.find_one(UserToken.user_id == user_id)
-    if existing:
-        existing.access_token = access_token
-        existing.refresh_token = refresh_token
-        existing.expires_at = expires_at
-        await existing.save()
-    else:
-        token_doc = UserToken(user_id=user_id, access_token=access_token, refresh_token=refresh_token, expires_at=expires_at)
-        await token_doc.insert()
+    await tokens.save(user_id, access_token, refresh_token, expires_at)
     return {"status": "authenticated"}
 
 @router.get("/auth/status")
 async def auth_status():
     user_id = "user1"
-    token = await UserToken.find_one(UserToken.user_id == user_id)
+    token = await tokens.get(user_id)
     if token:
         return {"authenticated": True}
     return {"authenticated": False}
 
-@router.get("/activities", response_model=List[Activity])
-async def get_activities(client: Client = Depends(get_strava_client)):
-    activities = client.get_activities(after=datetime.now() - timedelta(days=30))  # Last 30 days
-    return [Activity(
-        id=a.id,
-        name=a.name,
-        start_date=a.start_date.isoformat(),
-        type=a.type,
-        distance=float(a.distance),
-        moving_time=a.moving_time,
-        elapsed_time=a.elapsed_time,
-        total_elevation_gain=float(a.total_elevation_gain),
-        workout_type=a.workout_type,
-        average_speed=float(a.average_speed),
-        max_speed=float(a.max_speed),
-        has_heartrate=a.has_heartrate,
-        average_heartrate=a.average_heartrate,
-        max_heartrate=a.max_heartrate,
-        heartrate_opt_out=a.heartrate_opt_out,
-        display_hide_heartrate_option=a.display_hide_heartrate_option,
-        elev_high=a.elev_high,
-        elev_low=a.elev_low,
-        pr_count=a.pr_count,
-        total_photo_count=a.total_photo_count,
-        has_kudoed=a.has_kudoed
-    ) for a in activities[:50]]  # Limit to 50
-
-@router.post("/merge")
-async def merge_activities(request: MergeRequest, client: Client = Depends(get_strava_client)):
+@router.get("/activities")
+async def get_activities(
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[datetime] = None,
+    fields: Optional[str] = None,
+    refresh: bool = False,
+    user_id: str = "user1",
+    client: Client = Depends(get_strava_client),
+):
+    field_names = [f for f in fields.split(",") if f] if fields else None
+    unknown = set(field_names or ()) - set(Activity.__fields__)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    await sync_activities(
+        user_id, client, strava_pool,
+        min_interval=timedelta(seconds=settings.ACTIVITY_SYNC_INTERVAL_SECONDS),
+        initial_window=timedelta(days=settings.ACTIVITY_SYNC_INITIAL_DAYS),
+        overlap=timedelta(days=settings.ACTIVITY_SYNC_OVERLAP_DAYS),
+        reconcile_interval=timedelta(seconds=settings.ACTIVITY_SYNC_RECONCILE_SECONDS),
+        force=refresh,
+    )
+    return await list_activities(user_id, limit, before, field_names)
+
+async def load_tracks(user_id: str, client: Client, activity_ids: List[int]) -> List[Trackpoints]:
+    # Start times come from the synced activity list, falling back to Strava for unsynced activities
+    start_dates = {
+        doc.activity.id: doc.start_date.replace(tzinfo=timezone.utc)
+        async for doc in StoredActivity.find({"user_id": user_id, "activity.id": {"$in": activity_ids}})
+    }
+    missing = [i for i in activity_ids if i not in start_dates]
+    details = await asyncio.gather(*(strava_pool.run(client.get_activity, i) for i in missing))
+    start_dates.update((i, activity.start_date) for i, activity in zip(missing, details))
+    streams = await asyncio.gather(*(strava_pool.run(stream_cache.fetch, client, i) for i in activity_ids))
+    return [Trackpoints.from_streams(s, start_dates[i]) for i, s in zip(activity_ids, streams)]
+
+async def preview_response(user_id: str, client: Client, activity_ids: List[int], points: int,
+                           if_none_match: Optional[str]) -> Response:
+    etag = preview_etag(user_id, activity_ids, points)
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=86400"}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    body = preview_cache.get(etag)
+    if body is None:
+        tracks = await load_tracks(user_id, client, activity_ids)
+        if len(tracks) == 1:
+            preview = await asyncio.to_thread(build_preview, tracks[0], points)
+        else:
+            preview = await asyncio.to_thread(lambda: build_preview(merge_tracks(tracks), points))
+            preview["activities"] = [
+                {"id": i, "start_time": track.start_time(), "points": len(track)}
+                for i, track in zip(activity_ids, tracks)
+            ]
+        body = json.dumps(preview, separators=(",", ":")).encode()
+        preview_cache.put(etag, body)
+    return Response(body, media_type="application/json", headers=headers)
+
+@router.get("/activities/{activity_id}/preview")
+async def get_activity_preview(
+    activity_id: int,
+    points: int = Query(200, ge=2, le=2000),
+    user_id: str = "user1",
+    if_none_match: Optional[str] = Header(None),
+    client: Client = Depends(get_strava_client),
+):
+    """Downsampled route (encoded polyline) and elevation/heart rate summaries of one activity."""
+    return await preview_response(user_id, client, [activity_id], points, if_none_match)
+
+@router.get("/merge/preview")
+async def get_merge_preview(
+    activity_ids: List[int] = Query(...),
+    points: int = Query(200, ge=2, le=2000),
+    user_id: str = "user1",
+    if_none_match: Optional[str] = Header(None),
+    client: Client = Depends(get_strava_client),
+):
+    """Preview of merging ``activity_ids``, without merging or uploading anything."""
+    activity_ids = sorted(set(activity_ids))
+    if len(activity_ids) < 2:
+        raise HTTPException(status_code=400, detail="At least 2 activities required")
+    return await preview_response(user_id, client, activity_ids, points, if_none_match)
+
+@router.post("/merge", status_code=202)
+async def merge_activities(request: MergeRequest, force: bool = False, user_id: str = "user1"):
     if len(request.activity_ids) < 2:
         raise HTTPException(status_code=400, detail="At least 2 activities required")
-    
-    # Get all activities
-    activities = []
-    all_streams = []
-    for activity_id in request.activity_ids:
-        act = client.get_activity(activity_id)
-        activities.append(act)
-        streams = client.get_activity_streams(activity_id, types=['time', 'latlng', 'distance', 'altitude', 'heartrate', 'cadence', 'watts'])
-        all_streams.append(streams)
-    
-    sport = activities[0].type  # Use sport from first activity
-    
-    def create_points(streams, start_time):
-        points = []
-        times = streams.get('time', {}).data if 'time' in streams else []
-        latlngs = streams.get('latlng', {}).data if 'latlng' in streams else []
-        distances = streams.get('distance', {}).data if 'distance' in streams else []
-        altitudes = streams.get('altitude', {}).data if 'altitude' in streams else []
-        heartrates = streams.get('heartrate', {}).data if 'heartrate' in streams else []
-        cadences = streams.get('cadence', {}).data if 'cadence' in streams else []
-        wattss = streams.get('watts', {}).data if 'watts' in streams else []
-        
-        for i in range(len(times)):
-            point = {
-                'time': start_time + timedelta(seconds=times[i]),
-                'lat': latlngs[i][0] if i < len(latlngs) else None,
-                'lon': latlngs[i][1] if i < len(latlngs) else None,
-                'distance': distances[i] if i < len(distances) else None,
-                'altitude': altitudes[i] if i < len(altitudes) else None,
-                'heartrate': heartrates[i] if i < len(heartrates) else None,
-                'cadence': cadences[i] if i < len(cadences) else None,
-                'watts': wattss[i] if i < len(wattss) else None,
-            }
-            points.append(point)
-        return points
-    
-    all_points = []
-    cumulative_distance = 0
-    for i, (act, streams) in enumerate(zip(activities, all_streams)):
-        points = create_points(streams, act.start_date)
-        if points:
-            # Adjust distances for subsequent activities
-            if i > 0:
-                for p in points:
-                    if p['distance'] is not None:
-                        p['distance'] += cumulative_distance
-            max_dist = max((p['distance'] for p in points if p['distance'] is not None), default=0)
-            cumulative_distance += max_dist
-        all_points.extend(points)
-    
-    all_points.sort(key=lambda p: p['time'])
-    
-    # Create TCX
-    root = ET.Element("TrainingCenterDatabase", xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2")
-    activities_elem = ET.SubElement(root, "Activities")
-    activity_elem = ET.SubElement(activities_elem, "Activity", Sport=sport)
-    id_elem = ET.SubElement(activity_elem, "Id")
-    id_elem.text = datetime.now().isoformat()
-    
-    total_time = sum(act.elapsed_time for act in activities)
-    total_distance = sum(float(act.distance) for act in activities)
-    
-    lap = ET.SubElement(activity_elem, "Lap", StartTime=all_points[0]['time'].isoformat() if all_points else datetime.now().isoformat())
-    total_time_elem = ET.SubElement(lap, "TotalTimeSeconds")
-    total_time_elem.text = str(total_time)
-    distance_elem = ET.SubElement(lap, "DistanceMeters")
-    distance_elem.text = str(total_distance)
-    
-    track = ET.SubElement(lap, "Track")
-    for point in all_points:
-        tp = ET.SubElement(track, "Trackpoint")
-        time_elem = ET.SubElement(tp, "Time")
-        time_elem.text = point['time'].isoformat()
-        if point['lat'] is not None and point['lon'] is not None:
-            position = ET.SubElement(tp, "Position")
-            lat = ET.SubElement(position, "LatitudeDegrees")
-            lat.text = str(point['lat'])
-            lon = ET.SubElement(position, "LongitudeDegrees")
-            lon.text = str(point['lon'])
-        if point['altitude'] is not None:
-            alt = ET.SubElement(tp, "AltitudeMeters")
-            alt.text = str(point['altitude'])
-        if point['distance'] is not None:
-            dist = ET.SubElement(tp, "DistanceMeters")
-            dist.text = str(point['distance'])
-        if point['heartrate'] is not None:
-            hrbpm = ET.SubElement(tp, "HeartRateBpm")
-            value = ET.SubElement(hrbpm, "Value")
-            value.text = str(point['heartrate'])
-    
-    tree = ET.ElementTree(root)
-    tcx_content = ET.tostring(root, encoding='unicode', xml_declaration=True)
-    
-    # Upload to Strava
-    upload_url = "https://www.strava.com/api/v3/uploads"
-    headers = {'Authorization': f'Bearer {client.access_token}'}
-    data = {
-        'name': request.name,
-        'description': request.description,
-        'trainer': 'false',
-        'commute': 'false',
-        'data_type': 'tcx'
+    try:
+        source_priority(request.activity_ids, request.prefer)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    error = merge_budget_error(strava_pool, request.activity_ids)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    await get_strava_client(user_id)
+
+    # Repeats of a request return the job already running or done for it,
+    # unless force asks for a fresh merge and upload
+    key = fingerprint(user_id, request.activity_ids, request.output_format,
+                      request.simplify_interval, request.simplify_tolerance, request.prefer, request.resample)
+    trace_context = {}
+    propagate.inject(trace_context)
+    job, reused = await merge_results.submit(key, lambda: merge_workers.submit(MergeJob(
+        user_id=user_id,
+        activity_ids=request.activity_ids,
+        name=request.name,
+        description=request.description,
+        output_format=request.output_format,
+        simplify_interval=request.simplify_interval,
+        simplify_tolerance=request.simplify_tolerance,
+        prefer=request.prefer,
+        resample=request.resample,
+        trace_context=trace_context,
+        fingerprint=key,
+    )), force)
+    return {**merge_job_status(job), "reused": reused}
+
+@router.get("/merge/{job_id}")
+async def get_merge_job(job_id: PydanticObjectId, user_id: str = "user1"):
+    job = await MergeJob.get(job_id)
+    if not job or job.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Merge job not found")
+    return merge_job_status(job)
+
+@router.get("/merge/{job_id}/upload")
+async def get_merge_upload(job_id: PydanticObjectId, wait: float = Query(0, ge=0, le=60), user_id: str = "user1"):
+    """Strava's processing of the merged upload. With ``wait``, holds the
+    request up to that many seconds for processing to finish.
+    """
+    job = await MergeJob.get(job_id)
+    if not job or job.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Merge job not found")
+    if job.upload_id is None:
+        raise HTTPException(status_code=409, detail="Merge job has not been uploaded")
+    if wait and job.upload_state == UploadState.PROCESSING:
+        await upload_tracker.wait(job_id, wait)
+        job = await MergeJob.get(job_id)
+    return {
+        "upload_id": job.upload_id,
+        "state": job.upload_state,
+        "activity_id": job.activity_id,
+        "error": job.upload_error,
+    }
+
+@router.get("/merge/{job_id}/file")
+async def get_merge_file(job_id: PydanticObjectId, user_id: str = "user1"):
+    result = await MergeResult.find_one(MergeResult.job_id == job_id)
+    if not result or result.user_id != user_id or result.file is None:
+        raise HTTPException(status_code=404, detail="Merged file not available")
+    return Response(result.file, media_type="application/gzip", headers={
+        "Content-Disposition": f'attachment; filename="merged.{result.output_format}.gz"',
+    })
+
+def merge_job_status(job: MergeJob) -> dict:
+    status = {
+        "job_id": str(job.id),
+        "status": job.status,
+        "upload_id": job.upload_id,
+        "upload_state": job.upload_state,
+        "activity_id": job.activity_id,
+        "upload_error": job.upload_error,
+        "error": job.error,
+        "output_bytes": job.output_bytes,
+        "upload_bytes": job.upload_bytes,
+        "serialize_seconds": job.serialize_seconds,
+        "compression_seconds": job.compression_seconds,
+        "upload_seconds": job.upload_seconds,
+    }
+    if job.points_in is not None:
+        reduction = Reduction(job.points_in, job.points_out, job.simplify_seconds)
+        status["simplify"] = {
+            **reduction._asdict(),
+            "ratio": reduction.ratio,
+            "estimated_seconds_saved": reduction.estimated_seconds_saved(job.serialize_seconds or 0.0),
+        }
+    if job.status == MergeStatus.DONE and job.upload_state == UploadState.ERROR:
+        status["message"] = f"Activity merged but Strava could not process the upload: {job.upload_error}"
+    elif job.status == MergeStatus.DONE:
+        status["message"] = f"Activity merged and uploaded successfully! Upload ID: {job.upload_id}"
+    return status
+
+@router.get("/metrics")
+async def get_metrics():
+    return {
+        "stream_cache": stream_cache.stats(),
+        "strava_rate_limit": strava_session.scheduler.stats(),
+        "strava_http_pool": {**strava_session.pool_stats(), "clients": len(strava_pool.clients)},
+        "merge_results": merge_results.stats(),
+        "tokens": tokens.stats(),
+        "preview_cache": preview_cache.stats(),
+        "upload_tracker": upload_tracker.stats(),
     }
-    files = {'file': ('merged.tcx', tcx_content)}
-    response = requests.post(upload_url, headers=headers, data=data, files=files)
-    if response.status_code == 201:
-        upload_id = response.json().get('id')
-        return {"message": f"Activity merged and uploaded successfully! Upload ID: {upload_id}"}
-    else:
-        raise HTTPException(status_code=400, detail=f"Upload failed: {response.text}")
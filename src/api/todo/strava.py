@@ -0,0 +1,92 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Sequence, Tuple, TypeVar
+
+from stravalib import Client
+
+from .ratelimit import StravaSession
+from .stream_cache import StreamCache
+from .tokens import TokenStore
+
+T = TypeVar('T')
+
+
+class StravaClients:
+    """One reusable ``Client`` per user, all sharing the pooled session.
+
+    A user's client is rebuilt only when their access token changes.
+    """
+
+    def __init__(self, session: StravaSession, tokens: TokenStore):
+        self._session = session
+        self._tokens = tokens
+        self._clients: Dict[str, Client] = {}
+
+    async def get(self, user_id: str) -> Optional[Client]:
+        token = await self._tokens.get(user_id)
+        if not token:
+            self._clients.pop(user_id, None)
+            return None
+        client = self._clients.get(user_id)
+        if client is None or client.access_token != token.access_token:
+            # Rate limiting is done by the session's scheduler, not per client.
+            # Without a refresh token stravalib never refreshes (and loses the
+            # new token) mid-request; the TokenStore refreshes and saves it.
+            client = Client(access_token=token.access_token, requests_session=self._session,
+                            rate_limit_requests=False)
+            self._clients[user_id] = client
+        return client
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+
+class StravaPool:
+    """Bounded thread pool for blocking stravalib/requests calls.
+
+    Running them here keeps the event loop free while they wait on the
+    network, and ``max_workers`` caps how many Strava requests this process
+    has in flight at once. Every call shares ``session``, whose scheduler
+    keeps the process within Strava's rate limits.
+    """
+
+    def __init__(self, max_workers: int, stream_cache: StreamCache, session: StravaSession,
+                 tokens: Optional[TokenStore] = None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="strava")
+        self.stream_cache = stream_cache
+        self.session = session
+        self.tokens = tokens or TokenStore(session)
+        self.clients = StravaClients(session, self.tokens)
+
+    @property
+    def scheduler(self):
+        return self.session.scheduler
+
+    async def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        loop = asyncio.get_running_loop()
+        # Carry the request priority and any rate-limit reservation into the thread
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, functools.partial(context.run, fn, *args, **kwargs))
+
+    def calls_for_merge(self, activity_ids: Sequence[int]) -> int:
+        """Strava calls a merge of ``activity_ids`` needs, including the upload."""
+        uncached = sum(not self.stream_cache.contains(activity_id) for activity_id in activity_ids)
+        return len(activity_ids) + uncached + 1
+
+    async def fetch_activities(self, client: Client, activity_ids: Sequence[int]) -> Tuple[list, list]:
+        """Fetch details and streams for every activity concurrently.
+
+        Returns ``(activities, streams)`` in the order of ``activity_ids``.
+        """
+        details = [self.run(client.get_activity, activity_id) for activity_id in activity_ids]
+        streams = [
+            self.run(self.stream_cache.fetch, client, activity_id)
+            for activity_id in activity_ids
+        ]
+        results = await asyncio.gather(*details, *streams)
+        return list(results[:len(activity_ids)]), list(results[len(activity_ids):])
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
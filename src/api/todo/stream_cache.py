@@ -0,0 +1,130 @@
+import logging
+import os
+import tempfile
+import threading
+from typing import Dict, Mapping, Optional
+
+import numpy as np
+
+from .trackpoints import STREAM_TYPES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def default_cache_dir() -> str:
+    base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'strava-merge', 'streams')
+
+
+def streams_to_arrays(streams: Mapping) -> Dict[str, np.ndarray]:
+    arrays = {}
+    for key, stream in streams.items():
+        data = getattr(stream, 'data', stream)
+        if data is None:
+            continue
+        if key == 'time':
+            arrays[key] = np.asarray(data, dtype=np.int64)
+        elif key == 'latlng':
+            arrays[key] = np.asarray(data, dtype=np.float64).reshape(-1, 2)
+        else:
+            arrays[key] = np.asarray(data, dtype=np.float64)
+    return arrays
+
+
+class StreamCache:
+    """On-disk cache of activity streams, one compressed ``.npz`` per activity.
+
+    Recorded streams never change, so entries never expire; the least
+    recently used files are evicted once the directory exceeds ``max_bytes``.
+    Recency is the file mtime, which lets the CLI and API processes share
+    one directory. A ``max_bytes`` of 0 disables the cache.
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _path(self, activity_id: int) -> str:
+        return os.path.join(self.directory, f'{int(activity_id)}.npz')
+
+    def contains(self, activity_id: int) -> bool:
+        return self.enabled and os.path.exists(self._path(activity_id))
+
+    def get(self, activity_id: int) -> Optional[Dict[str, np.ndarray]]:
+        path = self._path(activity_id)
+        try:
+            with np.load(path) as npz:
+                arrays = {key: npz[key] for key in npz.files}
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return arrays
+
+    def put(self, activity_id: int, arrays: Dict[str, np.ndarray]):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp_path, self._path(activity_id))
+        except OSError:
+            logger.warning("Could not cache streams for activity %s", activity_id, exc_info=True)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def fetch(self, client, activity_id: int) -> Mapping:
+        """Streams for ``activity_id``, downloading them only on a cache miss."""
+        if not self.enabled:
+            return client.get_activity_streams(activity_id, types=STREAM_TYPES)
+        arrays = self.get(activity_id)
+        if arrays is None:
+            arrays = streams_to_arrays(client.get_activity_streams(activity_id, types=STREAM_TYPES))
+            self.put(activity_id, arrays)
+        return arrays
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, Tuple
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+
+from .trackpoints import Trackpoints
+
+TCX_NAMESPACE = "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"
+CHUNK_POINTS = 2000
+
+
+def sport_name(sport) -> str:
+    # stravalib >= 1.0 wraps the activity type in a pydantic root model
+    # (``__root__`` under pydantic 1, ``root`` under pydantic 2)
+    return str(getattr(sport, 'root', getattr(sport, '__root__', sport)))
+
+
+def merged_sport(starts_and_sports: Iterable[Tuple[datetime, object]]) -> str:
+    """Sport of a merge: that of the activity that started first, so that it
+    does not depend on the order of the activity ids.
+    """
+    return min((start, sport_name(sport)) for start, sport in starts_and_sports)[1]
+
+
+def elapsed_seconds(duration) -> int:
+    """Whole seconds of a stravalib duration such as ``elapsed_time``: a
+    ``timedelta`` under stravalib 1.x, an int-like ``Duration`` under 2.x.
+    """
+    if isinstance(duration, timedelta):
+        return int(duration.total_seconds())
+    return int(duration)
+
+
+def format_times(epoch_seconds: np.ndarray) -> list:
+    """ISO 8601 UTC timestamps (``2024-01-01T10:00:00Z``) for int64 epoch seconds."""
+    return np.datetime_as_string(epoch_seconds.astype('datetime64[s]'), unit='s', timezone='UTC').tolist()
+
+
+def _trackpoints(points: Trackpoints) -> str:
+    times = format_times(points.time)
+    positions = [
+        f"<Position><LatitudeDegrees>{lat}</LatitudeDegrees><LongitudeDegrees>{lon}</LongitudeDegrees></Position>"
+        if lat == lat and lon == lon else ""
+        for lat, lon in zip(points.lat.tolist(), points.lon.tolist())
+    ]
+    # NaN is the only value not equal to itself, i.e. a missing sample
+    altitudes = [
+        f"<AltitudeMeters>{v}</AltitudeMeters>" if v == v else ""
+        for v in points.altitude.tolist()
+    ]
+    distances = [
+        f"<DistanceMeters>{v}</DistanceMeters>" if v == v else ""
+        for v in points.distance.tolist()
+    ]
+    heartrates = [
+        f"<HeartRateBpm><Value>{int(v)}</Value></HeartRateBpm>" if v == v else ""
+        for v in points.heartrate.tolist()
+    ]
+    return "".join([
+        f"<Trackpoint><Time>{t}</Time>{p}{a}{d}{h}</Trackpoint>"
+        for t, p, a, d, h in zip(times, positions, altitudes, distances, heartrates)
+    ])
+
+
+def iter_tcx(points: Trackpoints, sport, total_time_seconds, distance_meters,
+             chunk_points: int = CHUNK_POINTS) -> Iterator[bytes]:
+    """Yield a TCX document as UTF-8 chunks of at most ``chunk_points`` trackpoints.
+
+    Only one chunk is formatted at a time, so memory stays flat regardless of
+    how long the activity is. ``total_time_seconds`` and ``distance_meters``
+    are plain numbers; convert stravalib durations with ``elapsed_seconds``.
+    """
+    start = format_times(points.time[:1])[0] if len(points) else None
+    yield (
+        "<?xml version='1.0' encoding='UTF-8'?>\n"
+        f'<TrainingCenterDatabase xmlns="{TCX_NAMESPACE}">'
+        f"<Activities><Activity Sport={quoteattr(sport_name(sport))}>"
+        f"<Id>{start or ''}</Id>"
+        f'<Lap StartTime="{start or ""}">'
+        f"<TotalTimeSeconds>{float(total_time_seconds)}</TotalTimeSeconds>"
+        f"<DistanceMeters>{float(distance_meters)}</DistanceMeters>"
+        "<Track>"
+    ).encode('utf-8')
+    for offset in range(0, len(points), chunk_points):
+        yield _trackpoints(points.take(slice(offset, offset + chunk_points))).encode('utf-8')
+    yield b"</Track></Lap></Activity></Activities></TrainingCenterDatabase>\n"
+
@@ -0,0 +1,86 @@
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+from opentelemetry import metrics, trace
+
+# Spans and instruments go to whichever providers the API or CLI installs;
+# until then they are no-ops.
+tracer = trace.get_tracer("strava_merge")
+meter = metrics.get_meter("strava_merge")
+
+stage_duration = meter.create_histogram(
+    "merge.stage.duration", unit="s", description="Duration of each merge pipeline stage")
+payload_size = meter.create_histogram(
+    "merge.payload.size", unit="By", description="Bytes produced by serialization and sent in uploads")
+strava_calls = meter.create_counter(
+    "strava.calls", unit="1", description="Requests made to the Strava API")
+strava_errors = meter.create_counter(
+    "strava.errors", unit="1", description="Strava API requests that failed or returned an error status")
+
+EXPORTERS = ("console", "otlp")
+
+
+@contextmanager
+def stage(name: str, attributes: Optional[dict] = None):
+    """A ``merge.<name>`` span whose duration is also recorded in the
+    ``merge.stage.duration`` histogram.
+    """
+    started = time.perf_counter()
+    with tracer.start_as_current_span(f"merge.{name}", attributes=attributes) as span:
+        try:
+            yield span
+        finally:
+            stage_duration.record(time.perf_counter() - started, {"stage": name})
+
+
+class MeteredChunks:
+    """Pass ``chunks`` through, counting bytes and the time spent producing
+    them. Lazily generated output is serialized while it is being uploaded,
+    so this separates encoder time from time spent waiting on the network.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = chunks
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def __iter__(self) -> Iterator[bytes]:
+        chunks = iter(self._chunks)
+        while True:
+            started = time.perf_counter()
+            chunk = next(chunks, None)
+            self.seconds += time.perf_counter() - started
+            if chunk is None:
+                return
+            self.bytes += len(chunk)
+            yield chunk
+
+
+def configure(exporter: str, service_name: str):
+    """Install SDK tracer and meter providers that export to the console or
+    over OTLP (``OTEL_EXPORTER_OTLP_*`` environment variables apply).
+    Providers flush when the process exits.
+    """
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.sdk.metrics.export import ConsoleMetricExporter, PeriodicExportingMetricReader
+    from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    if exporter == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError as e:
+            raise RuntimeError("OTLP export needs opentelemetry-exporter-otlp-proto-http") from e
+        span_exporter, metric_exporter = OTLPSpanExporter(), OTLPMetricExporter()
+    else:
+        span_exporter, metric_exporter = ConsoleSpanExporter(), ConsoleMetricExporter()
+
+    resource = Resource({SERVICE_NAME: service_name})
+    tracer_provider = TracerProvider(resource=resource)
+    tracer_provider.add_span_processor(BatchSpanProcessor(span_exporter))
+    trace.set_tracer_provider(tracer_provider)
+    metrics.set_meter_provider(MeterProvider(resource=resource,
+                                             metric_readers=[PeriodicExportingMetricReader(metric_exporter)]))
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from .models import Settings, UserToken
+from .ratelimit import BACKGROUND, StravaSession, request_priority
+
+logger = logging.getLogger(__name__)
+
+TOKEN_URL = "https://www.strava.com/oauth/token"
+
+
+class TokenStore:
+    """Process-local cache of users' Strava tokens in front of Mongo.
+
+    Tokens are re-read from Mongo after ``cache_ttl`` seconds, so tokens
+    refreshed by another instance are picked up. A background task refreshes
+    tokens within ``refresh_margin`` seconds of expiry and saves them; a
+    request only refreshes inline if its token has already expired. Refreshes
+    of one user are serialized, so concurrent callers never refresh twice.
+    The client credentials are read from ``settings`` on every refresh, so
+    secrets reloaded from Key Vault take effect.
+    """
+
+    def __init__(self, session: StravaSession, settings: Optional[Settings] = None,
+                 cache_ttl: float = 300.0, refresh_margin: float = 600.0, check_interval: float = 60.0):
+        self._session = session
+        self._settings = settings
+        self.cache_ttl = cache_ttl
+        self.refresh_margin = refresh_margin
+        self.check_interval = check_interval
+        self._cache: Dict[str, Tuple[float, Optional[UserToken]]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def _lock(self, user_id: str) -> asyncio.Lock:
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    def _cached(self, user_id: str) -> Tuple[bool, Optional[UserToken]]:
+        entry = self._cache.get(user_id)
+        if entry is None or time.monotonic() - entry[0] > self.cache_ttl:
+            return False, None
+        return True, entry[1]
+
+    async def _load(self, user_id: str) -> Optional[UserToken]:
+        token = await UserToken.find_one(UserToken.user_id == user_id)
+        self._cache[user_id] = (time.monotonic(), token)
+        return token
+
+    async def get(self, user_id: str) -> Optional[UserToken]:
+        """The user's token, or None if they have not authenticated."""
+        found, token = self._cached(user_id)
+        if found:
+            self.hits += 1
+        else:
+            async with self._lock(user_id):
+                # Another request may have loaded it while this one waited
+                found, token = self._cached(user_id)
+                if found:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    token = await self._load(user_id)
+        if token is not None and token.expires_at <= time.time():
+            token = await self.refresh(user_id)
+        return token
+
+    async def save(self, user_id: str, access_token: str, refresh_token: str, expires_at: int) -> UserToken:
+        await UserToken.get_motor_collection().update_one(
+            {"user_id": user_id},
+            {
+                "$set": {"access_token": access_token, "refresh_token": refresh_token, "expires_at": expires_at},
+                "$setOnInsert": {"created_at": datetime.utcnow()},
+            },
+            upsert=True,
+        )
+        return await self._load(user_id)
+
+    async def refresh(self, user_id: str, margin: float = 0.0) -> Optional[UserToken]:
+        """Refresh the user's token unless it is valid for more than ``margin`` seconds."""
+        async with self._lock(user_id):
+            # Re-read first: another request, the background task or another
+            # instance may already have refreshed it
+            token = await self._load(user_id)
+            if token is None or token.expires_at > time.time() + margin:
+                return token
+            client_id = self._settings and self._settings.STRAVA_CLIENT_ID
+            client_secret = self._settings and self._settings.STRAVA_CLIENT_SECRET
+            if not (client_id and client_secret):
+                logger.warning("Cannot refresh the Strava token of %s: no client credentials", user_id)
+                return token
+            try:
+                response = await asyncio.to_thread(self._session.post, TOKEN_URL, data={
+                    'client_id': client_id,
+                    'client_secret': client_secret,
+                    'grant_type': 'refresh_token',
+                    'refresh_token': token.refresh_token,
+                })
+                response.raise_for_status()
+                data = response.json()
+            except Exception:
+                self.refresh_failures += 1
+                logger.exception("Refreshing the Strava token of %s failed", user_id)
+                return token
+            self.refreshes += 1
+            return await self.save(user_id, data['access_token'], data['refresh_token'], data['expires_at'])
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        # Refreshes use the background share of the rate limit
+        request_priority.set(BACKGROUND)
+        while True:
+            try:
+                due = await UserToken.find(UserToken.expires_at < time.time() + self.refresh_margin).to_list()
+                for token in due:
+                    await self.refresh(token.user_id, self.refresh_margin)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Token refresh check failed")
+            await asyncio.sleep(self.check_interval)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+        }
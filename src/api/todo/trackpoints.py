@@ -0,0 +1,406 @@
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+STREAM_TYPES = ['time', 'latlng', 'distance', 'altitude', 'heartrate', 'cadence', 'watts']
+CHANNELS = ('lat', 'lon', 'distance', 'altitude', 'heartrate', 'cadence', 'watts')
+EARTH_RADIUS_M = 6371008.8
+
+
+def _stream_data(streams: Mapping, key: str):
+    # Accepts stravalib Stream objects as well as cached NumPy arrays
+    stream = streams.get(key) if key in streams else None
+    data = getattr(stream, 'data', stream)
+    return data if data is not None else []
+
+
+def _column(values, length: int) -> np.ndarray:
+    """Float64 column of exactly ``length`` samples; missing samples are NaN."""
+    column = np.full(length, np.nan)
+    if len(values):
+        # None entries (e.g. watts dropouts) become NaN under dtype=float
+        data = np.asarray(values[:length], dtype=np.float64)
+        column[:len(data)] = data
+    return column
+
+
+class Trackpoints:
+    """Columnar trackpoint storage: one NumPy array per stream channel.
+
+    ``time`` holds int64 epoch seconds. Every other channel is a float64 array
+    in which NaN marks a missing sample; ``mask(channel)`` returns the
+    matching validity mask.
+    """
+
+    __slots__ = ('time',) + CHANNELS
+
+    def __init__(self, time, lat, lon, distance, altitude, heartrate, cadence, watts):
+        self.time = np.asarray(time, dtype=np.int64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.distance = np.asarray(distance, dtype=np.float64)
+        self.altitude = np.asarray(altitude, dtype=np.float64)
+        self.heartrate = np.asarray(heartrate, dtype=np.float64)
+        self.cadence = np.asarray(cadence, dtype=np.float64)
+        self.watts = np.asarray(watts, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    @classmethod
+    def empty(cls) -> 'Trackpoints':
+        return cls(np.empty(0, dtype=np.int64), *(np.empty(0) for _ in CHANNELS))
+
+    @classmethod
+    def from_streams(cls, streams: Mapping, start_time: datetime) -> 'Trackpoints':
+        """Build columns from a streams dict (stravalib ``Stream`` objects or
+        arrays from the stream cache) and the activity start time.
+        """
+        times = _stream_data(streams, 'time')
+        n = len(times)
+        if not n:
+            return cls.empty()
+
+        latlng = np.full((n, 2), np.nan)
+        latlngs = _stream_data(streams, 'latlng')
+        if len(latlngs):
+            data = np.asarray(latlngs[:n], dtype=np.float64).reshape(-1, 2)
+            latlng[:len(data)] = data
+
+        return cls(
+            int(start_time.timestamp()) + np.asarray(times, dtype=np.int64),
+            latlng[:, 0],
+            latlng[:, 1],
+            _column(_stream_data(streams, 'distance'), n),
+            _column(_stream_data(streams, 'altitude'), n),
+            _column(_stream_data(streams, 'heartrate'), n),
+            _column(_stream_data(streams, 'cadence'), n),
+            _column(_stream_data(streams, 'watts'), n),
+        )
+
+    def mask(self, channel: str) -> np.ndarray:
+        if channel == 'position':
+            return ~(np.isnan(self.lat) | np.isnan(self.lon))
+        return ~np.isnan(getattr(self, channel))
+
+    def max_distance(self) -> float:
+        valid = self.distance[self.mask('distance')]
+        return float(valid.max()) if len(valid) else 0.0
+
+    def total_distance(self) -> float:
+        """The last recorded distance, 0 if there is none."""
+        valid = self.distance[self.mask('distance')]
+        return float(valid[-1]) if len(valid) else 0.0
+
+    def duration(self) -> int:
+        """Seconds from the first point to the last."""
+        return int(self.time[-1] - self.time[0]) if len(self) else 0
+
+    def take(self, index) -> 'Trackpoints':
+        return Trackpoints(*(getattr(self, name)[index] for name in self.__slots__))
+
+    def start_time(self) -> Optional[int]:
+        return int(self.time[0]) if len(self) else None
+
+
+# Channels a merge can prefer a source for; lat and lon always come from the same one
+PRIORITY_CHANNELS = ('position', 'distance', 'altitude', 'heartrate', 'cadence', 'watts')
+# Longest gap, in seconds, that resampling interpolates across
+RESAMPLE_MAX_GAP = 30
+
+
+def _merge_sorted(times: Sequence[np.ndarray]) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """Merge already sorted timestamp arrays in log2(k) pairwise passes.
+
+    Returns the merged timestamps and, for each input, the positions its
+    samples took in them. Equal timestamps keep input order.
+    """
+    nodes = [(t, [np.arange(len(t))]) for t in times]
+    while len(nodes) > 1:
+        merged = []
+        for (a, a_positions), (b, b_positions) in zip(nodes[::2], nodes[1::2]):
+            # Each sample's rank in the merged run is its own index plus the
+            # number of samples of the other run that go before it
+            to_a = np.arange(len(a)) + np.searchsorted(b, a, side='left')
+            to_b = np.arange(len(b)) + np.searchsorted(a, b, side='right')
+            t = np.empty(len(a) + len(b), dtype=np.int64)
+            t[to_a] = a
+            t[to_b] = b
+            merged.append((t, [to_a[p] for p in a_positions] + [to_b[p] for p in b_positions]))
+        if len(nodes) % 2:
+            merged.append(nodes[-1])
+        nodes = merged
+    return nodes[0]
+
+
+def _ranking(tracks: Sequence[Trackpoints], priority: Mapping[str, Sequence[int]], channel: str) -> List[int]:
+    """Track indices for ``channel``, most preferred first: those listed in
+    ``priority``, then the rest from the earliest start.
+    """
+    preferred = list(priority.get(channel, ()))
+    default = sorted(range(len(tracks)), key=lambda i: (not len(tracks[i]), tracks[i].start_time() or 0, i))
+    return preferred + [i for i in default if i not in preferred]
+
+
+def _merged_distance(times: np.ndarray, tracks: Sequence[Trackpoints], order: Sequence[int]) -> np.ndarray:
+    """Cumulative distance over the merged timeline.
+
+    Each step between consecutive timestamps is measured by the most
+    preferred track whose distance covers both, so overlapping recordings
+    are not counted twice and a change of source never jumps. Steps no track
+    covers, like the break between two activities, add nothing.
+    """
+    steps = np.zeros(len(times))
+    first = np.full(len(times), np.nan)
+    covered = np.zeros(len(times), dtype=bool)
+    # Least preferred first, so more preferred tracks overwrite them
+    for i in reversed(order):
+        valid = tracks[i].mask('distance')
+        if not valid.any():
+            continue
+        t, d = tracks[i].time[valid], tracks[i].distance[valid]
+        inside = (times >= t[0]) & (times <= t[-1])
+        at = np.interp(times, t, d)
+        spans = inside.copy()
+        spans[0] = False
+        spans[1:] &= inside[:-1]
+        steps[spans] = np.maximum(np.diff(at)[spans[1:]], 0.0)
+        first[inside] = at[inside]
+        covered |= inside
+    distance = np.full(len(times), np.nan)
+    if covered.any():
+        start = first[np.argmax(covered)]
+        distance[covered] = (start + np.cumsum(steps))[covered]
+    return distance
+
+
+def merge_tracks(tracks: Iterable[Trackpoints], priority: Optional[Mapping[str, Sequence[int]]] = None,
+                 resample: bool = False) -> Trackpoints:
+    """Merge activities onto one timeline, one point per timestamp.
+
+    Each track is already in time order, so they are merged rather than
+    sorted. Where recordings overlap, every channel takes the sample of the
+    most preferred track that has one at that time: ``priority`` maps a
+    channel in PRIORITY_CHANNELS to track indices in order of preference;
+    other tracks, and channels without an entry, prefer the earliest start.
+    Distance is rebuilt from the chosen tracks' steps so that it keeps
+    increasing (see _merged_distance). With ``resample``, the result is
+    interpolated onto a 1 Hz grid.
+    """
+    tracks = list(tracks)
+    priority = priority or {}
+    if not any(len(track) for track in tracks):
+        return Trackpoints.empty()
+
+    merged, positions = _merge_sorted([track.time for track in tracks])
+    new = np.empty(len(merged), dtype=bool)
+    new[0] = True
+    new[1:] = merged[1:] != merged[:-1]
+    row = np.cumsum(new) - 1
+    times = merged[new]
+    rows = [row[p] for p in positions]
+
+    columns = {'time': times}
+    for channel in PRIORITY_CHANNELS:
+        order = _ranking(tracks, priority, channel)
+        if channel == 'distance':
+            columns['distance'] = _merged_distance(times, tracks, order)
+            continue
+        names = ('lat', 'lon') if channel == 'position' else (channel,)
+        for name in names:
+            columns[name] = np.full(len(times), np.nan)
+        for i in reversed(order):
+            valid = tracks[i].mask(channel)
+            for name in names:
+                columns[name][rows[i][valid]] = getattr(tracks[i], name)[valid]
+    points = Trackpoints(**columns)
+    return resample_1hz(points) if resample else points
+
+
+def source_priority(activity_ids: Sequence[int], prefer: Mapping[str, Sequence[int]]) -> Dict[str, List[int]]:
+    """Turn preferred activity ids per channel into the track indices
+    ``merge_tracks`` takes, for tracks built in ``activity_ids`` order.
+    """
+    index = {activity_id: i for i, activity_id in enumerate(activity_ids)}
+    priority = {}
+    for channel, preferred in prefer.items():
+        if channel not in PRIORITY_CHANNELS:
+            raise ValueError(f"Unknown channel {channel!r}, expected one of {', '.join(PRIORITY_CHANNELS)}")
+        missing = [activity_id for activity_id in preferred if activity_id not in index]
+        if missing:
+            raise ValueError(f"Preferred {channel} activities are not being merged: "
+                             f"{', '.join(map(str, missing))}")
+        priority[channel] = [index[activity_id] for activity_id in preferred]
+    return priority
+
+
+class _Interpolation(NamedTuple):
+    usable: np.ndarray
+    left: np.ndarray
+    right: np.ndarray
+    weight: np.ndarray
+
+    @classmethod
+    def plan(cls, grid: np.ndarray, time: np.ndarray, max_gap: int) -> '_Interpolation':
+        """Linear interpolation from samples at ``time`` onto ``grid``, except
+        where the samples either side are more than ``max_gap`` seconds apart.
+        """
+        if not len(time):
+            empty = np.empty(0, dtype=np.int64)
+            return cls(np.zeros(len(grid), dtype=bool), empty, empty, np.empty(0))
+        after = np.searchsorted(time, grid, side='left')
+        right = np.minimum(after, len(time) - 1)
+        left = np.maximum(after - 1, 0)
+        exact = time[right] == grid
+        span = time[right] - time[left]
+        usable = exact | ((after > 0) & (after < len(time)) & (span <= max_gap))
+        left, right, exact, span = left[usable], right[usable], exact[usable], span[usable]
+        weight = np.ones(len(right))
+        inner = ~exact
+        weight[inner] = (grid[usable][inner] - time[left[inner]]) / span[inner]
+        return cls(usable, left, right, weight)
+
+    def apply(self, values: np.ndarray) -> np.ndarray:
+        out = np.full(len(self.usable), np.nan)
+        out[self.usable] = values[self.left] + self.weight * (values[self.right] - values[self.left])
+        return out
+
+
+def resample_1hz(points: Trackpoints, max_gap: int = RESAMPLE_MAX_GAP) -> Trackpoints:
+    """Interpolate every channel onto one point per second.
+
+    Gaps longer than ``max_gap`` seconds, like pauses or the break between
+    activities, stay gaps, and so do a channel's own gaps that long, e.g.
+    lost GPS. Every original timestamp is kept.
+    """
+    if len(points) < 2:
+        return points
+    t = points.time
+    breaks = np.flatnonzero(np.diff(t) > max_gap)
+    starts = np.concatenate([t[:1], t[breaks + 1]])
+    ends = np.concatenate([t[breaks], t[-1:]])
+    lengths = ends - starts + 1
+    offsets = np.cumsum(lengths) - lengths
+    grid = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+    position = points.mask('position')
+    columns = {'time': grid}
+    # Channels sampled at the same times, commonly all of them, share one plan
+    plans = {}
+    for name in CHANNELS:
+        valid = position if name in ('lat', 'lon') else points.mask(name)
+        key = valid.tobytes()
+        if key not in plans:
+            plans[key] = _Interpolation.plan(grid, t[valid], max_gap)
+        columns[name] = plans[key].apply(getattr(points, name)[valid])
+    return Trackpoints(**columns)
+
+
+def decimate(points: Trackpoints, interval_seconds: int) -> Trackpoints:
+    """Keep the first point of every ``interval_seconds`` window, plus the last point."""
+    if len(points) < 3 or interval_seconds <= 1:
+        return points
+    bucket = (points.time - points.time[0]) // interval_seconds
+    keep = np.empty(len(points), dtype=bool)
+    keep[0] = True
+    keep[1:] = bucket[1:] != bucket[:-1]
+    keep[-1] = True
+    return points.take(keep)
+
+
+def _local_coordinates(points: Trackpoints, index: np.ndarray) -> np.ndarray:
+    """Equirectangular x/y plus altitude, in meters, for the points at ``index``."""
+    lat = np.radians(points.lat[index])
+    lon = np.radians(points.lon[index])
+    lat0 = lat.mean()
+    altitude = points.altitude[index]
+    valid = ~np.isnan(altitude)
+    if valid.all():
+        z = altitude
+    elif valid.any():
+        z = np.interp(points.time[index], points.time[index][valid], altitude[valid])
+    else:
+        z = np.zeros(len(index))
+    return np.column_stack([
+        EARTH_RADIUS_M * (lon - lon.mean()) * np.cos(lat0),
+        EARTH_RADIUS_M * (lat - lat0),
+        z,
+    ])
+
+
+def _douglas_peucker(coords: np.ndarray, tolerance: float) -> np.ndarray:
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(coords) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        # Distance of every interior point to the start-end segment, at once
+        a = coords[start]
+        ab = coords[end] - a
+        ap = coords[start + 1:end] - a
+        length2 = ab @ ab
+        t = np.clip(ap @ ab / length2, 0.0, 1.0) if length2 else np.zeros(len(ap))
+        distances = np.linalg.norm(ap - t[:, None] * ab, axis=1)
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            split = start + 1 + i
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return keep
+
+
+def simplify(points: Trackpoints, tolerance_m: float) -> Trackpoints:
+    """Douglas-Peucker simplification on lat/lon/altitude.
+
+    Points deviating less than ``tolerance_m`` from the simplified line are
+    dropped. Points without a position are kept; the first and last points
+    always are, so elapsed time and cumulative distance are unchanged.
+    """
+    positioned = np.flatnonzero(points.mask('position'))
+    if len(positioned) < 3:
+        return points
+    keep = np.ones(len(points), dtype=bool)
+    keep[positioned] = _douglas_peucker(_local_coordinates(points, positioned), tolerance_m)
+    keep[0] = keep[-1] = True
+    return points.take(keep)
+
+
+class Reduction(NamedTuple):
+    points_in: int
+    points_out: int
+    seconds: float
+
+    @property
+    def ratio(self) -> float:
+        return self.points_out / self.points_in if self.points_in else 1.0
+
+    def estimated_seconds_saved(self, output_seconds: float) -> float:
+        """Given how long writing the reduced output took, estimate the time
+        the dropped points would have cost, net of this stage itself.
+        """
+        if not self.points_out:
+            return 0.0
+        return output_seconds * (self.points_in - self.points_out) / self.points_out - self.seconds
+
+    def summary(self) -> str:
+        return (f"{self.points_in} -> {self.points_out} points ({self.ratio:.0%}) "
+                f"in {self.seconds:.2f}s")
+
+
+def reduce_points(points: Trackpoints, interval_seconds: Optional[int] = None,
+                  tolerance_m: Optional[float] = None) -> Tuple[Trackpoints, Reduction]:
+    """Optional stage between merging and output: time decimation and/or
+    geometric simplification.
+    """
+    started = time.perf_counter()
+    reduced = points
+    if interval_seconds:
+        reduced = decimate(reduced, interval_seconds)
+    if tolerance_m:
+        reduced = simplify(reduced, tolerance_m)
+    return reduced, Reduction(len(points), len(reduced), time.perf_counter() - started)
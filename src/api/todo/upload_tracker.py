@@ -0,0 +1,248 @@
+import asyncio
+import heapq
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from beanie import PydanticObjectId
+from pymongo import ReturnDocument
+
+from . import uploads
+from .models import MergeJob, MergeResult, UploadState
+from .ratelimit import BACKGROUND, request_priority
+from .strava import StravaPool
+
+logger = logging.getLogger(__name__)
+
+
+class _Pending(NamedTuple):
+    due: float
+    job_id: PydanticObjectId
+    delay: float
+    deadline: float
+
+
+class UploadTracker:
+    """Follows Strava's processing of every pending upload from one
+    background task, instead of a request held open per upload.
+
+    Each upload is polled after ``initial_delay`` seconds, then at
+    intervals doubling up to ``max_delay``, until it is ready, fails or
+    ``timeout`` seconds have passed. The outcome is saved on the merge job
+    and wakes anyone waiting on it.
+
+    Like MergeWorkerPool, the tracker leases the jobs it follows, so with
+    several replicas each upload is polled by one of them. Uploads whose
+    tracker stops renewing its leases are taken over by another.
+    """
+
+    def __init__(self, strava_pool: StravaPool, initial_delay: float = 2.0, max_delay: float = 60.0,
+                 timeout: float = 1800.0, lease_seconds: float = 120.0):
+        self._strava_pool = strava_pool
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._pending: List[_Pending] = []
+        # Uploads this tracker has leased, whose leases it renews
+        self._held: Set[PydanticObjectId] = set()
+        self._wakeup = asyncio.Event()
+        self._waiters: Dict[PydanticObjectId, List[asyncio.Future]] = {}
+        self._tasks: List[asyncio.Task] = []
+        self.polls = 0
+        self.poll_errors = 0
+        self.outcomes = {state.value: 0 for state in UploadState if state != UploadState.PROCESSING}
+
+    async def start(self):
+        await self._resume()
+        self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._maintain())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _lease(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    async def track(self, job: MergeJob):
+        """Follow the upload of a merge job this replica has just run."""
+        # Taken over from the worker pool that ran the merge
+        claimed = await MergeJob.get_motor_collection().update_one(
+            {"_id": job.id, "owner": job.owner, "upload_state": UploadState.PROCESSING.value},
+            {"$set": {"owner": self.owner, "lease_expires_at": self._lease()}},
+        )
+        if claimed.modified_count:
+            self._push(job.id)
+
+    def _push(self, job_id: PydanticObjectId, elapsed: float = 0.0):
+        now = asyncio.get_running_loop().time()
+        self._held.add(job_id)
+        heapq.heappush(self._pending, _Pending(now + self.initial_delay, job_id, self.initial_delay,
+                                               now + max(0.0, self.timeout - elapsed)))
+        self._wakeup.set()
+
+    async def _claim(self, job_id: PydanticObjectId) -> Optional[MergeJob]:
+        """Atomically take the upload if it is still processing and no other live tracker holds it."""
+        document = await MergeJob.get_motor_collection().find_one_and_update(
+            {
+                "_id": job_id,
+                "upload_state": UploadState.PROCESSING.value,
+                "$or": [{"owner": self.owner}, {"owner": None}, {"lease_expires_at": None},
+                        {"lease_expires_at": {"$lt": datetime.utcnow()}}],
+            },
+            {"$set": {"owner": self.owner, "lease_expires_at": self._lease()}},
+            return_document=ReturnDocument.AFTER,
+        )
+        return MergeJob.parse_obj(document) if document else None
+
+    async def _renew(self):
+        if self._held:
+            await MergeJob.get_motor_collection().update_many(
+                {"_id": {"$in": list(self._held)}, "owner": self.owner},
+                {"$set": {"lease_expires_at": self._lease()}},
+            )
+
+    async def _resume(self):
+        """Take over uploads that were still processing when their tracker stopped."""
+        now = datetime.utcnow()
+        cursor = MergeJob.get_motor_collection().find({
+            "upload_state": UploadState.PROCESSING.value,
+            "$or": [{"lease_expires_at": None}, {"lease_expires_at": {"$lt": now}}],
+        })
+        async for document in cursor:
+            if document["_id"] in self._held:
+                continue
+            job = await self._claim(document["_id"])
+            if job is not None:
+                logger.info("Resuming upload tracking of merge job %s", job.id)
+                self._push(job.id, elapsed=(now - job.updated_at).total_seconds())
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self._renew()
+                await self._resume()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Renewing upload tracking leases failed")
+
+    async def wait(self, job_id: PydanticObjectId, timeout: float):
+        """Wait up to ``timeout`` seconds for a tracked upload to finish processing."""
+        if job_id not in self._held:
+            await self._watch(job_id, timeout)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(job_id, []).append(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiters = self._waiters.get(job_id, [])
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._waiters.pop(job_id, None)
+
+    async def _watch(self, job_id: PydanticObjectId, timeout: float):
+        # Followed by another replica, so only the saved outcome shows when it is done
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            await asyncio.sleep(min(self.initial_delay, deadline - loop.time()))
+            job = await MergeJob.get(job_id)
+            if job is None or job.upload_state != UploadState.PROCESSING:
+                return
+
+    async def _run(self):
+        # Polls use the background share of the rate limit, like merge jobs
+        request_priority.set(BACKGROUND)
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            if not self._pending:
+                await self._wakeup.wait()
+                continue
+            delay = self._pending[0].due - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due = []
+            while self._pending and self._pending[0].due <= loop.time():
+                due.append(heapq.heappop(self._pending))
+            await asyncio.gather(*(self._poll(pending) for pending in due))
+
+    async def _poll(self, pending: _Pending):
+        try:
+            job = await MergeJob.get(pending.job_id)
+            if job is None:
+                outcome = uploads.UploadOutcome(uploads.ERROR, error="Merge job deleted")
+            elif job.owner != self.owner:
+                # Taken over by another replica after this one's lease lapsed
+                self._held.discard(pending.job_id)
+                return
+            else:
+                outcome = await self._check(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Checking upload of merge job %s failed", pending.job_id)
+            self.poll_errors += 1
+            outcome = None
+        if outcome is not None and outcome.state != uploads.PROCESSING:
+            await self._finish(pending.job_id, UploadState(outcome.state), outcome.activity_id, outcome.error)
+            return
+        loop = asyncio.get_running_loop()
+        if loop.time() >= pending.deadline:
+            await self._finish(pending.job_id, UploadState.TIMEOUT, None,
+                               f"Still processing after {self.timeout:.0f}s")
+            return
+        delay = min(pending.delay * 2, self.max_delay)
+        heapq.heappush(self._pending, pending._replace(due=loop.time() + delay, delay=delay))
+
+    async def _check(self, job: MergeJob) -> Optional[uploads.UploadOutcome]:
+        """The upload's current outcome, or None to try again later."""
+        client = await self._strava_pool.clients.get(job.user_id)
+        if client is None:
+            return None
+        self.polls += 1
+        response = await self._strava_pool.run(uploads.get_upload_status, self._strava_pool.session,
+                                               client.access_token, job.upload_id)
+        if response.status_code >= 400 and response.status_code != 404:
+            self.poll_errors += 1
+        return uploads.status_outcome(response)
+
+    async def _finish(self, job_id: PydanticObjectId, state: UploadState, activity_id: Optional[int],
+                      error: Optional[str]):
+        job = await MergeJob.get(job_id)
+        if job is not None:
+            await job.set_status(job.status, upload_state=state, activity_id=activity_id, upload_error=error)
+            logger.info("Upload %s of merge job %s: %s", job.upload_id, job_id, error or state.value)
+        if state == UploadState.ERROR:
+            # Strava rejected the file, so a repeat of the request should merge again
+            await MergeResult.find(MergeResult.job_id == job_id).delete()
+        self._held.discard(job_id)
+        self.outcomes[state.value] += 1
+        for future in self._waiters.pop(job_id, []):
+            if not future.done():
+                future.set_result(state)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "waiting_requests": sum(len(waiters) for waiters in self._waiters.values()),
+            "polls": self.polls,
+            "poll_errors": self.poll_errors,
+            "outcomes": dict(self.outcomes),
+        }
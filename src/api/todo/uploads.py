@@ -0,0 +1,179 @@
+import time
+import uuid
+import zlib
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+import requests
+
+UPLOAD_URL = "https://www.strava.com/api/v3/uploads"
+
+# Upload processing states, as recorded in UploadOutcome.state
+PROCESSING = "processing"
+READY = "ready"
+ERROR = "error"
+
+
+class GzipStream:
+    """Gzip ``chunks`` on the fly as they are iterated, for the ``*.gz``
+    upload data types. Only one compressed chunk is held at a time; sizes and
+    compression time are recorded for reporting.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], level: int = 6):
+        self._chunks = chunks
+        self.level = level
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.seconds = 0.0
+
+    def __iter__(self) -> Iterator[bytes]:
+        # wbits=31 selects a gzip header and trailer around the deflate stream
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        for chunk in self._chunks:
+            started = time.perf_counter()
+            out = compressor.compress(chunk)
+            self.seconds += time.perf_counter() - started
+            self.raw_bytes += len(chunk)
+            if out:
+                self.compressed_bytes += len(out)
+                yield out
+        started = time.perf_counter()
+        out = compressor.flush()
+        self.seconds += time.perf_counter() - started
+        self.compressed_bytes += len(out)
+        yield out
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.raw_bytes - self.compressed_bytes
+
+    def summary(self) -> str:
+        ratio = self.compressed_bytes / self.raw_bytes if self.raw_bytes else 1.0
+        return (f"{self.raw_bytes / 1024:.0f} KB -> {self.compressed_bytes / 1024:.0f} KB "
+                f"({ratio:.0%}, saved {self.saved_bytes / 1024:.0f} KB) in {self.seconds:.2f}s")
+
+
+class RetainedCopy:
+    """Pass ``chunks`` through unchanged while keeping a copy of them,
+    gzip-compressed at ``level`` (0 keeps them as they are, e.g. when they
+    are already gzip). The copy is dropped once it exceeds ``max_bytes``,
+    and the rest of the chunks are then passed through without compressing.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], max_bytes: int, level: int = 0):
+        self._chunks = chunks
+        self.max_bytes = max_bytes
+        self.level = level
+        self._parts = []
+        self._size = 0
+        self.overflowed = False
+
+    def _keep(self, data: bytes):
+        if self.overflowed or not data:
+            return
+        self._size += len(data)
+        if self._size > self.max_bytes:
+            self.overflowed = True
+            self._parts = []
+        else:
+            self._parts.append(data)
+
+    def __iter__(self) -> Iterator[bytes]:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31) if self.level else None
+        for chunk in self._chunks:
+            if not self.overflowed:
+                self._keep(compressor.compress(chunk) if compressor else chunk)
+            yield chunk
+        if compressor and not self.overflowed:
+            self._keep(compressor.flush())
+
+    @property
+    def data(self) -> Optional[bytes]:
+        return None if self.overflowed else b''.join(self._parts)
+
+
+def iter_multipart(fields: dict, filename: str, chunks: Iterable[bytes], boundary: str) -> Iterator[bytes]:
+    """Encode form fields plus a file part as multipart/form-data without
+    buffering the file: its chunks are passed through as they are produced.
+    """
+    for name, value in fields.items():
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f'{value}\r\n'
+        ).encode('utf-8')
+    yield (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode('utf-8')
+    yield from chunks
+    yield f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+
+def upload_activity(session: requests.Session, access_token: str, chunks: Iterable[bytes], name: str,
+                    description: str, data_type: str, filename: str) -> requests.Response:
+    """POST an activity file to Strava as a chunked request body."""
+    boundary = uuid.uuid4().hex
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': f'multipart/form-data; boundary={boundary}',
+    }
+    data = {
+        'name': name,
+        'description': description,
+        'trainer': 'false',
+        'commute': 'false',
+        'data_type': data_type
+    }
+    return session.post(UPLOAD_URL, headers=headers, data=iter_multipart(data, filename, chunks, boundary))
+
+
+class UploadOutcome(NamedTuple):
+    """Where Strava is with processing an upload."""
+    state: str
+    activity_id: Optional[int] = None
+    error: Optional[str] = None
+
+
+def upload_outcome(body: dict) -> UploadOutcome:
+    """Interpret an upload status body from ``POST /uploads`` or ``GET /uploads/{id}``."""
+    if body.get('error'):
+        return UploadOutcome(ERROR, error=body['error'])
+    if body.get('activity_id'):
+        return UploadOutcome(READY, activity_id=body['activity_id'])
+    if body.get('status') == 'The created activity has been deleted.':
+        return UploadOutcome(ERROR, error=body['status'])
+    return UploadOutcome(PROCESSING)
+
+
+def get_upload_status(session: requests.Session, access_token: str, upload_id: int) -> requests.Response:
+    return session.get(f'{UPLOAD_URL}/{upload_id}', headers={'Authorization': f'Bearer {access_token}'})
+
+
+def status_outcome(response: requests.Response) -> UploadOutcome:
+    """Interpret a ``GET /uploads/{id}`` response. Rate-limited and failed
+    polls count as still processing, to be retried at the next interval.
+    """
+    if response.status_code == 404:
+        return UploadOutcome(ERROR, error="Upload not found")
+    if response.status_code >= 400:
+        return UploadOutcome(PROCESSING)
+    return upload_outcome(response.json())
+
+
+def wait_for_upload(session: requests.Session, access_token: str, upload_id: int, timeout: float = 300.0,
+                    initial_delay: float = 1.0, max_delay: float = 30.0) -> UploadOutcome:
+    """Poll an upload with exponential backoff until Strava has processed it.
+
+    Returns a PROCESSING outcome if it is still processing after ``timeout``
+    seconds.
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    while True:
+        time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+        outcome = status_outcome(get_upload_status(session, access_token, upload_id))
+        if outcome.state != PROCESSING or time.monotonic() >= deadline:
+            return outcome
+        delay = min(delay * 2, max_delay)
@@ -0,0 +1,22 @@
+export type MergeStatus =
+  | 'queued'
+  | 'fetching'
+  | 'merging'
+  | 'simplifying'
+  | 'serializing'
+  | 'uploading'
+  | 'done'
+  | 'failed';
+
+export type UploadState = 'processing' | 'ready' | 'error' | 'timeout';
+
+export interface MergeJob {
+  job_id: string;
+  status: MergeStatus;
+  upload_id?: number;
+  upload_state?: UploadState;
+  activity_id?: number;
+  upload_error?: string;
+  error?: string;
+  message?: string;
+}
@@ -1,6 +1,9 @@
 import { useState, useEffect } from 'react';
 import { Stack, PrimaryButton, Checkbox, Text, Spinner, MessageBar, MessageBarType, Link } from '@fluentui/react';
 import { Activity } from '../models/activity';
+import { MergeJob } from '../models/mergeJob';
+
+const MERGE_POLL_INTERVAL_MS = 2000;
 
 const HomePage = () => {
   const [isAuthenticated, setIsAuthenticated] = useState(false);
@@ -8,6 +11,7 @@ const HomePage = () => {
   const [selectedActivities, setSelectedActivities] = useState<Set<number>>(new Set());
   const [loading, setLoading] = useState(false);
   const [merging, setMerging] = useState(false);
+  const [mergeStage, setMergeStage] = useState<string | null>(null);
   const [mergeResult, setMergeResult] = useState<string | null>(null);
   const [error, setError] = useState<string | null>(null);
 
@@ -82,8 +86,13 @@ const HomePage = () => {
       });
 
       if (response.ok) {
-        const result = await response.json();
-        setMergeResult(result.message);
+        const job: MergeJob = await response.json();
+        const result = await waitForMergeJob(job);
+        if (result.status === 'done') {
+          setMergeResult(result.message || 'Activity merged and uploaded successfully!');
+        } else {
+          setError(result.error || 'Failed to merge activities');
+        }
       } else {
         const errorData = await response.json();
         setError(errorData.detail || 'Failed to merge activities');
@@ -92,7 +101,21 @@ const HomePage = () => {
       setError('Failed to merge activities');
     } finally {
       setMerging(false);
+      setMergeStage(null);
+    }
+  };
+
+  const waitForMergeJob = async (job: MergeJob): Promise<MergeJob> => {
+    while (job.status !== 'done' && job.status !== 'failed') {
+      setMergeStage(job.status);
+      await new Promise((resolve) => setTimeout(resolve, MERGE_POLL_INTERVAL_MS));
+      const response = await fetch(`${API_BASE_URL}/merge/${job.job_id}`);
+      if (!response.ok) {
+        throw new Error('Failed to get merge status');
+      }
+      job = await response.json();
     }
+    return job;
   };
 
   if (!isAuthenticated) {
@@ -142,7 +165,7 @@ const HomePage = () => {
       </Stack>
 
       <PrimaryButton
-        text={merging ? "Merging..." : "Merge Selected Activities"}
+        text={merging ? `Merging${mergeStage ? ` (${mergeStage})` : ''}...` : "Merge Selected Activities"}
         onClick={handleMerge}
         disabled={merging || selectedActivities.size < 2}
       />
@@ -1,44 +1,105 @@
 #!/usr/bin/env python3
 
+import argparse
+import contextlib
 import os
 import sys
-from datetime import datetime, timedelta
-import requests
-from stravalib import Client
-from stravalib.model import Stream
-import xml.etree.ElementTree as ET
+import time
 
-def get_access_token():
+STARTED = time.perf_counter()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src', 'api'))
+
+# Heavy dependencies (stravalib and its pydantic models, NumPy, requests,
+# OpenTelemetry) are imported inside the commands that use them, so that
+# --help, list and upload start quickly. These mirror todo.formats.ENCODERS
+# and todo.telemetry.EXPORTERS for the argument parser.
+OUTPUT_FORMATS = ('fit', 'tcx')
+OTEL_EXPORTERS = ('console', 'otlp')
+ACTIVITIES_URL = "https://www.strava.com/api/v3/athlete/activities"
+DEFAULT_NAME = "Merged Activity"
+DEFAULT_DESCRIPTION = "Merged from multiple activities"
+
+class ImportTimer:
+    """Times the imports made while active, like ``python -X importtime``
+    but only for outermost imports: each entry is the cumulative time to
+    import a module and everything it pulls in.
+    """
+
+    def __init__(self):
+        self.imports = []
+        self._depth = 0
+        self._original = None
+
+    def __enter__(self):
+        import builtins
+        self._original = builtins.__import__
+        builtins.__import__ = self._import
+        return self
+
+    def __exit__(self, *exc_info):
+        import builtins
+        builtins.__import__ = self._original
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if self._depth:
+            return self._original(name, globals, locals, fromlist, level)
+        loaded = len(sys.modules)
+        started = time.perf_counter()
+        self._depth += 1
+        try:
+            return self._original(name, globals, locals, fromlist, level)
+        finally:
+            self._depth -= 1
+            if len(sys.modules) > loaded:
+                label = '.' * level + name + (f" ({', '.join(fromlist)})" if fromlist else '')
+                self.imports.append((label, time.perf_counter() - started, len(sys.modules) - loaded))
+
+    def report(self, main_started: float):
+        total = time.perf_counter() - STARTED
+        imported = sum(seconds for _, seconds, _ in self.imports)
+        print(f"startup: {(main_started - STARTED) * 1000:.1f} ms to start, "
+              f"{imported * 1000:.1f} ms importing, {total * 1000:.1f} ms total", file=sys.stderr)
+        print("import time: cumulative | modules | import", file=sys.stderr)
+        for name, seconds, modules in sorted(self.imports, key=lambda entry: -entry[1]):
+            print(f"import time: {seconds * 1e6:10.0f} | {modules:7d} | {name}", file=sys.stderr)
+
+def get_access_token(interactive=True):
     token = os.getenv('STRAVA_ACCESS_TOKEN')
     refresh_token = os.getenv('STRAVA_REFRESH_TOKEN')
     expires_at = int(os.getenv('STRAVA_TOKEN_EXPIRES', 0))
     if token:
-        print("Using access token from environment variable.")
+        if interactive:
+            print("Using access token from environment variable.")
         return token, refresh_token, expires_at
-    
+    if not interactive:
+        sys.exit("Set STRAVA_ACCESS_TOKEN (run without a command once to authorize)")
+
     # Perform OAuth flow
+    from stravalib import Client
+
     client_id = input("Enter your Strava client ID: ")
     client_secret = input("Enter your Strava client secret: ")
-    
+
     client = Client()
     authorize_url = client.authorization_url(
         client_id=client_id,
         redirect_uri='http://localhost',
         scope=['activity:read', 'activity:write']
     )
-    
+
     print(f"Go to this URL in your browser and authorize the app: {authorize_url}")
     print("After authorization, you'll be redirected to http://localhost?code=...")
     print("Copy the 'code' parameter from the URL and paste it here.")
-    
+
     code = input("Enter the authorization code: ")
-    
+
     token_response = client.exchange_code_for_token(
         client_id=client_id,
         client_secret=client_secret,
         code=code
     )
-    
+
     access_token = token_response['access_token']
     refresh_token = token_response['refresh_token']
     expires_at = token_response.get('expires_at', 0)
@@ -46,14 +107,40 @@ def get_access_token():
     print(f"Refresh token obtained: {refresh_token}")
     print(f"Expires at: {expires_at}")
     print("You can set these as STRAVA_ACCESS_TOKEN, STRAVA_REFRESH_TOKEN, and STRAVA_TOKEN_EXPIRES environment variables for future runs.")
-    
+
     return access_token, refresh_token, expires_at
 
-def list_recent_activities(client):
-    after = datetime.now() - timedelta(days=7)
-    activities = list(client.get_activities(after=after))
+def make_session(pool_size=10):
+    from todo.ratelimit import RateLimitScheduler, StravaSession
+    return StravaSession(RateLimitScheduler(), os.getenv('STRAVA_BASE_URL', 'https://www.strava.com'),
+                         pool_size=pool_size)
+
+def make_client(session, access_token):
+    # As todo.strava.StravaClients: the session's scheduler does the rate limiting
+    from stravalib import Client
+    return Client(access_token=access_token, requests_session=session, rate_limit_requests=False)
+
+def fetch_recent_activities(session, access_token, days=7):
+    """Activities started in the last ``days`` days, oldest first, as plain
+    JSON: listing needs none of stravalib's models.
+    """
+    after = int(time.time() - days * 24 * 3600)
+    activities = []
+    page = 1
+    while True:
+        response = session.get(ACTIVITIES_URL, params={'after': after, 'page': page, 'per_page': 200},
+                               headers={'Authorization': f'Bearer {access_token}'})
+        response.raise_for_status()
+        batch = response.json()
+        activities.extend(batch)
+        if len(batch) < 200:
+            return activities
+        page += 1
+
+def list_recent_activities(session, access_token):
+    activities = fetch_recent_activities(session, access_token)
     for i, activity in enumerate(activities):
-        print(f"{i+1}: {activity.name} - {activity.start_date_local}")
+        print(f"{i+1}: {activity['name']} - {activity['start_date_local']}")
     return activities
 
 def download_fit(activity_id, access_token, filename):
@@ -61,140 +148,317 @@ def download_fit(activity_id, access_token, filename):
     # Users must download manually from the web interface.
     pass
 
-def merge_activities(client, act1_id, act2_id, output_file):
-    # Get activity details
-    act1 = client.get_activity(act1_id)
-    act2 = client.get_activity(act2_id)
-    
-    sport = act1.type
-    
-    # Get streams
-    streams1 = client.get_activity_streams(act1_id, types=['time', 'latlng', 'distance', 'altitude', 'heartrate', 'cadence', 'watts'])
-    streams2 = client.get_activity_streams(act2_id, types=['time', 'latlng', 'distance', 'altitude', 'heartrate', 'cadence', 'watts'])
-    
-    def create_points(streams, start_time):
-        points = []
-        times = streams.get('time', Stream()).data if 'time' in streams else []
-        latlngs = streams.get('latlng', Stream()).data if 'latlng' in streams else []
-        distances = streams.get('distance', Stream()).data if 'distance' in streams else []
-        altitudes = streams.get('altitude', Stream()).data if 'altitude' in streams else []
-        heartrates = streams.get('heartrate', Stream()).data if 'heartrate' in streams else []
-        cadences = streams.get('cadence', Stream()).data if 'cadence' in streams else []
-        wattss = streams.get('watts', Stream()).data if 'watts' in streams else []
-        
-        for i in range(len(times)):
-            point = {
-                'time': start_time + timedelta(seconds=times[i]),
-                'lat': latlngs[i][0] if i < len(latlngs) else None,
-                'lon': latlngs[i][1] if i < len(latlngs) else None,
-                'distance': distances[i] if i < len(distances) else None,
-                'altitude': altitudes[i] if i < len(altitudes) else None,
-                'heartrate': heartrates[i] if i < len(heartrates) else None,
-                'cadence': cadences[i] if i < len(cadences) else None,
-                'watts': wattss[i] if i < len(wattss) else None,
-            }
-            points.append(point)
-        return points
-    
-    points1 = create_points(streams1, act1.start_date)
-    points2 = create_points(streams2, act2.start_date)
-    
-    # Offset distances for second activity
-    if points1 and points2:
-        max_dist1 = max((p['distance'] for p in points1 if p['distance'] is not None), default=0)
-        for p in points2:
-            if p['distance'] is not None:
-                p['distance'] += max_dist1
-    
-    all_points = points1 + points2
-    all_points.sort(key=lambda p: p['time'])
-    
-    # Create TCX
-    root = ET.Element("TrainingCenterDatabase", xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2")
-    activities_elem = ET.SubElement(root, "Activities")
-    activity_elem = ET.SubElement(activities_elem, "Activity", Sport=sport)
-    id_elem = ET.SubElement(activity_elem, "Id")
-    id_elem.text = datetime.now().isoformat()
-    
-    lap = ET.SubElement(activity_elem, "Lap", StartTime=all_points[0]['time'].isoformat() if all_points else datetime.now().isoformat())
-    total_time = ET.SubElement(lap, "TotalTimeSeconds")
-    total_time.text = str(act1.elapsed_time + act2.elapsed_time)
-    distance_elem = ET.SubElement(lap, "DistanceMeters")
-    distance_elem.text = str(float(act1.distance) + float(act2.distance))
-    
-    track = ET.SubElement(lap, "Track")
-    for point in all_points:
-        tp = ET.SubElement(track, "Trackpoint")
-        time_elem = ET.SubElement(tp, "Time")
-        time_elem.text = point['time'].isoformat()
-        if point['lat'] is not None and point['lon'] is not None:
-            position = ET.SubElement(tp, "Position")
-            lat = ET.SubElement(position, "LatitudeDegrees")
-            lat.text = str(point['lat'])
-            lon = ET.SubElement(position, "LongitudeDegrees")
-            lon.text = str(point['lon'])
-        if point['altitude'] is not None:
-            alt = ET.SubElement(tp, "AltitudeMeters")
-            alt.text = str(point['altitude'])
-        if point['distance'] is not None:
-            dist = ET.SubElement(tp, "DistanceMeters")
-            dist.text = str(point['distance'])
-        if point['heartrate'] is not None:
-            hrbpm = ET.SubElement(tp, "HeartRateBpm")
-            value = ET.SubElement(hrbpm, "Value")
-            value.text = str(point['heartrate'])
-    
-    tree = ET.ElementTree(root)
-    tree.write(output_file, encoding='unicode', xml_declaration=True)
-
-def upload_activity(access_token, file_path, name, description, data_type='fit'):
-    url = "https://www.strava.com/api/v3/uploads"
-    headers = {'Authorization': f'Bearer {access_token}'}
-    data = {
-        'name': name,
-        'description': description,
-        'trainer': 'false',
-        'commute': 'false',
-        'data_type': data_type
-    }
+def merge_activities(client, activity_ids, output_file, output_format='tcx', compare_formats=False,
+                     simplify_interval=None, simplify_tolerance=None, prefer=None, resample=False):
+    from todo import telemetry
+
+    with telemetry.tracer.start_as_current_span("merge.cli", attributes={"merge.output_format": output_format}):
+        _merge_activities(client, activity_ids, output_file, output_format, compare_formats,
+                          simplify_interval, simplify_tolerance, prefer or {}, resample)
+
+def _merge_activities(client, activity_ids, output_file, output_format, compare_formats,
+                      simplify_interval, simplify_tolerance, prefer, resample):
+    from todo import formats, telemetry
+    from todo.stream_cache import DEFAULT_MAX_BYTES, StreamCache
+    from todo.tcx import merged_sport
+    from todo.trackpoints import Trackpoints, merge_tracks, reduce_points, source_priority
+
+    priority = source_priority(activity_ids, prefer)
+
+    with telemetry.stage("fetch", {"merge.activities": len(activity_ids)}):
+        # Get activity details
+        activities = [client.get_activity(activity_id) for activity_id in activity_ids]
+
+        # Get streams, from the local cache when they were downloaded before
+        stream_cache = StreamCache(os.getenv('STREAM_CACHE_DIR'),
+                                   int(os.getenv('STREAM_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)))
+        all_streams = [stream_cache.fetch(client, activity_id) for activity_id in activity_ids]
+    if stream_cache.enabled:
+        print(f"Stream cache: {stream_cache.hits} hits, {stream_cache.misses} misses")
+
+    sport = merged_sport((activity.start_date, activity.type) for activity in activities)
+
+    with telemetry.stage("build_points") as span:
+        tracks = [
+            Trackpoints.from_streams(streams, activity.start_date)
+            for activity, streams in zip(activities, all_streams)
+        ]
+        span.set_attribute("merge.points_per_activity", [len(track) for track in tracks])
+    with telemetry.stage("merge", {"merge.resample": resample}) as span:
+        all_points = merge_tracks(tracks, priority, resample)
+        span.set_attribute("merge.points", len(all_points))
+    reduction = None
+    if simplify_interval or simplify_tolerance:
+        with telemetry.stage("simplify"):
+            all_points, reduction = reduce_points(all_points, simplify_interval, simplify_tolerance)
+        print(f"Simplified track: {reduction.summary()}")
+
+    # Overlapping recordings would be counted twice by summing the activities
+    total_time = all_points.duration()
+    total_distance = all_points.total_distance()
+    started = time.perf_counter()
+    with telemetry.stage("serialize", {"merge.points": len(all_points)}) as span:
+        size = formats.write_file(output_file, output_format, all_points, sport, total_time, total_distance)
+        span.set_attribute("merge.bytes_serialized", size)
+    telemetry.payload_size.record(size, {"payload": "serialized", "format": output_format})
+    seconds = time.perf_counter() - started
+    print(f"Wrote {output_file}: {len(all_points)} points, {size / 1024:.0f} KB in {seconds:.2f}s")
+    if reduction:
+        print(f"  simplification saved an estimated {reduction.estimated_seconds_saved(seconds):.2f}s of writing")
+    if compare_formats:
+        for fmt, (fmt_size, seconds) in formats.compare(all_points, sport, total_time, total_distance).items():
+            print(f"  {fmt}: {fmt_size / 1024:.0f} KB in {seconds:.2f}s")
+
+def upload_activity(session, access_token, file_path, name, description, data_type='fit', compression_level=0,
+                    wait=None):
+    """Upload ``file_path``; returns whether Strava accepted it (and, with
+    ``wait``, processed it without error).
+    """
+    from todo import telemetry, uploads
+
+    filename = os.path.basename(file_path)
     with open(file_path, 'rb') as f:
-        files = {'file': f}
-        response = requests.post(url, headers=headers, data=data, files=files)
-    if response.status_code == 201:
-        print("Activity uploaded successfully")
-    else:
+        chunks = telemetry.MeteredChunks(iter(lambda: f.read(64 * 1024), b''))
+        upload = chunks
+        if compression_level:
+            # Strava accepts gzipped uploads as <type>.gz; compress while streaming
+            upload = uploads.GzipStream(chunks, compression_level)
+            data_type += '.gz'
+            filename += '.gz'
+        with telemetry.stage("upload", {"merge.data_type": data_type}) as span:
+            response = uploads.upload_activity(session, access_token, upload, name, description, data_type,
+                                               filename)
+            upload_bytes = upload.compressed_bytes if isinstance(upload, uploads.GzipStream) else chunks.bytes
+            span.set_attributes({"merge.bytes_uploaded": upload_bytes, "merge.upload_status": response.status_code})
+    telemetry.payload_size.record(upload_bytes, {"payload": "upload", "format": data_type})
+    if isinstance(upload, uploads.GzipStream):
+        print(f"Compressed upload: {upload.summary()}")
+    if response.status_code != 201:
         print(f"Upload failed: {response.status_code} {response.text}")
+        return False
+    print("Activity uploaded successfully")
+    if wait:
+        upload_id = response.json()['id']
+        print(f"Waiting up to {wait:.0f}s for Strava to process upload {upload_id}...")
+        outcome = uploads.wait_for_upload(session, access_token, upload_id, timeout=wait)
+        if outcome.state == uploads.READY:
+            print(f"Activity ready: https://www.strava.com/activities/{outcome.activity_id}")
+        elif outcome.state == uploads.ERROR:
+            print(f"Strava could not process the upload: {outcome.error}")
+            return False
+        else:
+            print("Strava is still processing the upload")
+    return True
+
+def command_list(args):
+    access_token, _, _ = get_access_token(interactive=False)
+    activities = fetch_recent_activities(make_session(), access_token, args.days)
+    if args.json:
+        import json
+        for activity in activities:
+            print(json.dumps(activity))
+        return 0
+    for activity in activities:
+        sport = activity.get('sport_type') or activity.get('type')
+        print(f"{activity['id']}\t{activity['start_date_local']}\t{sport}\t{activity['name']}")
+    return 0
 
-def main():
-    access_token, refresh_token, expires_at = get_access_token()
-    client = Client(access_token=access_token, refresh_token=refresh_token, token_expires=expires_at)
+def command_merge(args):
+    prefer = preferences(args, args.activity_ids)
+    access_token, _, _ = get_access_token(interactive=False)
+    session = make_session()
+    output_file = args.output or f'merged.{args.format}'
+    merge_activities(make_client(session, access_token), args.activity_ids,
+                     output_file, args.format, args.compare_formats, args.simplify_interval,
+                     args.simplify_tolerance, prefer, args.resample)
+    if not args.upload:
+        return 0
+    uploaded = upload_activity(session, access_token, output_file, args.name, args.description,
+                               data_type=args.format, compression_level=args.compress_level, wait=args.wait)
+    return 0 if uploaded else 1
 
-    activities = list_recent_activities(client)
+def command_upload(args):
+    access_token, _, _ = get_access_token(interactive=False)
+    filename = os.path.basename(args.file).lower()
+    data_type = args.data_type
+    compression_level = args.compress_level
+    if data_type is None:
+        data_type = next((fmt for fmt in OUTPUT_FORMATS if filename.endswith((f'.{fmt}', f'.{fmt}.gz'))), None)
+        if data_type is None:
+            sys.exit(f"Cannot tell the format of {args.file}; pass --data-type")
+    if filename.endswith('.gz'):
+        # Already compressed
+        data_type += '.gz'
+        compression_level = 0
+    uploaded = upload_activity(make_session(), access_token, args.file, args.name, args.description,
+                               data_type=data_type, compression_level=compression_level, wait=args.wait)
+    return 0 if uploaded else 1
+
+def command_batch(args):
+    from todo import batch
+    from todo.stream_cache import DEFAULT_MAX_BYTES, StreamCache
+
+    # Read the manifest first so that mistakes show up before authenticating
+    groups = batch.load_manifest(args.manifest)
+    access_token, _, _ = get_access_token()
+    session = make_session(pool_size=max(args.concurrency, 10))
+    stream_cache = StreamCache(os.getenv('STREAM_CACHE_DIR'),
+                               int(os.getenv('STREAM_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)))
+    report = batch.BatchMerge(
+        make_client(session, access_token), session, access_token, args.output_dir,
+        args.format, processes=args.processes, concurrency=args.concurrency, upload=not args.no_upload,
+        compression_level=args.compress_level, stream_cache=stream_cache, simplify_interval=args.simplify_interval,
+        simplify_tolerance=args.simplify_tolerance, resample=args.resample, wait=args.wait,
+        on_result=lambda result: print(batch.describe(result), flush=True),
+    ).run(groups)
+    print(f"{report['done']} merged, {report['failed']} failed, {report['skipped']} already done "
+          f"in {report['seconds']:.1f}s; report in {os.path.join(args.output_dir, batch.REPORT_FILE)}")
+    return 0 if not report['failed'] else 1
+
+def command_interactive(args):
+    access_token, _, _ = get_access_token()
+    session = make_session()
+    activities = list_recent_activities(session, access_token)
 
     if len(activities) < 2:
         print("Not enough activities in the past week.")
-        return
+        return 0
 
     try:
         idx1 = int(input("Select first activity (number): ")) - 1
         idx2 = int(input("Select second activity (number): ")) - 1
     except ValueError:
         print("Invalid input")
-        return
+        return 1
 
     if idx1 < 0 or idx1 >= len(activities) or idx2 < 0 or idx2 >= len(activities):
         print("Invalid selection")
-        return
+        return 1
 
     act1 = activities[idx1]
     act2 = activities[idx2]
 
-    merge_activities(client, act1.id, act2.id, 'merged.tcx')
+    output_file = f'merged.{args.format}'
+    activity_ids = [act1['id'], act2['id']]
+    merge_activities(make_client(session, access_token), activity_ids,
+                     output_file, args.format, args.compare_formats, args.simplify_interval,
+                     args.simplify_tolerance, preferences(args, activity_ids), args.resample)
 
     name = input("Enter name for merged activity: ")
     description = input("Enter description: ")
 
-    upload_activity(access_token, 'merged.tcx', name, description, data_type='tcx')
+    uploaded = upload_activity(session, access_token, output_file, name, description, data_type=args.format,
+                               compression_level=args.compress_level, wait=args.wait)
+    return 0 if uploaded else 1
+
+def add_merge_options(parser, defaults=True):
+    # Subcommands leave unset options alone, so values given before the command still apply
+    default = (lambda value: value) if defaults else (lambda value: argparse.SUPPRESS)
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default=default('tcx'),
+                        help="output file format (default: tcx)")
+    parser.add_argument('--compare-formats', action='store_true', default=default(False),
+                        help="also report size and encoding time of every output format")
+    parser.add_argument('--simplify-interval', type=int, metavar='SECONDS', default=default(None),
+                        help="keep at most one point per this many seconds")
+    parser.add_argument('--simplify-tolerance', type=float, metavar='METERS', default=default(None),
+                        help="drop points within this distance of the simplified line (Douglas-Peucker)")
+    parser.add_argument('--prefer', type=parse_prefer, action='append', metavar='CHANNEL=ID[,ID]',
+                        default=default([]),
+                        help="where activities overlap, take CHANNEL (position, distance, altitude, heartrate, "
+                             "cadence or watts) from these activities first; may be repeated")
+    parser.add_argument('--resample', action='store_true', default=default(False),
+                        help="interpolate the merged track onto one point per second")
+
+def preferences(args, activity_ids):
+    """The --prefer options as a dict; exits if they name activities not being merged."""
+    from todo.trackpoints import source_priority
+
+    prefer = dict(args.prefer)
+    try:
+        source_priority(activity_ids, prefer)
+    except ValueError as e:
+        sys.exit(f"--prefer: {e}")
+    return prefer
+
+def parse_prefer(value):
+    channel, _, ids = value.partition('=')
+    try:
+        return channel.strip(), [int(i) for i in ids.split(',') if i.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected CHANNEL=ID[,ID], got {value!r}")
+
+def add_upload_options(parser, defaults=True):
+    default = (lambda value: value) if defaults else (lambda value: argparse.SUPPRESS)
+    parser.add_argument('--compress-level', type=int, choices=range(0, 10), default=default(6), metavar='0-9',
+                        help="gzip level for the upload, 0 to upload uncompressed (default: 6)")
+    parser.add_argument('--wait', type=float, nargs='?', const=300.0, metavar='SECONDS', default=default(None),
+                        help="wait for Strava to finish processing each upload (default: up to 300s)")
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Merge Strava activities and upload the result. Without a command, prompts for two "
+                    "recent activities.")
+    parser.add_argument('--manifest', metavar='FILE',
+                        help="merge every group in a JSON or CSV manifest without prompting")
+    parser.add_argument('--output-dir', default='merged',
+                        help="where batch mode writes outputs, its resume state and report (default: merged)")
+    parser.add_argument('--processes', type=int, help="batch mode merge processes (default: CPU count)")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="batch mode concurrent downloads and uploads (default: 4)")
+    parser.add_argument('--no-upload', action='store_true', help="batch mode: only write the merged files")
+    add_merge_options(parser)
+    add_upload_options(parser)
+    parser.add_argument('--otel', choices=OTEL_EXPORTERS,
+                        help="export OpenTelemetry spans and metrics to the console or over OTLP")
+    parser.add_argument('--timings', action='store_true',
+                        help="print startup and per-import times to stderr on exit")
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+
+    list_parser = commands.add_parser('list', help="print recent activities, one per line")
+    list_parser.add_argument('--days', type=float, default=7, help="how far back to look (default: 7)")
+    list_parser.add_argument('--json', action='store_true', help="print each activity as a JSON object")
+    list_parser.set_defaults(run=command_list)
+
+    merge_parser = commands.add_parser('merge', help="merge activities by ID without prompting")
+    merge_parser.add_argument('activity_ids', type=int, nargs='+', metavar='ID')
+    merge_parser.add_argument('-o', '--output', metavar='FILE', help="output path (default: merged.<format>)")
+    merge_parser.add_argument('--upload', action='store_true', help="upload the merged file")
+    merge_parser.add_argument('--name', default=DEFAULT_NAME, help="name of the uploaded activity")
+    merge_parser.add_argument('--description', default=DEFAULT_DESCRIPTION)
+    add_merge_options(merge_parser, defaults=False)
+    add_upload_options(merge_parser, defaults=False)
+    merge_parser.set_defaults(run=command_merge)
+
+    upload_parser = commands.add_parser('upload', help="upload a TCX or FIT file (optionally .gz)")
+    upload_parser.add_argument('file')
+    upload_parser.add_argument('--name', default=DEFAULT_NAME)
+    upload_parser.add_argument('--description', default=DEFAULT_DESCRIPTION)
+    upload_parser.add_argument('--data-type', choices=OUTPUT_FORMATS,
+                               help="file format (default: from the file extension)")
+    add_upload_options(upload_parser, defaults=False)
+    upload_parser.set_defaults(run=command_upload)
+    return parser
+
+def run(args):
+    if args.otel:
+        from todo import telemetry
+        telemetry.configure(args.otel, 'strava-merge-cli')
+    if args.command:
+        return args.run(args)
+    if args.manifest:
+        return command_batch(args)
+    return command_interactive(args)
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    main_started = time.perf_counter()
+    timer = ImportTimer() if args.timings else None
+    try:
+        with timer or contextlib.nullcontext():
+            return run(args)
+    finally:
+        if timer:
+            timer.report(main_started)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())